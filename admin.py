@@ -2,12 +2,17 @@
 import asyncio
 from tornado import web
 import os, sys
+import httppool
+import seriesindex
 
 class Storage(object):
     def __init__(self, **kwds):
         for k, v in kwds.items():
             setattr(self, k, v)
 
+# number of series listed on a page of uploads table
+PAGE_SIZE = 500
+
 class WebUI(web.RequestHandler):
     def initialize(self, manager):
         self.manager = manager
@@ -25,7 +30,19 @@ class WebUI(web.RequestHandler):
 
     def get_index(self):
         self.set_header('content-type', 'text/html')
-        self.render('main.html', uname=os.uname(), projects=self.projects)
+        # uploads table: status filter and page
+        status = self.get_argument('status', '') or None
+        if status and status not in seriesindex.STATUS_FILTERS:
+            self.send_error(400)
+            return
+        try:
+            offset = max(0, int(self.get_argument('offset', '0')))
+            limit = int(self.get_argument('limit', str(PAGE_SIZE)))
+        except ValueError:
+            self.send_error(400)
+            return
+        self.render('main.html', uname=os.uname(), projects=self.projects,
+                    status=status, offset=offset, limit=limit)
     def get_startpackwarcs(self):
         try:
             pj = int(self.get_argument('pj'))
@@ -51,11 +68,18 @@ class WebUI(web.RequestHandler):
             if series is None:
                 self.write(dict(ok=0, s=s, error='no such series'))
                 return
-            r = series.retryasap()
+            r = pj.retryasap(series)
             self.write(r)
         except Exception as ex:
             self.write(dict(ok=0, s=p.s, error=str(ex)))
 
+    def get_uploadstats(self):
+        pjid = int(self.get_argument('pj'))
+        pj = self.projects[pjid]
+        stats = pj.upload_stats.to_dict()
+        stats['window'] = pj.upload_window.to_dict()
+        self.write(stats)
+
     def get_processes(self):
         result = []
         pjid = int(self.get_argument('pj'))
@@ -70,6 +94,15 @@ class WebUI(web.RequestHandler):
                                a=proc.cmdline))
         self.write(result)
 
+    def get_uploadrate(self):
+        try:
+            rate = httppool.parse_rate(self.get_argument('rate', ''))
+        except ValueError as ex:
+            self.write(dict(ok=0, error=str(ex)))
+            return
+        self.manager.set_upload_rate(rate)
+        self.write(dict(ok=1, rate=rate))
+
     def get_drain(self):
         pjid = int(self.get_argument('pj'))
         sw = self.get_argument('sw', '1')
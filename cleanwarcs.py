@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""delete uploaded W/ARCs of series
+Usage: cleanwarcs.py xfer_job_dir
+
+in-process equivalent of delete-verified-warcs.sh (always in force
+mode). for each series with SUCCESS, W/ARCs listed in MANIFEST are
+deleted if all of them have .tombstone. progress and errors of each
+series go to CLEAN.open, which is renamed to CLEAN on success, or to
+CLEAN.err on failure.
+"""
+
+import sys, os
+import time
+
+class CleanError(Exception):
+    pass
+
+class SeriesCleaner(object):
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.counts = dict(cleaned=0, inactive=0, active=0, error=0,
+                           locked=0)
+        self.total_rm_count = 0
+
+    def echo(self, msg):
+        print(msg, file=self.out)
+
+    def clean_item(self, d, log):
+        """delete uploaded files in series directory d, writing messages
+        to file log. raises CleanError on failure."""
+        with open(os.path.join(d, 'MANIFEST')) as f:
+            upload_files = [l.split()[1] for l in f if len(l.split()) > 1]
+        # if .tombstone's and MANIFEST don't agree, something must have
+        # gone wrong. need to call operator's attention.
+        missedout = [w for w in upload_files
+                     if not os.path.exists(os.path.join(d, w + '.tombstone'))]
+        if missedout:
+            for w in missedout:
+                print("%s: listed in MANIFEST, but no .tombstone exists" % w,
+                      file=log)
+            raise CleanError("ERROR: %d file(s) not uploaded while SUCCESS"
+                             " exists" % len(missedout))
+        if not upload_files:
+            print("no uploaded files in this item", file=log)
+            return
+        self.echo("cleaning %s" % os.path.basename(d))
+        removed = missing = 0
+        for w in upload_files:
+            path = os.path.join(d, w)
+            if not os.path.exists(path):
+                # already deleted files are okay. it is sometimes necessary
+                # to add/re-upload files after upload is complete.
+                missing += 1
+                continue
+            with open(path + '.tombstone') as f:
+                print("removing %s uploaded to %s" % (w, f.read().strip()),
+                      file=log)
+            os.remove(path)
+            removed += 1
+        if missing:
+            print("%s: removed %d files (%d already removed)" % (
+                    os.path.basename(d), removed, missing), file=log)
+        else:
+            print("%s: removed %d files" % (os.path.basename(d), removed),
+                  file=log)
+        self.total_rm_count += removed
+
+    def clean(self, d):
+        """clean series directory d if it is ready. returns one of
+        'cleaned', 'inactive' (already cleaned), 'active' (no SUCCESS
+        yet), 'locked', 'error' and None (has CLEAN.err)."""
+        iid = os.path.basename(d)
+        CLEAN = os.path.join(d, 'CLEAN')
+        if os.path.exists(CLEAN + '.err'):
+            self.echo("%s: has CLEAN.err" % iid)
+            return None
+        if os.path.exists(CLEAN):
+            status = 'inactive'
+        elif not os.path.exists(os.path.join(d, 'SUCCESS')):
+            self.echo("%s: no SUCCESS yet" % iid)
+            status = 'active'
+        elif os.path.exists(CLEAN + '.open'):
+            self.echo("%s: has %s.open" % (iid, CLEAN))
+            status = 'locked'
+        else:
+            try:
+                with open(CLEAN + '.open', 'w') as log:
+                    try:
+                        self.clean_item(d, log)
+                    except CleanError as ex:
+                        print(ex, file=log)
+                        raise
+                os.rename(CLEAN + '.open', CLEAN)
+                status = 'cleaned'
+            except (CleanError, OSError) as ex:
+                if os.path.exists(CLEAN + '.open'):
+                    os.rename(CLEAN + '.open', CLEAN + '.err')
+                self.echo("failed to clean %s - see %s.err" % (d, CLEAN))
+                self.echo(str(ex))
+                status = 'error'
+        self.counts[status] += 1
+        return status
+
+    def run(self, xfer_dir):
+        self.echo("%s: %s" % (os.path.basename(__file__), time.strftime('%c')))
+        for name in sorted(os.listdir(xfer_dir)):
+            d = os.path.join(xfer_dir, name)
+            if os.path.isdir(d):
+                self.clean(d)
+        self.echo("%s: %s" % (os.path.basename(__file__), self.summary()))
+        self.echo("%s: done %s" % (os.path.basename(__file__),
+                                   time.strftime('%c')))
+        return self.counts['cleaned']
+
+    def summary(self):
+        return ("%(cleaned)d cleaned, %(inactive)d inactive, %(active)d"
+                " active, %(error)d error, %(locked)d locked" % self.counts +
+                "; removed %d files total" % self.total_rm_count)
+
+def main(xfer_dir, out=None):
+    """clean all series in xfer_dir. returns exit status."""
+    try:
+        SeriesCleaner(out=out).run(xfer_dir)
+    except OSError as ex:
+        print("ERROR: %s" % ex, file=out or sys.stdout)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    sys.exit(main(sys.argv[1]))
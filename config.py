@@ -2,36 +2,100 @@
 
 """returns a config dict string from YAML config file
 Usage: config.py file [param]
+       config.py --export-shell [--prefix=PREFIX] file
+       config.py --export-json file
     file   a YAML config file
     param  optional param to get from file
+
+--export-shell validates the config, and prints all parameters,
+including derived ones (job_dir, xfer_dir, warc_name_pattern,
+s3cfg, ...), as shell variable assignments for eval, like:
+
+    confvars=$(config.py --export-shell --prefix=conf_ $CONFIG) || exit 1
+    eval "$confvars"
+
+values are the same as config.py file param prints (metadata as -m
+prints it). --export-json prints them as a JSON object instead.
 """
 __author__ = "siznax 2010"
 
 import sys, os, pprint, re
+import copy
+import json
+import shlex
 from lib import yaml
 
+# LibYAML-based loader of system PyYAML is many times faster than
+# pure-Python one of vendored yaml. it is used with its own yaml module:
+# vendored yaml cannot be mixed with system C extension.
+try:
+    import yaml as yaml_loader
+    SafeLoader = yaml_loader.CSafeLoader
+except (ImportError, AttributeError):
+    yaml_loader = yaml
+    SafeLoader = yaml.SafeLoader
+
 MAX_ITEM_SIZE_GB = 500
+PIPELINE_STAGES = ('pack', 'manifest', 'ingest', 'clean')
+
+# synthetic parameters included in export(), in addition to those in YAML
+DERIVED_PARAMS = ('config', 'job_dir', 'xfer_dir', 'drainme',
+                  'warc_name_pattern', 'warc_name_pattern_upload',
+                  'item_name_template', 'item_name_template_sh',
+                  'collections', 'crawlhost', 'metadata', 's3cfg')
 
 def is_alnum(x): return x.isalnum()
 def is_integer(x): return type(x) == int
 def is_name(x): return re.match(r'[-_a-zA-Z0-9]+$', x)
+def is_number(x): return type(x) in (int, float)
 def is_boolean(x): return isinstance(x, (bool, int))
 
+class CachedConfig(object):
+    """config dict parsed from a file, as of stamp (mtime, size) of the
+    file. validated is True once validate() has passed on it."""
+    __slots__ = ('stamp', 'cfg', 'validated')
+
+    def __init__(self, stamp, cfg):
+        self.stamp = stamp
+        self.cfg = cfg
+        self.validated = False
+
+# CachedConfig by absolute path of config file. DrainConfig for a file
+# unchanged since last loaded skips parsing, and validate() skips all
+# checks (including job_dir and xfer_dir) if the last one passed.
+_cache = {}
+
+def clear_cache():
+    _cache.clear()
+
 class DrainConfig(object):
     def __init__(self, fname):
         self.fname = fname
+        # CachedConfig cfg is copied from
+        self.cached = None
         self.cfg = self.load(fname)
 
     def load(self, fname):
         """return config dict from YAML file"""
+        path = os.path.abspath(fname)
         try:
             with open(fname) as f:
-                return yaml.safe_load(f.read())
+                st = os.fstat(f.fileno())
+                stamp = (st.st_mtime_ns, st.st_size)
+                cached = _cache.get(path)
+                if cached is None or cached.stamp != stamp:
+                    cfg = yaml_loader.load(f, Loader=SafeLoader)
+                    cached = _cache[path] = CachedConfig(stamp, cfg)
         except OSError:
             print("Failed to open %s" % fname, file=sys.stderr)
-        except yaml.YAMLError as exc:
+            return None
+        except (yaml.YAMLError, yaml_loader.YAMLError) as exc:
             print("Error parsing config:", exc, file=sys.stderr)
             sys.exit(1)
+        self.cached = cached
+        # callers may modify cfg (tests do). cached one must stay as
+        # parsed.
+        return copy.deepcopy(cached.cfg)
 
     def __check(self, name, vf, msg):
         v = self.get_param(name)
@@ -41,7 +105,24 @@ class DrainConfig(object):
     def check_integer(self, name):
         self.__check(name, is_integer, 'must be an integer')
 
+    def check_optional_integer(self, name):
+        if self.cfg.get(name) is not None:
+            self.check_integer(name)
+
+    def check_optional_number(self, name):
+        if self.cfg.get(name) is not None:
+            self.__check(name, is_number, 'must be a number')
+
     def validate(self):
+        cached = self.cached
+        if cached and cached.validated and self.cfg == cached.cfg:
+            return True
+        self.validate_all()
+        if cached and self.cfg == cached.cfg:
+            cached.validated = True
+        return True
+
+    def validate_all(self):
         self.__check('crawljob', is_name, 'must be alpha-numeric')
         self.__check('job_dir', os.path.isdir, 'must be a directory')
         self.__check('xfer_dir', os.path.isdir, 'must be a directory')
@@ -88,8 +169,36 @@ class DrainConfig(object):
         self.check_integer('derive')
         # compact_names is int
         self.check_integer('compact_names')
-
-        return True
+        # number of files hashed concurrently by manifest.py
+        self.check_optional_integer('manifest_workers')
+        # concurrency limits of s3upload.py
+        self.check_optional_integer('upload_concurrency')
+        self.check_optional_integer('upload_series')
+        self.check_optional_integer('upload_max_connections')
+        # requests verify.py makes at once, and its samples of each file
+        self.check_optional_integer('verify_concurrency')
+        self.check_optional_integer('verify_samples')
+        self.check_optional_number('verify_sample_size')
+        # sampling interval of job_dir for admin page
+        self.check_optional_number('source_sample_interval')
+        # wake up dtmon.py on job_dir changes
+        if self.cfg.get('inotify') is not None:
+            self.__check('inotify', is_boolean, 'must be 0 or 1')
+        # skip files found in the item when resuming upload
+        if self.cfg.get('remote_resume') is not None:
+            self.__check('remote_resume', is_boolean, 'must be 0 or 1')
+        # workers of each stage of pipeline.py
+        workers = self.cfg.get('pipeline_workers')
+        if workers is not None:
+            if not isinstance(workers, dict) or not all(
+                    k in PIPELINE_STAGES and is_integer(v) and v > 0
+                    for k, v in workers.items()):
+                raise ValueError('pipeline_workers must map %s to a'
+                                 ' positive integer: %s' % (
+                        '/'.join(PIPELINE_STAGES), workers))
+        # multipart upload of large files, in MB
+        self.check_optional_number('multipart_threshold')
+        self.check_optional_number('multipart_part_size')
 
     def validate_naming(self):
         """validate naming WARC filename pattern and item name template.
@@ -266,32 +375,58 @@ class DrainConfig(object):
         if param is None:
             pprint.pprint(self.cfg, stream=out)
         else:
-            v = self.get_param(param)
-            if isinstance(v, dict):
-                if format == 'header':
-                    for key, value in v.items():
-                        if re.search(r'\s', key): continue
-                        if value is None or value == '': continue
-                        for s in format_header(key, value):
-                            print(s, file=out)
+            for line in format_value(self.get_param(param), format):
+                print(line, file=out)
+
+    def export(self):
+        """returns dict of all parameters, those in YAML and synthetic
+        ones (DERIVED_PARAMS), with values as returned by get_param."""
+        params = {}
+        for name in list(self.cfg) + list(DERIVED_PARAMS):
+            params[name] = self.get_param(name)
+        return params
+
+    def export_shell(self, prefix='', out=sys.stdout):
+        """print parameters as shell variable assignments"""
+        params = self.export()
+        for name in sorted(params):
+            var = prefix + re.sub(r'\W', '_', name)
+            fmt = 'header' if name == 'metadata' else None
+            value = '\n'.join(format_value(params[name], fmt))
+            print('%s=%s' % (var, shlex.quote(value)), file=out)
+
+    def export_json(self, out=sys.stdout):
+        json.dump(self.export(), out, indent=1, sort_keys=True)
+        print(file=out)
+
+def format_value(v, format=None):
+    """returns lines of value v of a parameter, as printed by
+    config.py"""
+    lines = []
+    if isinstance(v, dict):
+        if format == 'header':
+            for key, value in v.items():
+                if re.search(r'\s', key): continue
+                if value is None or value == '': continue
+                lines.extend(format_header(key, value))
+        else:
+            for key, value in v.items():
+                # space in key screws up, so drop it
+                if re.search(r'\s', key): continue
+                if value is None:
+                    lines.append("%s\t")
+                elif isinstance(value, list):
+                    lines.append("%s\t%s" % (key, ';'.join(value)))
                 else:
-                    for key, value in v.items():
-                        # space in key screws up, so drop it
-                        if re.search(r'\s', key): continue
-                        if value is None:
-                            print("%s\t", file=out)
-                        elif isinstance(value, list):
-                            print("%s\t%s" % (key, ';'.join(value)), file=out)
-                        else:
-                            print("%s\t%s" % (key, value), file=out)
-            elif isinstance(v, list):
-                for value in v:
-                    print(value, file=out)
-            elif isinstance(v, bool):
-                print(int(v), file=out)
-            else:
-                print(v if v is not None else '', file=out)
-        
+                    lines.append("%s\t%s" % (key, value))
+    elif isinstance(v, list):
+        lines.extend(str(value) for value in v)
+    elif isinstance(v, bool):
+        lines.append(str(int(v)))
+    else:
+        lines.append(str(v) if v is not None else '')
+    return lines
+
 def format_header(k, v):
     if isinstance(v, list):
         for i, v1 in enumerate(v):
@@ -305,13 +440,31 @@ if __name__ == "__main__":
     opt.add_option('-f', dest='format', default=None)
     opt.add_option('-m', action='store_const', dest='format', const='header',
                    help='equivalent of -f header')
+    opt.add_option('--export-shell', action='store_const', dest='export',
+                   const='shell', default=None,
+                   help='print all parameters as shell variable assignments')
+    opt.add_option('--export-json', action='store_const', dest='export',
+                   const='json', help='print all parameters as JSON')
+    opt.add_option('--prefix', dest='prefix', default='',
+                   help='prefix of shell variable names (--export-shell)')
     options, args = opt.parse_args()
     if len(args) < 1:
         print(os.path.basename(__file__),  __doc__, __author__)
         sys.exit(1)
     else:
         config = DrainConfig(args[0])
-        if len(args) == 1:
+        if options.export:
+            try:
+                config.validate()
+            except (ValueError, KeyError, TypeError) as ex:
+                print("ERROR: invalid config: %s: %s" % (args[0], ex),
+                      file=sys.stderr)
+                sys.exit(1)
+            if options.export == 'shell':
+                config.export_shell(prefix=options.prefix)
+            else:
+                config.export_json()
+        elif len(args) == 1:
             if config.validate():
                 config.pprint()
         elif len(args) == 2:
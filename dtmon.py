@@ -14,14 +14,27 @@ import sys, os
 libdir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'lib'))
 if libdir not in sys.path:
     sys.path.append(libdir)
-import config, utils
-import re
+import config, utils, httppool
+import packwarcs, manifest, s3upload, cleanwarcs, pipeline
+import inotify, retrysched, seriesindex, sourcestats
+import uploadstats, uploadwindow
 import subprocess
 import threading
 import signal
 import errno
+import time
+import traceback
 from tempfile import NamedTemporaryFile
 from datetime import datetime
+from collections import OrderedDict
+
+# seconds to sleep at least before retry job, even if retries are
+# overdue
+MIN_RETRY_SLEEP = 1.0
+
+# number of Series kept in Project.series_cache, least recently used
+# ones are dropped first
+SERIES_CACHE_SIZE = 1000
 
 class Storage(object):
     def __init__(self, **kwds):
@@ -86,6 +99,32 @@ def getdtprocesses(dtconf, excludes=[]):
                                   o=getstdout(pid), st=start_time))
     return result
 
+class StepThread(threading.Thread):
+    '''runs drain step in-process, with subset of Popen interface
+    (pid, poll(), wait()) used by Project and admin UI.'''
+    def __init__(self, name, func, out):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.func = func
+        self.out = out
+        self.pid = os.getpid()
+        self.returncode = None
+
+    def run(self):
+        try:
+            self.returncode = self.func(self.out) or 0
+        except Exception:
+            traceback.print_exc(file=self.out)
+            self.returncode = 1
+        finally:
+            self.out.flush()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.join()
+        return self.returncode
+
 def getstdout(pid):
     path = os.path.join('/proc', str(pid), 'fd', '1')
     try:
@@ -94,21 +133,44 @@ def getstdout(pid):
         return None
 
 
+def marker_path(f):
+    return property(lambda self: os.path.join(self.path, f))
+
 class Series(object):
-    def __init__(self, xfer, name):
+    '''series in xfer dir. marker files and W/ARC counts come from a
+    snapshot of the series directory (seriesindex.SeriesState), which is
+    taken with a single scandir if not given.'''
+    __slots__ = ('xfer', 'name', 'state')
+
+    # paths of marker files
+    RETRY = marker_path('RETRY')
+    PACKED = marker_path('PACKED')
+    MANIFEST = marker_path('MANIFEST')
+    LAUNCH = marker_path('LAUNCH')
+    TASK = marker_path('TASK')
+    SUCCESS = marker_path('SUCCESS')
+    ERROR = marker_path('ERROR')
+    TOMBSTONE = marker_path('TOMBSTONE')
+
+    def __init__(self, xfer, name, state=None):
         self.xfer = xfer
         self.name = name
-        self.path = os.path.join(self.xfer, self.name)
-        for f in ('RETRY','PACKED','MANIFEST','LAUNCH','TASK',
-                  'SUCCESS','ERROR','TOMBSTONE'):
-            setattr(self, f, os.path.join(self.path, f))
-        try:
-            st = os.stat(self.path)
-            self.mtime = st.st_mtime
-        except OSError:
-            self.mtime = 0
+        if state is None:
+            state = (seriesindex.scan_series(self.path) or
+                     seriesindex.SeriesState(name, 0, '', None, 0, 0))
+        self.state = state
+
+    @property
+    def path(self):
+        return os.path.join(self.xfer, self.name)
+
+    @property
+    def mtime(self):
+        return self.state.mtime
 
     def has_file(self, file):
+        if file in seriesindex.MARKERS:
+            return self.state.has(file)
         return os.path.isfile(os.path.join(self.xfer, self.name, file))
     def read_file(self, file):
         path = os.path.join(self.xfer, self.name, file)
@@ -128,21 +190,11 @@ class Series(object):
 
     @property
     def warcs(self):
-        d = os.path.join(self.xfer, self.name)
-        count = 0
-        for fn in os.listdir(d):
-            if re.match(r'.*\.w?arc(\.gz)?$', fn):
-                count += 1
-        return count
+        return self.state.warcs
 
     @property
     def warcs_done(self):
-        d = os.path.join(self.xfer, self.name)
-        count = 0
-        for fn in os.listdir(d):
-            if re.match(r'.*\.w?arc(\.gz)?\.tombstone$', fn):
-                count += 1
-        return count
+        return self.state.warcs_done
 
     @property
     def packed(self):
@@ -174,19 +226,13 @@ class Series(object):
 
     @property
     def retry(self):
-        if self.has_file('RETRY'):
-            return 'RETRY (%s)' % (self.read_file('RETRY'),)
-        else:
+        if self.state.retry is None:
             return None
+        return 'RETRY (%s)' % (self.state.retry,)
 
     @property
     def status(self):
-        if self.has_file('SUCCESS'):
-            return 'completed'
-        if not os.path.isfile(self.RETRY):
-            if self.has_file('LAUNCH.open'): return 'running'
-            if self.has_file('MANIFEST.open'): return 'running'
-        return ''
+        return self.state.status
 
     def retryasap(self):
         if os.path.isfile(self.SUCCESS):
@@ -227,29 +273,84 @@ class Project(object):
         self.config_fname = os.path.abspath(config)
         self.manager = manager
         self.processes = []
-        self.config_mtime = None
+        self.config_stamp = None
+        # message of the last config found invalid, None if valid
+        self.config_error = None
+        # set by wakeup(). wakeup while draining cuts the next sleep.
+        self.wakeup_event = threading.Event()
+        self.next_wakeup = None
+        self.watcher = None
+        # RetrySchedule of xfer_dir, loaded once from RETRY files
+        self.retries = None
+        # SeriesIndex of xfer_dir
+        self.index = None
+        # Series by name, reused while series directory is unchanged,
+        # least recently used first
+        self.series_cache = OrderedDict()
+        # SourceSampler of job_dir
+        self.sampler = None
+        # timings of upload requests, for admin page
+        self.upload_stats = uploadstats.UploadStats()
+        # concurrency of upload requests, adapted across runs. made
+        # from the first valid config.
+        self.upload_window = None
 
     def is_config_updated(self):
-        if self.config_mtime is None: return True
+        # (mtime, size) of config file, as in config.DrainConfig cache
         st = os.stat(self.config_fname)
-        if st.st_mtime > self.config_mtime:
-            self.config_mtime = st.st_mtime
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self.config_stamp:
+            self.config_stamp = stamp
             return True
         else:
             return False
         
     def loadconfig(self, force=False):
-        if force or self.is_config_updated():
-            self.configobj = config.DrainConfig(self.config_fname)
-            try:
-                self.configobj.validate()
-                print("config OK: %s" % self.config_fname)
-            except Exception as ex:
-                print('Aborting: invalid config %s: %s' % (
-                    self.config_fname, ex), file=sys.stderr)
-                sys.exit(1)
-            self.DRAINME = self.configobj['drainme']
-            self.sleep = self.configobj['sleep_time']
+        '''(re)load config file if updated. raises ValueError if it is
+        invalid (the last valid one is kept in configobj).'''
+        try:
+            if not (force or self.is_config_updated()):
+                return
+            configobj = config.DrainConfig(self.config_fname)
+            configobj.validate()
+        except Exception as ex:
+            # read again next time, until it is fixed
+            self.config_stamp = None
+            self.config_error = str(ex)
+            raise ValueError('invalid config %s: %s' % (
+                self.config_fname, ex))
+        self.config_error = None
+        self.configobj = configobj
+        print("config OK: %s" % self.config_fname)
+        self.DRAINME = self.configobj['drainme']
+        self.sleep = self.configobj['sleep_time']
+        if self.upload_window is None:
+            self.upload_window = uploadwindow.AdaptiveWindow(
+                (self.configobj['upload_concurrency'] or
+                 s3upload.DEFAULT_CONCURRENCY),
+                (self.configobj['upload_max_connections'] or
+                 s3upload.DEFAULT_MAX_CONNECTIONS))
+        if self.index is None or self.index.xfer_dir != self.xfer_dir:
+            # rebuilt from marker files, which may have changed while
+            # dtmon was not running (or crashed) without changing mtime
+            self.index = seriesindex.SeriesIndex(self.xfer_dir)
+            print("indexed %d series in %s" % (self.index.rebuild(),
+                                                self.xfer_dir))
+        self.update_sampler()
+
+    def update_sampler(self):
+        '''start SourceSampler of job_dir, or restart it for new job_dir
+        or source_sample_interval'''
+        job_dir = self.configobj['job_dir']
+        interval = (self.configobj['source_sample_interval'] or
+                    sourcestats.DEFAULT_INTERVAL)
+        if self.sampler:
+            if self.sampler.job_dir == job_dir and \
+                    self.sampler.interval == interval:
+                return
+            self.sampler.stop()
+        self.sampler = sourcestats.SourceSampler(job_dir, interval)
+        self.sampler.start()
 
     def configitems(self):
         return self.configobj.iteritems()
@@ -258,76 +359,71 @@ class Project(object):
     def xfer_dir(self):
         return self.configobj['xfer_dir']
 
-    def count_warcs(self, dir):
-        cnt = 0
-        try:
-            for f in os.listdir(dir):
-                if re.match(r'.*\.w?arc(\.gz)?$', f): cnt += 1
-        except:
-            pass
-        return cnt
-
-    def warcs_size(self, dir):
-        size = 0
-        for fn in os.listdir(dir):
-            if re.match(r'.*\.w?arc(\.gz)?$', fn):
-                try:
-                    size += os.stat(os.path.join(dir, fn)).st_size
-                except:
-                    pass
-        return size
-
     @property
     def source(self):
+        '''job_dir status. W/ARCs and disk space are from the latest
+        snapshot of SourceSampler; marker files are checked live, as
+        they are switched from the admin page.'''
         srcdir = self.configobj['job_dir']
-        if os.path.isdir(srcdir):
-            s = os.statvfs(srcdir)
+        snap = self.sampler.snapshot
+        if snap.exists:
             r = Storage(
                 exists=True,
                 drainme=self.is_draining(),
                 finishdrain=os.path.isfile(os.path.join(srcdir, 'FINISH_DRAIN')),
                 packing=os.path.isfile(os.path.join(srcdir, 'PACKED.open')),
-                free=s.f_bfree * s.f_bsize,
-                total=s.f_blocks * s.f_bsize,
-                warcs=self.count_warcs(srcdir),
-                warcs_size=self.warcs_size(srcdir)
+                free=snap.free,
+                total=snap.total,
+                warcs=snap.warcs,
+                warcs_size=snap.warcs_size,
+                fill_rate=snap.fill_rate,
+                sampled=snap.time
                 )
             return r
         else:
             return Storage(exists=False, drainme=False, finishdrain=False,
                            free=0, avail=0)
 
-    def uploads(self):
-        '''return upload serieses'''
-        serieses = []
-        xferdir = self.configobj['xfer_dir']
-        if os.path.isdir(xferdir):
-            for e in os.listdir(xferdir):
-                p = os.path.join(xferdir, e)
-                if os.path.isdir(p):
-                    s = Series(xferdir, e)
-                    serieses.append(s)
-        return sorted(serieses, key=lambda a: a.mtime,
-                      reverse=True)
+    def cached_series(self, state):
+        '''Series for SeriesState state, from cache if its snapshot is
+        current'''
+        s = self.series_cache.get(state.name)
+        if s is None or s.mtime != state.mtime or s.xfer != self.xfer_dir:
+            s = Series(self.xfer_dir, state.name, state)
+            self.series_cache[state.name] = s
+        self.series_cache.move_to_end(state.name)
+        while len(self.series_cache) > SERIES_CACHE_SIZE:
+            self.series_cache.popitem(last=False)
+        return s
+
+    def uploads(self, status=None, limit=None, offset=0):
+        '''yield upload serieses, most recently updated first. status
+        is one of seriesindex.STATUS_FILTERS keys, or None for all.'''
+        for st in self.index.iter(status, limit, offset):
+            yield self.cached_series(st)
 
     def get_series(self, name):
         '''return specific series by its name'''
-        # TODO should cache Series objects
-        xferdir = self.configobj['xfer_dir']
-        serdir = os.path.join(xferdir, name)
-        return Series(xferdir, name) if os.path.isdir(serdir) else None
+        if os.path.dirname(name) or name.startswith('.'):
+            return None
+        st = self.index.get(name)
+        return self.cached_series(st) if st else None
 
     def start_packwarcs(self):
-        outfile = NamedTemporaryFile(prefix='packwarcs', delete=False)
+        outfile = NamedTemporaryFile(mode='w', prefix='packwarcs',
+                                     delete=False)
         p = self.run_step('pack', outf=outfile)
-        rec = Storage(p=p, o=outfile, st=datetime.now(), cmdline=args)
+        rec = Storage(p=p, o=outfile, st=datetime.now(),
+                      cmdline=['pack', self.config_fname])
         self.processes.append(rec)
         return rec
 
     def start_launchtransfers(self, mode='single'):
-        outfile = NamedTemporaryFile(prefix='launchtransfers', delete=False)
+        outfile = NamedTemporaryFile(mode='w', prefix='launchtransfers',
+                                     delete=False)
         p = self.run_step('ingest', outf=outfile)
-        rec = Storage(p=p, o=outfile, st=datetime.now(), cmdline=args)
+        rec = Storage(p=p, o=outfile, st=datetime.now(),
+                      cmdline=['ingest', self.config_fname])
         self.processes.append(rec)
         return rec
 
@@ -339,16 +435,100 @@ class Project(object):
         'clean': 'delete-verified-warcs.sh %(xfer_dir)s 1'
         }
 
+    # steps run in-process, without spawning STEP_COMMAND.
+    # value is the name of a method taking output stream and returning
+    # exit status.
+    STEP_FUNCTION = {
+        'pack': 'pack_step',
+        'manifest': 'manifest_step',
+        'ingest': 'ingest_step',
+        'clean': 'clean_step',
+        }
+
+    def pack_step(self, out):
+        # gzip container is checked by manifest_step, in the same pass
+        # as md5 computation.
+        return packwarcs.main(self.configobj, force=True, mode='single',
+                              out=out, check_gzip=False)
+
+    def manifest_step(self, out):
+        return manifest.main(self.configobj, mode='single', out=out)
+
+    def ingest_step(self, out):
+        # uploads all series ready, upload_series of them at a time
+        return s3upload.main(self.configobj, mode='all', out=out,
+                             stats=self.upload_stats,
+                             window=self.upload_window)
+
+    def clean_step(self, out):
+        return cleanwarcs.main(self.xfer_dir, out=out)
+
     def start_drain_job(self):
-        for step in ('pack', 'manifest', 'ingest', 'clean'):
-            p = self.run_step(step)
-            returncode = p.wait()
-            if returncode != 0:
-                print(('ERROR step %s failed with returncode %d' %
-                     (step, returncode)), file=sys.stderr)
-                continue
+        '''run drain steps as a pipeline (see pipeline.py), with
+        before/on hooks of each step.'''
+        sys.stdout.flush()
+        returncode = pipeline.main(self.configobj, out=sys.stdout,
+                                   run_hook=self.run_hook,
+                                   retries=self.retries, index=self.index,
+                                   stats=self.upload_stats,
+                                   window=self.upload_window)
+        if returncode != 0:
+            print('ERROR drain pipeline failed with returncode %d' %
+                  returncode, file=sys.stderr)
+        return returncode
+
+    def start_retry_job(self):
+        '''upload series due for retry, without packing or scanning
+        xfer_dir.'''
+        due = self.retries.due()
+        if not due:
+            return 0
+        sys.stdout.flush()
+        returncode = pipeline.main(self.configobj, out=sys.stdout,
+                                   run_hook=self.run_hook,
+                                   retries=self.retries, retry=due,
+                                   index=self.index,
+                                   stats=self.upload_stats,
+                                   window=self.upload_window)
+        if returncode != 0:
+            print('ERROR retry pipeline failed with returncode %d' %
+                  returncode, file=sys.stderr)
+        return returncode
+
+    def update_retries(self):
+        '''load RetrySchedule of xfer_dir, if not yet (or xfer_dir has
+        changed)'''
+        if self.retries is None or \
+                self.retries.xfer_dir != self.xfer_dir:
+            self.retries = retrysched.RetrySchedule(self.xfer_dir)
+
+    def retryasap(self, series):
+        '''retry upload of series right away. RETRY is rewritten for
+        the next run, and the series is rescheduled in RetrySchedule,
+        which does not read RETRY again.'''
+        r = series.retryasap()
+        if r.get('ok') and self.retries is not None:
+            self.retries.schedule(series.path, 0)
+            self.wakeup()
+        return r
+
+    def sleep_timeout(self, sleep_time):
+        '''returns (timeout, retry): seconds until sleep_time or the
+        earliest retry deadline, and True if the latter comes first.
+        retries are not waited for while not draining, as nothing
+        uploads them. sleep for retry is at least MIN_RETRY_SLEEP.'''
+        deadline = None
+        if self.retries is not None and self.is_draining():
+            deadline = self.retries.next_deadline()
+        if deadline is not None:
+            remaining = max(MIN_RETRY_SLEEP, deadline - time.time())
+            if remaining < sleep_time:
+                return remaining, True
+        return sleep_time, False
 
     def run_step(self, step, outf=None):
+        if step in self.STEP_FUNCTION:
+            return self.run_step_inprocess(step, outf)
         cmd = self.STEP_COMMAND[step]
         if not cmd.startswith('/'):
             cmd = self.manager.home + '/' + cmd
@@ -366,6 +546,66 @@ class Project(object):
                              stderr=(outf or sys.stderr))
         return p
 
+    def run_hook(self, step, hook, out):
+        cmd = self.configobj[hook+step]
+        if not cmd:
+            return 0
+        cmd = cmd % self.configobj
+        print("%s: %s" % (hook+step, cmd), file=sys.stderr)
+        out.flush()
+        return subprocess.call(cmd, shell=True, cwd=self.manager.home,
+                               stdout=out, stderr=out)
+
+    def run_step_inprocess(self, step, outf=None):
+        '''run step in a thread, along with before/on hooks (as
+        separate shell commands). returns StepThread.'''
+        func = getattr(self, self.STEP_FUNCTION[step])
+        def runstep(out):
+            rc = self.run_hook(step, 'before', out)
+            if rc != 0:
+                return rc
+            rc = func(out)
+            if rc != 0:
+                return rc
+            return self.run_hook(step, 'on', out)
+        print("%s: in-process" % (step,), file=sys.stderr)
+        p = StepThread(step, runstep, outf or sys.stdout)
+        p.start()
+        return p
+
+    def update_watcher(self):
+        '''start or stop inotify watcher of job_dir, as configured'''
+        job_dir = self.configobj['job_dir']
+        w = self.watcher
+        if w and (not self.configobj['inotify'] or w.job_dir != job_dir or
+                  not w.is_alive()):
+            w.stop()
+            w = self.watcher = None
+        if not self.configobj['inotify'] or not os.path.isdir(job_dir):
+            return
+        max_size = int(self.configobj['max_size'] * 1024**3)
+        if w:
+            w.max_size = max_size
+            return
+        try:
+            self.watcher = inotify.JobDirWatcher(job_dir, max_size,
+                                                 self.wakeup)
+            self.watcher.start()
+        except OSError as ex:
+            print('inotify watcher not started for %s: %s' % (
+                    job_dir, ex), file=sys.stderr)
+
+    def sleep_until_wakeup(self, timeout):
+        '''sleep for timeout seconds. returns True if woken up.'''
+        self.next_wakeup = time.time() + timeout
+        woken = self.wakeup_event.wait(timeout)
+        self.wakeup_event.clear()
+        self.next_wakeup = None
+        return woken
+
+    def wakeup(self):
+        self.wakeup_event.set()
+
     def get_dtprocesses(self):
         excludes = [pinfo.p.pid for pinfo in self.processes]
         result = getdtprocesses(self.config_fname, excludes)
@@ -393,10 +633,14 @@ class Project(object):
 # to be contained within iaupldr module
 class UpLoader:
 
-    def __init__(self, configs, sleep=None, home=None, prefix=''):
-        """ initialize configuration """
+    def __init__(self, configs, sleep=None, home=None, prefix='',
+                 upload_rate=None):
+        """ initialize configuration. upload_rate is limit of total
+        upload bandwidth of all projects in bytes/s, None for no
+        limit. """
         self.name = os.path.basename(__file__)
         self.sleep = sleep
+        self.set_upload_rate(upload_rate)
         self.home = home
         if self.home is None:
             self.home = os.path.dirname(__file__)
@@ -410,40 +654,93 @@ class UpLoader:
                          in enumerate(configs)]
         #self.init_config(fname)
         for pj in self.projects:
-            pj.loadconfig()
+            try:
+                pj.loadconfig()
+            except ValueError as ex:
+                print('Aborting: %s' % ex, file=sys.stderr)
+                sys.exit(1)
+
+    @property
+    def upload_rate(self):
+        return httppool.limiter.rate
 
-        self.wakeupcond = threading.Condition()
+    def set_upload_rate(self, rate):
+        """ change upload bandwidth limit (bytes/s, or None), effective
+        for uploads in progress as well """
+        httppool.limiter.set_rate(rate)
 
     def __cmd(self, name):
         return os.path.join(self.home, (self.prefix or '') + name)
 
-    def run(self, once=False):
-        """ if DRAINME file exists, update config, drain job, sleep """
-        utils.echo_start(self.name)
+    def run_project(self, pj, once=False):
+        """ drain project pj periodically, sleeping for its own
+        sleep_time in between. runs in a thread of its own. sleep is
+        cut short for series due for retry, which are uploaded alone.
+        """
+        retry = False
+        # time of the next full drain, not put off by retry jobs
+        next_drain = 0
         while 1:
-            for pj in self.projects:
+            try:
                 pj.loadconfig()
-                if pj.is_draining():
-                    pj.start_drain_job()
-                else:
-                    print("DRAINME file not found: ", pj.DRAINME)
-                # old code that does not fit new multi-project support.
-                # sleep time would be removed from dtmon.cfg and smarter
-                # scheduling will be implemented. for now, sleeping for
-                # sleep_time parameter in dtmon.cfg for the project
-                # (overridden by command line option), until we start
-                # using draintasker with multiple projects.
+            except ValueError as ex:
+                # keep the thread, and try again after sleep
+                print('ERROR: %s' % ex, file=sys.stderr)
+                if once: break
                 sleep_time = self.sleep or pj.sleep
-                if not once:
-                    print("sleeping %ds" % sleep_time)
-                    sys.stdout.flush()
-                    with self.wakeupcond:
-                        self.wakeupcond.wait(timeout=sleep_time)
+                print("%s: sleeping %ds" % (pj.config_fname, sleep_time))
+                sys.stdout.flush()
+                pj.sleep_until_wakeup(sleep_time)
+                continue
+            pj.update_watcher()
+            pj.update_retries()
+            if pj.is_draining():
+                try:
+                    if retry:
+                        pj.start_retry_job()
+                    else:
+                        pj.start_drain_job()
+                except Exception:
+                    # keep draining this project next time, and others
+                    traceback.print_exc()
+            else:
+                print("DRAINME file not found: ", pj.DRAINME)
             if once: break
+            # sleep_time parameter in the project's config, overridden
+            # by command line option.
+            sleep_time = self.sleep or pj.sleep
+            if not retry:
+                next_drain = time.time() + sleep_time
+            timeout, retry = pj.sleep_timeout(
+                max(0, next_drain - time.time()))
+            if retry:
+                print("%s: sleeping %ds until retry" % (pj.config_fname,
+                                                        timeout))
+            else:
+                print("%s: sleeping %ds" % (pj.config_fname, timeout))
+            sys.stdout.flush()
+            if pj.sleep_until_wakeup(timeout):
+                retry = False
 
-    def wakeup(self):
-        with self.wakeupcond:
-            self.wakeupcond.notify()
+    def run(self, once=False):
+        """ drain each project with DRAINME file, independently of
+        each other """
+        utils.echo_start(self.name)
+        workers = []
+        for pj in self.projects:
+            t = threading.Thread(target=self.run_project, args=(pj, once),
+                                 name='project-%d' % pj.id, daemon=True)
+            t.start()
+            workers.append(t)
+        for t in workers:
+            # join with timeout so that KeyboardInterrupt is delivered
+            while t.is_alive():
+                t.join(1.0)
+
+    def wakeup(self, pj=None):
+        """ wake up project pj, or all projects, from sleep """
+        for p in ([pj] if pj else self.projects):
+            p.wakeup()
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -466,6 +763,11 @@ if __name__ == "__main__":
                    default=os.environ.get('DTMON_PREFIX', ''),
                    help='string to prepend to each sub-command '
                    '(intended for test/development aid)')
+    opt.add_option('--upload-rate', action='store', dest='upload_rate',
+                   default=None,
+                   help='limit total upload bandwidth of all projects to'
+                   ' RATE bytes/s (with optional K, M or G suffix).'
+                   ' can be changed on admin page')
     opt.add_option('-1', '--once', action='store_true', dest='once',
                    help='run each draining steps just once and exit'
                    ' this option replaces running s3-drain-jobs.sh manually',
@@ -480,7 +782,12 @@ if __name__ == "__main__":
     if os.path.isdir(configs[0]):
         opt.error('%s is a directory' % args[0])
 
-    dt = UpLoader(configs, sleep=options.interval, prefix=options.prefix)
+    try:
+        upload_rate = httppool.parse_rate(options.upload_rate)
+    except ValueError as ex:
+        opt.error(str(ex))
+    dt = UpLoader(configs, sleep=options.interval, prefix=options.prefix,
+                  upload_rate=upload_rate)
 
     signal.signal(signal.SIGUSR1, lambda sig, st: dt.wakeup())
 
@@ -0,0 +1,643 @@
+#!/usr/bin/env python3
+
+"""keep-alive HTTP client for uploads
+
+KeepAliveHTTPClient is an AsyncHTTPClient that keeps connections open
+after each request, and reuses them for following requests to the same
+host, instead of making new connection (and TLS handshake) for every
+request as SimpleAsyncHTTPClient does. host names are resolved through
+a cache, and TLS sessions are resumed when a new connection has to be
+made.
+
+connections are bound to the IOLoop they were made on. run_sync() runs
+a coroutine on an IOLoop in a background thread, that lives as long as
+the process, so that all uploads of a dtmon process share one pool of
+connections.
+
+time_info of responses has the time (in seconds) spent in each phase
+of the request:
+
+    queue     waiting for a free slot (max_clients)
+    connect   TCP connection, including DNS lookup (0 if reused)
+    tls       TLS handshake (0 if reused, or http)
+    continue  from request headers sent to 100 Continue (or
+              EXPECT_TIMEOUT), i.e. before request body is sent
+    send      sending request body
+    response  from request body sent to response headers, i.e. time
+              to first byte of response
+    recv      reading response body
+    total     all of the above
+
+limiter is a BandwidthLimiter shared by all uploads in the process.
+s3upload.py passes each buffer of request body through it before
+writing it to the connection.
+"""
+
+import sys, os, re
+libdir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'lib'))
+if libdir not in sys.path:
+    sys.path.append(libdir)
+import asyncio
+import copy
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+from datetime import timedelta
+from io import BytesIO
+
+from tornado import gen, httputil, locks, version
+from tornado.httpclient import AsyncHTTPClient, HTTPResponse
+from tornado.ioloop import IOLoop
+from tornado.iostream import SSLIOStream, StreamClosedError
+from tornado.netutil import Resolver, DefaultExecutorResolver
+from tornado.simple_httpclient import HTTPTimeoutError, HTTPStreamClosedError
+from tornado.tcpclient import TCPClient
+
+# seconds to keep resolved addresses
+DNS_TTL = 300
+# seconds to keep idle connection. should be shorter than server's
+# keep-alive timeout.
+IDLE_TIMEOUT = 30
+# idle connections kept per host
+MAX_IDLE = 16
+# seconds to wait for 100 Continue before sending body anyway (as curl)
+EXPECT_TIMEOUT = 1.0
+# seconds without any byte sent or received before request fails. long
+# enough for IAS3 to store large file before responding.
+STALL_TIMEOUT = 600
+
+MAX_HEADER_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+# seconds worth of rate BandwidthLimiter lets through at once after idle
+BURST_SECONDS = 1.0
+
+def parse_rate(v):
+    """bytes/s from v, an integer optionally followed by K, M or G
+    (powers of 1024). None (no limit) for 0, empty or None."""
+    if v is None or str(v).strip() == '':
+        return None
+    m = re.match(r'\s*(\d+(?:\.\d*)?)\s*([kmg]?)b?\s*$', str(v), re.I)
+    if not m:
+        raise ValueError('invalid rate: %r' % v)
+    rate = float(m.group(1)) * 1024**' kmg'.index(m.group(2).lower() or ' ')
+    return int(rate) or None
+
+class BandwidthLimiter(object):
+    """token bucket limiting total rate (bytes/s) of data passed through
+    consume(). tokens are kept as the time the bucket will have
+    refilled (GCRA), so consume() is a few arithmetic operations, and
+    a sleep only when over the rate. rate can be changed at any time,
+    from any thread; None means no limit."""
+    def __init__(self, rate=None, burst=BURST_SECONDS):
+        self.rate = rate
+        self.burst = burst
+        # IOLoop time when all data consumed so far is paid for
+        self.paid_until = 0.0
+        # for admin page: bytes consumed and seconds spent waiting
+        self.bytes = 0
+        self.waited = 0.0
+
+    def set_rate(self, rate):
+        self.rate = rate or None
+
+    async def consume(self, n):
+        """wait until n bytes may be sent"""
+        self.bytes += n
+        rate = self.rate
+        if not rate:
+            return
+        now = IOLoop.current().time()
+        # up to burst seconds of unused rate is credited
+        start = max(self.paid_until, now - self.burst)
+        self.paid_until = start + float(n) / rate
+        delay = self.paid_until - now
+        if delay > 0:
+            self.waited += delay
+            await gen.sleep(delay)
+
+# limiter of all upload bodies in the process
+limiter = BandwidthLimiter()
+
+class CachingResolver(Resolver):
+    """Resolver caching results of another resolver for ttl seconds"""
+    def initialize(self, resolver=None, ttl=DNS_TTL):
+        self.resolver = resolver or DefaultExecutorResolver()
+        self.ttl = ttl
+        self.cache = {}
+        self.lookups = 0
+        self.hits = 0
+
+    async def resolve(self, host, port, family=socket.AF_UNSPEC):
+        key = (host, port, family)
+        now = time.time()
+        cached = self.cache.get(key)
+        if cached and cached[0] > now:
+            self.hits += 1
+            return cached[1]
+        self.lookups += 1
+        addrs = await self.resolver.resolve(host, port, family)
+        self.cache[key] = (now + self.ttl, addrs)
+        return addrs
+
+    def close(self):
+        self.resolver.close()
+
+class Connection(object):
+    """connection to (scheme, host, port) key. connect_time and
+    tls_time are seconds it took to open it."""
+    def __init__(self, key, stream, connect_time=0.0, tls_time=0.0):
+        self.key = key
+        self.stream = stream
+        self.requests = 0
+        self.idle_since = None
+        self.connect_time = connect_time
+        self.tls_time = tls_time
+
+class ConnectionPool(object):
+    """idle connections by (scheme, host, port), and TLS sessions by
+    (host, port)."""
+    def __init__(self, resolver=None, idle_timeout=IDLE_TIMEOUT,
+                 max_idle=MAX_IDLE):
+        self.resolver = resolver or CachingResolver()
+        self.tcp_client = TCPClient(resolver=self.resolver)
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.sessions = {}
+        self.ssl_contexts = {}
+        self.counts = dict(requests=0, opened=0, reused=0,
+                           tls_handshakes=0, tls_resumed=0)
+
+    @property
+    def stats(self):
+        stats = dict(self.counts)
+        stats['idle'] = sum(len(l) for l in self.idle.values())
+        stats['dns_lookups'] = getattr(self.resolver, 'lookups', 0)
+        stats['dns_cached'] = getattr(self.resolver, 'hits', 0)
+        return stats
+
+    def summary(self):
+        return ("%(requests)d requests, %(opened)d connections opened,"
+                " %(reused)d reused, %(idle)d idle;"
+                " TLS %(tls_resumed)d of %(tls_handshakes)d resumed;"
+                " DNS %(dns_lookups)d lookups, %(dns_cached)d cached" %
+                self.stats)
+
+    def ssl_context(self, validate_cert):
+        ctx = self.ssl_contexts.get(validate_cert)
+        if ctx is None:
+            ctx = ssl.create_default_context()
+            if not validate_cert:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            self.ssl_contexts[validate_cert] = ctx
+        return ctx
+
+    def take_idle(self, key):
+        """most recently used idle connection for key, or None"""
+        conns = self.idle.get(key)
+        now = time.time()
+        while conns:
+            conn = conns.pop()
+            conn.stream.set_close_callback(None)
+            if conn.stream.closed():
+                continue
+            if now - conn.idle_since > self.idle_timeout:
+                conn.stream.close()
+                continue
+            return conn
+        return None
+
+    async def connect(self, scheme, host, port, timeout=None,
+                      validate_cert=True, max_buffer_size=None, fresh=False):
+        """idle connection to (scheme, host, port), or a new one. with
+        fresh=True, always a new one."""
+        key = (scheme, host, port)
+        conn = None if fresh else self.take_idle(key)
+        if conn:
+            self.counts['reused'] += 1
+            return conn
+        io_loop = IOLoop.current()
+        start = io_loop.time()
+        stream = await self.tcp_client.connect(
+            host, port, timeout=timeout or None,
+            max_buffer_size=max_buffer_size)
+        connected = io_loop.time()
+        tls_time = 0.0
+        if scheme == 'https':
+            handshake = self.start_tls(stream, host, port,
+                                       self.ssl_context(validate_cert))
+            try:
+                if timeout:
+                    handshake = gen.with_timeout(timedelta(seconds=timeout),
+                                                 handshake)
+                stream = await handshake
+            except gen.TimeoutError:
+                stream.close()
+                raise HTTPTimeoutError("while connecting")
+            tls_time = io_loop.time() - connected
+        self.counts['opened'] += 1
+        return Connection(key, stream, connected - start, tls_time)
+
+    async def start_tls(self, stream, host, port, context):
+        """IOStream.start_tls with TLS session resumption"""
+        sock = stream.socket
+        stream.io_loop.remove_handler(sock)
+        stream.socket = None
+        sock = context.wrap_socket(sock, server_hostname=host,
+                                   do_handshake_on_connect=False,
+                                   session=self.sessions.get((host, port)))
+        ssl_stream = SSLIOStream(sock, ssl_options=context,
+                                 max_buffer_size=stream.max_buffer_size)
+        await ssl_stream.wait_for_handshake()
+        self.counts['tls_handshakes'] += 1
+        if sock.session_reused:
+            self.counts['tls_resumed'] += 1
+        return ssl_stream
+
+    def release(self, conn, reusable):
+        """put conn back in the pool if reusable, otherwise close it"""
+        stream = conn.stream
+        if not reusable or stream.closed():
+            stream.close()
+            return
+        if isinstance(stream, SSLIOStream) and stream.socket.session:
+            # TLS 1.3 session ticket comes after handshake
+            self.sessions[conn.key[1:]] = stream.socket.session
+        conns = self.idle.setdefault(conn.key, [])
+        if len(conns) >= self.max_idle:
+            stream.close()
+            return
+        conn.idle_since = time.time()
+        stream.set_close_callback(lambda: self.discard(conn))
+        conns.append(conn)
+
+    def discard(self, conn):
+        conns = self.idle.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+
+    def close(self):
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.stream.set_close_callback(None)
+                conn.stream.close()
+        self.idle.clear()
+
+class Exchange(object):
+    """one request and response on a connection"""
+    def __init__(self, request, conn, reused=False):
+        self.request = request
+        self.stream = conn.stream
+        # time to open connection is counted for its first request
+        self.connect_time = 0.0 if reused else conn.connect_time
+        self.tls_time = 0.0 if reused else conn.tls_time
+        self.code = None
+        self.reason = None
+        self.headers = None
+        self.version = None
+        self.chunks = []
+        self.body_sent = False
+        self.keep_alive = True
+        # IOLoop time at start, body_start, body_end, headers and end
+        self.times = {}
+        # IOLoop time of the last byte sent or received
+        self.last_activity = IOLoop.current().time()
+
+    def mark(self, name):
+        self.times[name] = self.last_activity = IOLoop.current().time()
+
+    def touch(self):
+        self.last_activity = IOLoop.current().time()
+
+    @property
+    def time_info(self):
+        """time spent in each phase (see module docstring)"""
+        t = self.times
+        start = t['start']
+        headers = t.get('headers', start)
+        body_start = t.get('body_start', headers)
+        body_end = t.get('body_end', body_start)
+        end = t.get('end', headers)
+        return {'continue': body_start - start,
+                'send': body_end - body_start,
+                'response': headers - body_end,
+                'recv': end - headers}
+
+    def write_headers(self, path, headers):
+        lines = ['%s %s HTTP/1.1' % (self.request.method, path)]
+        lines.extend('%s: %s' % (k, v) for k, v in headers.get_all())
+        self.chunked = (self.request.body_producer is not None and
+                        'Content-Length' not in headers)
+        self.stream.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+
+    async def write_body(self):
+        self.mark('body_start')
+        if self.request.body is not None:
+            await self.stream.write(self.request.body)
+        elif self.request.body_producer is not None:
+            def write(chunk):
+                self.touch()
+                if self.chunked:
+                    chunk = b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                fut = self.stream.write(chunk)
+                fut.add_done_callback(lambda f: self.touch())
+                return fut
+            fut = self.request.body_producer(write)
+            if fut is not None:
+                await fut
+            if self.chunked:
+                await self.stream.write(b'0\r\n\r\n')
+        self.mark('body_end')
+        self.body_sent = True
+
+    async def read_headers(self, header_future=None):
+        """read response headers, skipping 1xx responses. sends request
+        body on 100 Continue."""
+        while True:
+            data = await (header_future or self.stream.read_until_regex(
+                    b'\r?\n\r?\n', max_bytes=MAX_HEADER_SIZE))
+            header_future = None
+            self.touch()
+            start_line, _, rest = data.decode('latin1').lstrip(
+                '\r\n').partition('\n')
+            first = httputil.parse_response_start_line(start_line)
+            headers = httputil.HTTPHeaders.parse(rest)
+            if 100 <= first.code < 200:
+                if first.code == 100 and not self.body_sent:
+                    await self.write_body()
+                continue
+            self.version, self.code, self.reason = first
+            self.headers = headers
+            self.mark('headers')
+            if self.request.header_callback is not None:
+                self.request.header_callback('%s\r\n' % start_line.rstrip())
+                for k, v in headers.get_all():
+                    self.request.header_callback('%s: %s\r\n' % (k, v))
+                self.request.header_callback('\r\n')
+            return
+
+    def data_received(self, chunk):
+        self.touch()
+        if self.request.streaming_callback is not None:
+            self.request.streaming_callback(chunk)
+        else:
+            self.chunks.append(chunk)
+
+    async def read_body(self):
+        headers = self.headers
+        if self.request.method == 'HEAD' or self.code in (204, 304):
+            return
+        if 'Content-Length' in headers:
+            remaining = int(headers['Content-Length'].split(',')[0])
+            while remaining > 0:
+                chunk = await self.stream.read_bytes(
+                    min(CHUNK_SIZE, remaining), partial=True)
+                remaining -= len(chunk)
+                self.data_received(chunk)
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                line = await self.stream.read_until(b'\r\n', 1024)
+                size = int(line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # trailer
+                    while (await self.stream.read_until(
+                            b'\r\n', MAX_HEADER_SIZE)) != b'\r\n':
+                        pass
+                    break
+                while size > 0:
+                    chunk = await self.stream.read_bytes(
+                        min(CHUNK_SIZE, size), partial=True)
+                    size -= len(chunk)
+                    self.data_received(chunk)
+                await self.stream.read_bytes(2)
+        else:
+            self.keep_alive = False
+            self.data_received(await self.stream.read_until_close())
+
+    async def run(self, path, headers):
+        self.mark('start')
+        self.write_headers(path, headers)
+        header_future = None
+        if self.request.expect_100_continue:
+            header_future = self.stream.read_until_regex(
+                b'\r?\n\r?\n', max_bytes=MAX_HEADER_SIZE)
+            try:
+                await gen.with_timeout(timedelta(seconds=EXPECT_TIMEOUT),
+                                       header_future)
+            except gen.TimeoutError:
+                await self.write_body()
+        else:
+            await self.write_body()
+        await self.read_headers(header_future)
+        await self.read_body()
+        self.mark('end')
+        if self.headers.get('Connection', '').lower() == 'close' or \
+                self.version != 'HTTP/1.1':
+            self.keep_alive = False
+        # if server responded without reading body, the rest of request
+        # would be taken for next request.
+        if not self.body_sent:
+            self.keep_alive = False
+
+class KeepAliveHTTPClient(AsyncHTTPClient):
+    """AsyncHTTPClient reusing connections of a ConnectionPool.
+    supports the subset of HTTPRequest options used by draintasker:
+    body, body_producer, expect_100_continue, connect_timeout,
+    request_timeout, follow_redirects, streaming_callback,
+    header_callback and validate_cert.
+
+    as AsyncHTTPClient, there is one instance per IOLoop (unless
+    force_instance). max_clients of the instance is raised to the
+    largest asked for. requests fail with HTTPTimeoutError if no byte is
+    sent or received for stall_timeout seconds (on top of
+    request_timeout, if any).
+    """
+    def __new__(cls, force_instance=False, **kwargs):
+        client = super().__new__(cls, force_instance=force_instance,
+                                 **kwargs)
+        max_clients = kwargs.get('max_clients')
+        if max_clients is not None and max_clients > client.max_clients:
+            client.set_max_clients(max_clients)
+        return client
+
+    def initialize(self, defaults=None, max_clients=10, pool=None,
+                   max_buffer_size=104857600, stall_timeout=STALL_TIMEOUT):
+        super().initialize(defaults=defaults)
+        self.pool = pool or ConnectionPool()
+        self.max_clients = max_clients
+        self.slots = locks.Semaphore(max_clients)
+        self.max_buffer_size = max_buffer_size
+        self.stall_timeout = stall_timeout
+
+    def set_max_clients(self, max_clients):
+        """raise limit of concurrent requests to max_clients"""
+        for i in range(max_clients - self.max_clients):
+            self.slots.release()
+        self.max_clients = max_clients
+
+    def close(self):
+        self.pool.close()
+        super().close()
+
+    def fetch_impl(self, request, callback):
+        IOLoop.current().add_future(
+            gen.convert_yielded(self.fetch_one(request)),
+            lambda f: callback(f.result()))
+
+    async def fetch_one(self, request):
+        io_loop = IOLoop.current()
+        start_time = io_loop.time()
+        start_wall_time = time.time()
+        time_info = {}
+        try:
+            async with self.slots:
+                time_info['queue'] = io_loop.time() - start_time
+                ex = await self.send(request)
+        except Exception as e:
+            time_info['total'] = io_loop.time() - start_time
+            return HTTPResponse(request, 599, error=e,
+                                request_time=time_info['total'],
+                                start_time=start_wall_time,
+                                time_info=time_info)
+        if request.follow_redirects and request.max_redirects > 0 and \
+                ex.code in (301, 302, 303, 307, 308) and \
+                'Location' in ex.headers:
+            new_request = copy.copy(request.request)
+            new_request.url = urllib.parse.urljoin(request.url,
+                                                   ex.headers['Location'])
+            new_request.max_redirects = request.max_redirects - 1
+            new_request.headers = httputil.HTTPHeaders(request.headers)
+            if 'Host' in new_request.headers:
+                del new_request.headers['Host']
+            # credentials are not given away to other hosts
+            if urllib.parse.urlsplit(new_request.url).netloc != \
+                    urllib.parse.urlsplit(request.url).netloc and \
+                    'Authorization' in new_request.headers:
+                del new_request.headers['Authorization']
+            if ex.code == 303 and request.method != 'HEAD':
+                new_request.method = 'GET'
+                new_request.body = None
+            return await self.fetch(new_request, raise_error=False)
+        time_info.update(ex.time_info, connect=ex.connect_time,
+                         tls=ex.tls_time,
+                         total=io_loop.time() - start_time)
+        return HTTPResponse(request, ex.code, reason=ex.reason,
+                            headers=ex.headers,
+                            buffer=BytesIO(b''.join(ex.chunks)),
+                            effective_url=request.url,
+                            request_time=time_info['total'],
+                            start_time=start_wall_time,
+                            time_info=time_info)
+
+    def request_headers(self, request, netloc):
+        headers = httputil.HTTPHeaders(request.headers)
+        if 'Host' not in headers:
+            headers['Host'] = netloc
+        if 'User-Agent' not in headers:
+            headers['User-Agent'] = request.user_agent or \
+                'Tornado/%s' % version
+        if request.body is not None:
+            headers['Content-Length'] = str(len(request.body))
+        elif request.body_producer is None:
+            if request.method in ('POST', 'PUT', 'PATCH'):
+                headers['Content-Length'] = '0'
+        elif 'Content-Length' not in headers:
+            headers['Transfer-Encoding'] = 'chunked'
+        if request.expect_100_continue:
+            headers['Expect'] = '100-continue'
+        return headers
+
+    async def send(self, request):
+        """send request on pooled connection. request is retried once
+        on a fresh connection if reused one turns out to be closed by
+        server before responding."""
+        parsed = urllib.parse.urlsplit(request.url)
+        if parsed.scheme not in ('http', 'https'):
+            raise ValueError("Unsupported url scheme: %s" % request.url)
+        host, port = httputil.split_host_and_port(parsed.netloc)
+        if port is None:
+            port = 443 if parsed.scheme == 'https' else 80
+        if re.match(r'^\[.*\]$', host):
+            host = host[1:-1]
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query
+                                       else '')
+        headers = self.request_headers(request, parsed.netloc)
+        io_loop = IOLoop.current()
+        fresh = False
+        while True:
+            conn = await self.pool.connect(
+                parsed.scheme, host, port, timeout=request.connect_timeout,
+                validate_cert=request.validate_cert,
+                max_buffer_size=self.max_buffer_size, fresh=fresh)
+            reused = conn.requests > 0
+            conn.requests += 1
+            self.pool.counts['requests'] += 1
+            ex = Exchange(request, conn, reused)
+            timeouts = []
+            timed_out = []
+            def expire(reason):
+                timed_out.append(reason)
+                conn.stream.close()
+            def check_stall():
+                idle = io_loop.time() - ex.last_activity
+                if idle >= self.stall_timeout:
+                    expire("stalled for %.1fs" % idle)
+                else:
+                    timeouts.append(io_loop.call_later(
+                        self.stall_timeout - idle, check_stall))
+            if request.request_timeout:
+                timeouts.append(io_loop.call_later(
+                    request.request_timeout, expire, "during request"))
+            if self.stall_timeout:
+                timeouts.append(io_loop.call_later(self.stall_timeout,
+                                                   check_stall))
+            try:
+                await ex.run(path, headers)
+            except StreamClosedError as e:
+                self.pool.release(conn, False)
+                if timed_out:
+                    raise HTTPTimeoutError(timed_out[0])
+                if reused and ex.code is None and \
+                        request.streaming_callback is None:
+                    # other idle connections may be stale as well
+                    fresh = True
+                    continue
+                raise HTTPStreamClosedError(
+                    str(e.real_error or "Stream closed"))
+            except BaseException:
+                self.pool.release(conn, False)
+                raise
+            finally:
+                for timeout in timeouts:
+                    io_loop.remove_timeout(timeout)
+            self.pool.release(conn, ex.keep_alive)
+            return ex
+
+# IOLoop shared by the process
+_loop = None
+_loop_lock = threading.Lock()
+
+def shared_loop():
+    """IOLoop running in a daemon thread, started at first call"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            ready = threading.Event()
+            def run():
+                global _loop
+                asyncio.set_event_loop(asyncio.new_event_loop())
+                _loop = IOLoop.current()
+                ready.set()
+                _loop.start()
+            threading.Thread(target=run, name='httppool', daemon=True).start()
+            ready.wait()
+        return _loop
+
+def run_sync(coro):
+    """run coroutine on shared IOLoop, and return its result. may be
+    called from any thread but the shared IOLoop's."""
+    loop = shared_loop()
+    return asyncio.run_coroutine_threadsafe(coro, loop.asyncio_loop).result()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""watch job_dir with inotify(7), through ctypes
+Usage: inotify.py config
+    config  a YAML config file
+
+JobDirWatcher keeps track of the total size of closed W/ARC files in
+job_dir: files are counted when they are closed after writing or
+renamed into job_dir (as *.open files are by Heritrix), and dropped
+when they are moved out (by packing) or deleted. it calls back as soon
+as max_size worth of W/ARCs is ready, and when DRAINME or FINISH_DRAIN
+is created. dtmon.py uses it for waking up project before sleep_time
+runs out, if inotify config parameter is 1. periodic polling goes on as
+before, so that nothing is missed if watching fails.
+"""
+
+import sys, os, re
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import threading
+import time
+
+import config
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+WARC_RE = re.compile(r'.*\.w?arc(\.gz)?$')
+TRIGGER_FILES = ('DRAINME', 'FINISH_DRAIN')
+
+_libc = None
+
+def libc():
+    """libc with inotify functions, or None if not available"""
+    global _libc
+    if _libc is None:
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                              use_errno=True)
+            lib.inotify_init1.argtypes = [ctypes.c_int]
+            lib.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                              ctypes.c_uint32]
+            lib.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            _libc = lib
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+def available():
+    return libc() is not None
+
+class Inotify(object):
+    """inotify instance. read() returns list of (wd, mask, cookie, name)
+    """
+    def __init__(self):
+        lib = libc()
+        if lib is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = lib.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = libc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read(self):
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = buf[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class JobDirWatcher(threading.Thread):
+    """watches job_dir, calling callback() when max_size bytes of W/ARCs
+    are ready for packing, or DRAINME or FINISH_DRAIN is created."""
+
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self, job_dir, max_size, callback, out=None):
+        threading.Thread.__init__(self, name='inotify', daemon=True)
+        self.job_dir = job_dir
+        self.max_size = max_size
+        self.callback = callback
+        self.out = out or sys.stdout
+        self.sizes = {}
+        self.fired = False
+        self.stopped = threading.Event()
+        self.inotify = Inotify()
+        self.inotify.add_watch(job_dir, self.MASK)
+        self.rescan()
+
+    def echo(self, msg):
+        print("%s: %s" % (self.job_dir, msg), file=self.out)
+
+    @property
+    def ready_size(self):
+        return sum(self.sizes.values())
+
+    def rescan(self):
+        """reset sizes from W/ARCs in job_dir"""
+        self.sizes = {}
+        try:
+            for e in os.scandir(self.job_dir):
+                if WARC_RE.match(e.name) and e.is_file():
+                    self.sizes[e.name] = e.stat().st_size
+        except OSError:
+            pass
+
+    def add(self, name):
+        try:
+            self.sizes[name] = os.stat(
+                os.path.join(self.job_dir, name)).st_size
+        except OSError:
+            self.sizes.pop(name, None)
+
+    def handle(self, events):
+        """update sizes with events. returns reason for callback, or
+        None."""
+        reason = None
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.rescan()
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self.echo("job_dir is gone, stop watching")
+                self.stopped.set()
+                continue
+            if mask & IN_ISDIR:
+                continue
+            if name in TRIGGER_FILES and \
+                    mask & (IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE):
+                reason = name
+            elif WARC_RE.match(name):
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.add(name)
+                elif mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.sizes.pop(name, None)
+        ready = self.ready_size
+        if ready < self.max_size:
+            self.fired = False
+        elif not self.fired:
+            self.fired = True
+            reason = reason or '%d bytes of W/ARCs' % ready
+        return reason
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.inotify.fileno(), select.POLLIN)
+        try:
+            while not self.stopped.is_set():
+                if not poller.poll(1000):
+                    continue
+                reason = self.handle(self.inotify.read())
+                if reason:
+                    self.echo("wakeup: %s" % reason)
+                    self.callback()
+        finally:
+            self.inotify.close()
+
+    def stop(self):
+        self.stopped.set()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    w = JobDirWatcher(conf['job_dir'], int(conf['max_size'] * 1024**3),
+                      lambda: print(time.strftime('%c'), "ready"))
+    w.start()
+    try:
+        while w.is_alive():
+            w.join(1.0)
+    except KeyboardInterrupt:
+        w.stop()
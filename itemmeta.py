@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""item metadata headers of a series
+Usage: itemmeta.py config series_dir
+    config      a YAML config file
+    series_dir  series directory in xfer_dir, with MANIFEST and PACKED
+
+builds x-archive-meta headers sent with item creation (auto-make-bucket)
+of a series, for s3upload.py and s3-launch-transfers.sh: date range
+from W/ARC names and mtime of the last W/ARC, description with
+CRAWLHOST, CRAWLJOB, START_DATE and END_DATE substituted, crawler
+software from warcinfo record and collections, in the same order and
+format as s3-launch-transfers.sh has always sent them. dates are
+formatted as date(1) does, in local time.
+
+warcinfo is read from the first gzip member of the first W/ARC only,
+which holds the warcinfo record, instead of decompressing the file
+until the next record.
+
+prints headers, one per line: metadata headers first, then collection
+headers (x-archive-metaNN-collection).
+"""
+
+import sys, os, re
+import functools
+import time
+import zlib
+
+import config
+from packwarcs import WarcNaming
+
+# at most this many bytes of warcinfo are read for software
+WARCINFO_MAX = 1024 * 1024
+# read size for W/ARC files
+READ_SIZE = 64 * 1024
+
+# date formats of date(1) used by s3-launch-transfers.sh. empty for
+# None, as date(1) prints nothing for invalid date.
+def format_date_hr(t):
+    if t is None: return ''
+    return time.strftime('%a %b %e %H:%M:%S %Z %Y', time.localtime(t))
+def format_date_iso(t):
+    if t is None: return ''
+    return time.strftime('%Y-%m-%dT%H:%M:%S%Z', time.localtime(t))
+
+def parse_timestamp(ts):
+    """epoch time of (at least 14 digits) WARC timestamp, as local time.
+    None if ts is not a valid timestamp."""
+    try:
+        return time.mktime(time.strptime(ts[:14], '%Y%m%d%H%M%S'))
+    except ValueError:
+        return None
+
+@functools.lru_cache(maxsize=8)
+def warc_naming(pattern):
+    return WarcNaming(pattern)
+
+def read_warcinfo(path):
+    """beginning of W/ARC file path, up to WARCINFO_MAX bytes: the first
+    gzip member if path ends with .gz. empty if unreadable."""
+    try:
+        with open(path, 'rb') as f:
+            if not path.endswith('.gz'):
+                return f.read(WARCINFO_MAX)
+            z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = []
+            size = 0
+            while not z.eof and size < WARCINFO_MAX:
+                buf = z.unconsumed_tail or f.read(READ_SIZE)
+                if not buf:
+                    break
+                chunk = z.decompress(buf, WARCINFO_MAX - size)
+                data.append(chunk)
+                size += len(chunk)
+            return b''.join(data)
+    except (OSError, zlib.error):
+        return b''
+
+def warc_software(path):
+    """value of 'software' field in the warcinfo record at the beginning
+    of W/ARC file path."""
+    software = []
+    for nr, l in enumerate(read_warcinfo(path).split(b'\n')):
+        l = l.decode('utf-8', 'replace')
+        if nr > 0 and l.startswith('WARC/'):
+            break
+        if l.startswith('software:'):
+            v = l.split()
+            if len(v) > 1:
+                software.append(v[1])
+    return '\n'.join(software)
+
+def item_metadata(conf, bucket, files, num_warcs, size_hint):
+    """list of x-archive-meta headers for item creation of bucket, same
+    as s3-launch-transfers.sh. files is a list of paths of W/ARCs to be
+    uploaded, num_warcs number of files in MANIFEST, and size_hint from
+    PACKED.
+    """
+    naming = warc_naming(conf['warc_name_pattern_upload'])
+    first = naming.parse(os.path.basename(files[0])) or {}
+    last = naming.parse(os.path.basename(files[-1])) or {}
+
+    first_file_date = first.get('timestamp', '')
+    start = parse_timestamp(first_file_date)
+    last_file_date = last.get('timestamp', '')
+    # end date from last file mtime. should (closely) correspond to
+    # time of last record in series
+    end = int(os.stat(files[-1]).st_mtime)
+    last_date = time.strftime('%Y%m%d%H%M%S', time.localtime(end))
+    date_range = '%s to %s' % (format_date_iso(start), format_date_iso(end))
+
+    description = str(conf['description'])
+    for k, v in (('CRAWLHOST', conf['crawlhost']),
+                 ('CRAWLJOB', conf['crawljob']),
+                 ('START_DATE', format_date_hr(start)),
+                 ('END_DATE', format_date_hr(end))):
+        description = description.replace(k, str(v), 1)
+    description = re.sub(r' +', ' ', description)
+
+    headers = []
+    for key, value in conf['metadata'].items():
+        if re.search(r'\s', key): continue
+        if value is None or value == '': continue
+        headers.extend(config.format_header(key, value))
+    headers.extend([
+        'x-archive-meta-identifier-access:https://archive.org/details/%s' %
+        bucket,
+        'x-archive-meta-title:%s %s' % (conf['title_prefix'], date_range),
+        'x-archive-meta-description:%s' % description,
+        'x-archive-meta-scandate:%s' % first_file_date[:14],
+        'x-archive-meta-date:%s' % first_file_date[:4],
+        'x-archive-meta-sizehint:%s' % size_hint,
+        'x-archive-meta-firstfiledate:%s' % first_file_date,
+        'x-archive-meta-lastfiledate:%s' % last_file_date,
+        'x-archive-meta-lastdate:%s' % last_date,
+        ])
+    crawler_version = warc_software(files[0])
+    if crawler_version:
+        headers.append('x-archive-meta-crawler:%s' % crawler_version)
+    if conf['crawljob']:
+        headers.append('x-archive-meta-crawljob:%s' % conf['crawljob'])
+    if num_warcs:
+        # sic - s3-launch-transfers.sh has always sent it this way
+        headers.append('x-archive.meta-numwarcs:%s' % num_warcs)
+    if first.get('serial'):
+        headers.append('x-archive-meta-firstfileserial:%s' % first['serial'])
+    if last.get('serial'):
+        headers.append('x-archive-meta-lastfileserial:%s' % last['serial'])
+    return headers
+
+def collection_headers(conf):
+    """webwidecrawl/collection/serial => collection3 = webwidecrawl,
+    collection2 = collection, collection1 = serial"""
+    colls = str(conf['collections']).replace('/', ' ').split()
+    return ['x-archive-meta%02d-collection:%s' % (len(colls) - i, c)
+            for i, c in enumerate(colls)]
+
+def read_size_hint(d):
+    """last field of the first line of PACKED in series directory d"""
+    try:
+        with open(os.path.join(d, 'PACKED')) as f:
+            return f.readline().split()[-1]
+    except (OSError, IndexError):
+        return ''
+
+def series_headers(conf, d):
+    """metadata and collection headers of series directory d, from its
+    MANIFEST and PACKED. W/ARCs not in d (uploaded and cleaned) are
+    left out, as in s3-launch-transfers.sh."""
+    with open(os.path.join(d, 'MANIFEST')) as f:
+        manifest = [l.split()[1] for l in f if len(l.split()) >= 2]
+    files = [os.path.join(d, fn) for fn in manifest
+             if os.path.isfile(os.path.join(d, fn))]
+    if not files:
+        return collection_headers(conf)
+    name = os.path.basename(os.path.normpath(d))
+    return (item_metadata(conf, name, files, len(manifest),
+                          read_size_hint(d)) +
+            collection_headers(conf))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    try:
+        headers = series_headers(conf, sys.argv[2])
+    except OSError as ex:
+        print("ERROR: %s" % ex, file=sys.stderr)
+        sys.exit(1)
+    for h in headers:
+        print(h)
@@ -44,11 +44,12 @@ if [ -n "$CONFIG" ]; then
     exit 1
   fi
 # validate configuration
-  $GETCONF $CONFIG || {
+  confvars=$($GETCONF --export-shell --prefix=conf_ $CONFIG) || {
     echo "ERROR: invalid config: $CONFIG"
     exit 1
   }
-  MD5SUM=$($GETCONF $CONFIG md5sum)
+  eval "$confvars"
+  MD5SUM=$conf_md5sum
 fi
 
 
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+"""compute md5 of W/ARCs into MANIFEST of each PACKED series
+Usage: manifest.py config [mode]
+    config  a YAML config file
+    mode    single = make manifest for 1 series, then exit
+            all = make manifests for all PACKED series (default)
+
+in-process equivalent of make-manifests.sh. each W/ARC is read just
+once: compressed bytes are fed to MD5 and, at the same time, to zlib for
+checking integrity of the gzip container (what pack-warcs.sh does with
+gzip -t). W/ARCs with bad gzip container are renamed to *.bad and left
+out of MANIFEST. as they are found after packing, PACKED is rewritten
+without them, and they are reported in ERROR of the series, which
+holds its upload until checked (retryasap from admin page resumes it).
+"""
+
+import sys, os
+import fcntl
+import hashlib
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# read size. large enough for hashlib and zlib to release the GIL
+# for most of the time.
+BUFSIZE = 1024 * 1024
+
+# default for manifest_workers config parameter
+DEFAULT_WORKERS = 4
+
+# extensions of files listed in MANIFEST (brace expansion in
+# make-manifests.sh, whose ls sorts files of all of them together)
+MANIFEST_EXTS = ('.arc', '.warc', '.arc.gz', '.warc.gz')
+
+class GzipChecker(object):
+    """incremental equivalent of gzip -t. feed compressed bytes with
+    update(), and check result with ok() at the end.
+    supports multi-member gzip files. trailing zero padding is accepted,
+    as by packwarcs.verify_gzip (gzip module), though gzip -t warns
+    about it and exits with status 2.
+    """
+    def __init__(self):
+        self.d = None
+        self.members = 0
+        self.padding = False
+        self.failed = False
+
+    def update(self, data):
+        while data and not self.failed:
+            if self.padding:
+                if data.strip(b'\0'):
+                    self.failed = True
+                return
+            if self.d is None:
+                if data[:1] == b'\0' and self.members > 0:
+                    self.padding = True
+                    continue
+                self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                # decompressed output is discarded. max_length bounds
+                # memory use for highly compressed data.
+                self.d.decompress(data, BUFSIZE)
+                while self.d.unconsumed_tail:
+                    self.d.decompress(self.d.unconsumed_tail, BUFSIZE)
+            except zlib.error:
+                self.failed = True
+                return
+            if not self.d.eof:
+                return
+            self.members += 1
+            data = self.d.unused_data
+            self.d = None
+
+    def ok(self):
+        return not self.failed and self.members > 0 and self.d is None
+
+def hash_warc(path, md5sum=True, check_gzip=True):
+    """read path once, returning (md5, gzip_ok). md5 is '-' if md5sum
+    is False. gzip_ok is None if path is not gzip-compressed or
+    check_gzip is False.
+    """
+    h = hashlib.md5() if md5sum else None
+    gz = GzipChecker() if (check_gzip and path.endswith('.gz')) else None
+    if h or gz:
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(BUFSIZE)
+                if not data: break
+                if h: h.update(data)
+                if gz: gz.update(data)
+    return (h.hexdigest() if h else '-'), (gz.ok() if gz else None)
+
+def list_warcs(series_dir):
+    """W/ARC files in series_dir, in MANIFEST order"""
+    # '.arc' must not match '.arc.gz'
+    return sorted(fn for fn in os.listdir(series_dir)
+                  if any(fn.endswith(ext) and not fn.endswith(ext + '.gz')
+                         for ext in MANIFEST_EXTS))
+
+class ManifestBuilder(object):
+    """computes MANIFEST of series with a pool of worker threads.
+    files of a series, and of multiple series, are hashed concurrently,
+    up to manifest_workers files at a time (hashlib and zlib release the
+    GIL while working on large buffers).
+    """
+    def __init__(self, conf, out=None, workers=None):
+        self.config = conf
+        self.out = out or sys.stdout
+        self.xfer_dir = conf['xfer_dir']
+        self.md5sum = conf['md5sum'] != 0
+        self.check_gzip = conf['verify_gzip'] != 0
+        self.workers = workers or conf['manifest_workers'] or \
+            DEFAULT_WORKERS
+        self.warc_count = 0
+        self.manifest_count = 0
+        self.error_count = 0
+
+    def echo(self, *args):
+        print(*args, file=self.out)
+
+    def hash_file(self, d, fn):
+        return hash_warc(os.path.join(d, fn), md5sum=self.md5sum,
+                         check_gzip=self.check_gzip)
+
+    def manifest_line(self, d, fn, md5, gzip_ok):
+        """returns MANIFEST line for file fn, or None if it has bad
+        gzip container (file is renamed to .bad).
+        """
+        path = os.path.join(d, fn)
+        if gzip_ok is False:
+            self.echo("  ERROR: bad gzip, skipping file: %s" % path)
+            self.echo("  mv %s %s.bad" % (path, path))
+            os.rename(path, path + '.bad')
+            return None
+        self.echo("  %s %s%s" % ('md5sum' if self.md5sum else 'NO md5sum',
+                                 fn, ' gz_OK' if gzip_ok else ''))
+        return '%s  %s\n' % (md5, fn)
+
+    def open_manifest(self, d):
+        """create and lock MANIFEST.open in series directory d.
+        returns open file, or None if MANIFEST is there or being made.
+        """
+        OPEN = os.path.join(d, 'MANIFEST.open')
+        if os.path.exists(os.path.join(d, 'MANIFEST')):
+            return None
+        if os.path.exists(OPEN):
+            self.echo("OPEN file exists: %s" % OPEN)
+            return None
+        w = open(OPEN, 'w')
+        try:
+            fcntl.flock(w, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            self.echo("ERROR could not lock %s" % OPEN)
+            w.close()
+            return None
+        return w
+
+    def drop_bad(self, d, bad):
+        """rewrite PACKED of series directory d without W/ARCs bad
+        (renamed to .bad), and report them in ERROR"""
+        PACKED = os.path.join(d, 'PACKED')
+        with open(PACKED) as f:
+            v = f.readline().split()
+        if len(v) == 3:
+            size = sum(os.path.getsize(os.path.join(d, fn + '.bad'))
+                       for fn in bad)
+            pack_info = '%s %d %d' % (v[0], int(v[1]) - len(bad),
+                                      int(v[2]) - size)
+            self.echo("  PACKED: %s" % pack_info)
+            with open(PACKED + '.tmp', 'w') as w:
+                w.write(pack_info + '\n')
+            os.rename(PACKED + '.tmp', PACKED)
+        with open(os.path.join(d, 'ERROR'), 'a') as w:
+            for fn in bad:
+                w.write("ERROR: bad gzip, left out of MANIFEST: %s.bad\n" %
+                        os.path.join(d, fn))
+        self.echo("  wrote ERROR: %d files with bad gzip" % len(bad))
+
+    def finish_manifest(self, d, w, futures):
+        """write hash results into MANIFEST.open w in MANIFEST order,
+        and rename it to MANIFEST. returns True on success.
+        """
+        OPEN = w.name
+        MANIFEST = os.path.join(d, 'MANIFEST')
+        self.echo("%s:" % d)
+        bad = []
+        try:
+            with w:
+                for fn, future in futures:
+                    self.warc_count += 1
+                    md5, gzip_ok = future.result()
+                    line = self.manifest_line(d, fn, md5, gzip_ok)
+                    if line:
+                        w.write(line)
+                    else:
+                        bad.append(fn)
+            if bad:
+                self.drop_bad(d, bad)
+        except OSError as ex:
+            self.echo("ERROR: md5sum failed: %s" % ex)
+            # so that it is retried next time
+            os.remove(OPEN)
+            self.error_count += 1
+            return False
+        self.echo("  mv %s %s" % (os.path.basename(OPEN),
+                                  os.path.basename(MANIFEST)))
+        os.rename(OPEN, MANIFEST)
+        self.manifest_count += 1
+        return True
+
+    def build_many(self, dirs):
+        """write MANIFEST for series directories dirs, hashing all their
+        files concurrently. returns number of MANIFESTs written.
+        """
+        count = self.manifest_count
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            jobs = []
+            try:
+                for d in dirs:
+                    w = self.open_manifest(d)
+                    if w is None:
+                        continue
+                    futures = []
+                    jobs.append((d, w, futures))
+                    futures.extend((fn, pool.submit(self.hash_file, d, fn))
+                                   for fn in list_warcs(d))
+                while jobs:
+                    d, w, futures = jobs[0]
+                    self.finish_manifest(d, w, futures)
+                    jobs.pop(0)
+            finally:
+                # MANIFEST.open of series not finished would keep them
+                # from being retried
+                for d, w, futures in jobs:
+                    for fn, future in futures:
+                        future.cancel()
+                    w.close()
+                    if os.path.exists(w.name):
+                        os.remove(w.name)
+        return self.manifest_count - count
+
+    def build(self, d):
+        """write MANIFEST for series directory d.
+        returns True if MANIFEST has been written.
+        """
+        return self.build_many([d]) > 0
+
+    def packed_series(self):
+        """series directories with PACKED, without MANIFEST"""
+        for name in sorted(os.listdir(self.xfer_dir)):
+            d = os.path.join(self.xfer_dir, name)
+            if not os.path.isdir(d):
+                continue
+            if not os.path.exists(os.path.join(d, 'PACKED')):
+                continue
+            if os.path.exists(os.path.join(d, 'MANIFEST')):
+                continue
+            yield d
+
+    def run(self, mode='single'):
+        self.echo(os.path.basename(__file__), time.strftime('%c'))
+        self.echo("  workers = %d" % self.workers)
+        if mode == 'single':
+            for d in self.packed_series():
+                if self.build(d):
+                    self.echo("mode = %s, exiting normally." % mode)
+                    break
+        else:
+            self.build_many(list(self.packed_series()))
+        self.echo("%d warcs %d manifests" % (self.warc_count,
+                                             self.manifest_count))
+        self.echo(os.path.basename(__file__), "done.", time.strftime('%c'))
+        return self.manifest_count
+
+def main(conf, mode='single', out=None):
+    """make manifests for DrainConfig conf. returns exit status."""
+    try:
+        builder = ManifestBuilder(conf, out=out)
+        builder.run(mode=mode)
+    except OSError as ex:
+        print("ERROR: %s" % ex, file=out or sys.stdout)
+        return 1
+    return 1 if builder.error_count else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    try:
+        conf.validate()
+    except ValueError as ex:
+        print("ERROR: invalid config: %s: %s" % (sys.argv[1], ex))
+        sys.exit(1)
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'all'
+    sys.exit(main(conf, mode=mode))
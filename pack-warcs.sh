@@ -111,22 +111,23 @@ fi
 echo $(basename $0) $(date)
 
 CONFIG=$1
-$BIN/config.py $CONFIG || {
+confvars=$($BIN/config.py --export-shell --prefix=conf_ $CONFIG) || {
   echo "ERROR: invalid config: $CONFIG"
   exit 1
 }
+eval "$confvars"
 force=${2:-0}
 mode=${3:-single}
 # get config parameters
-job_dir=$($BIN/config.py $CONFIG job_dir)
-xfer_home=$($BIN/config.py $CONFIG xfer_dir)
-max_GB=$($BIN/config.py $CONFIG max_size)
-compactify=$($BIN/config.py $CONFIG compact_names)
-WARC_NAME_PATTERN="$($BIN/config.py $CONFIG warc_name_pattern)"
-item_naming="$($BIN/config.py $CONFIG item_name_template)"
-ITEM_NAME_TEMPLATE="$($BIN/config.py $CONFIG item_name_template_sh)"
-verify_gzip=$($BIN/config.py $CONFIG verify_gzip)
-SUFFIX_RE=$($BIN/config.py $CONFIG suffix_re)
+job_dir=$conf_job_dir
+xfer_home=$conf_xfer_dir
+max_GB=$conf_max_size
+compactify=$conf_compact_names
+WARC_NAME_PATTERN="$conf_warc_name_pattern"
+item_naming="$conf_item_name_template"
+ITEM_NAME_TEMPLATE="$conf_item_name_template_sh"
+verify_gzip=$conf_verify_gzip
+SUFFIX_RE=$conf_suffix_re
 if [ -z "$SUFFIX_RE" ]; then
     SUFFIX_RE='\.w?arc\(\.gz\)?'
 fi
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+"""pack WARCs in job_dir into series directories in xfer_dir
+Usage: packwarcs.py config [force] [mode]
+    config  a YAML config file
+    force   1 = do not query user
+    mode    single = pack only 1 series and exit (default)
+            test = do not move files
+
+in-process equivalent of pack-warcs.sh: job_dir is scanned just once,
+WARC names are parsed with regular expressions compiled from
+warc_name_pattern, and series are planned in memory before files are
+moved with rename(2). writes the same PACKED file and picks the same
+item names as pack-warcs.sh.
+"""
+
+import sys, os, re
+import errno
+import gzip
+import shutil
+import zlib
+import time
+
+import config
+
+# default for suffix_re config parameter (Python syntax)
+DEFAULT_SUFFIX_RE = r'\.w?arc(\.gz)?'
+
+# buffer size for reading WARC content
+BUFSIZE = 1024 * 1024
+
+def emacs_to_python_re(s):
+    """translate regular expression in find(1) -regex (emacs) syntax
+    into Python syntax. in emacs syntax, parentheses, vertical bar and
+    braces are literal unless escaped.
+    """
+    return re.sub(r'\\([(){}|])|([(){}|])',
+                  lambda m: m.group(1) or '\\' + m.group(2), s)
+
+class WarcNaming(object):
+    """compiled form of WARC naming pattern like
+    ``{prefix}-{timestamp}-{serial}-{host}``.
+    """
+    def __init__(self, pattern, suffix_re=None):
+        self.pattern = pattern
+        self.fields = re.findall(r'\{([^}]*)\}', pattern)
+        literals = re.split(r'\{[^}]*\}', pattern)
+        body = '(.*)'.join(re.escape(s) for s in literals)
+        self.name_re = re.compile('^%s(%s)$' % (
+                body, suffix_re or DEFAULT_SUFFIX_RE))
+
+    def parse(self, name):
+        """decompose WARC name into a dict of fields, or return None if
+        name does not match the pattern. ``ext`` is set to suffix, and
+        ``shost`` to host name without domain part.
+        """
+        m = self.name_re.match(name)
+        if m is None:
+            return None
+        fields = dict(zip(self.fields, m.groups()))
+        fields['ext'] = m.group(len(self.fields) + 1)
+        if 'host' in fields:
+            fields['shost'] = fields['host'].split('.', 1)[0]
+        return fields
+
+    def match(self, name):
+        return self.name_re.match(name) is not None
+
+def expand_template(template, fields):
+    """substitute ``{name}`` in template with value from fields.
+    undefined fields expand to empty string, as in shell.
+    """
+    return re.sub(r'\{([A-Za-z][_0-9A-Za-z]*)\}',
+                  lambda m: fields.get(m.group(1)) or '', template)
+
+def verify_gzip(path):
+    """return True if path is an intact (possibly multi-member) gzip
+    file. equivalent of gzip -t.
+    """
+    try:
+        with gzip.open(path, 'rb') as z:
+            while z.read(BUFSIZE):
+                pass
+        return True
+    except (OSError, EOFError, zlib.error):
+        return False
+
+class PackError(Exception):
+    pass
+
+class WarcPacker(object):
+    def __init__(self, conf, out=None, check_gzip=None):
+        """check_gzip=False skips gzip verification, for use when it is
+        done by manifest.py while computing md5 (saves reading each WARC
+        twice). default follows verify_gzip config parameter.
+        """
+        self.config = conf
+        self.out = out or sys.stdout
+        self.job_dir = conf['job_dir']
+        self.xfer_home = conf['xfer_dir']
+        # fractional GB is okay here (pack-warcs.sh requires integer)
+        self.max_size = int(conf['max_size'] * 1024**3)
+        self.compactify = bool(conf['compact_names'])
+        self.verify_gzip = conf['verify_gzip'] != 0
+        if check_gzip is not None:
+            self.verify_gzip = self.verify_gzip and check_gzip
+        suffix_re = conf['suffix_re']
+        if suffix_re:
+            suffix_re = emacs_to_python_re(suffix_re)
+        self.naming = WarcNaming(conf['warc_name_pattern'], suffix_re)
+        self.item_name_template = conf['item_name_template']
+
+        self.open = os.path.join(self.job_dir, 'PACKED.open')
+        self.finish_drain = os.path.join(self.job_dir, 'FINISH_DRAIN')
+
+    def echo(self, *args):
+        print(*args, file=self.out)
+
+    def make_item_name(self, first, last, suffix=''):
+        fields = self.naming.parse(first)
+        for k, v in self.naming.parse(last).items():
+            fields['last' + k] = v
+        fields['timestamp14'] = (fields.get('timestamp') or '')[:14]
+        fields['lasttimestamp14'] = (fields.get('lasttimestamp') or '')[:14]
+        fields['suffix'] = suffix
+        return expand_template(self.item_name_template, fields)
+
+    def compactify_target(self, name):
+        f = self.naming.parse(name)
+        return '%s-%s-%s%s' % (f.get('prefix', ''),
+                               (f.get('timestamp') or '')[:14],
+                               f.get('serial', ''), f['ext'])
+
+    def scan(self):
+        """return sorted list of (name, size) of WARCs in job_dir,
+        with just one pass over the directory.
+        """
+        warcs = []
+        with os.scandir(self.job_dir) as it:
+            for e in it:
+                if not self.naming.match(e.name):
+                    continue
+                try:
+                    if not e.is_file():
+                        continue
+                    warcs.append((e.name, e.stat().st_size))
+                except OSError:
+                    # removed in the meantime
+                    continue
+        warcs.sort()
+        return warcs
+
+    def plan(self, warcs, finish_drain):
+        """group warcs into series of at most max_size bytes, following
+        pack-warcs.sh rules: last WARC is packed only when finish_drain,
+        and a WARC larger than max_size is packed by itself.
+        yields lists of (name, size).
+        """
+        mfiles = []
+        msize = 0
+        for i, (name, size) in enumerate(warcs):
+            is_last = (i == len(warcs) - 1)
+            msize += size
+            if msize <= self.max_size and not is_last:
+                mfiles.append((name, size))
+                continue
+            if is_last:
+                mfiles.append((name, size))
+                if not finish_drain:
+                    self.echo("FINISH_DRAIN file not found, leaving last "
+                              "warcs (%d)" % len(mfiles))
+                    return
+                self.echo("FINISH_DRAIN file found, packing last warcs "
+                          "(%d)" % len(mfiles))
+                yield mfiles
+                return
+            if not mfiles:
+                # first file is larger than max_size - pack it by itself
+                yield [(name, size)]
+                mfiles, msize = [], 0
+            else:
+                yield mfiles
+                mfiles, msize = [(name, size)], size
+
+    def lock(self):
+        """create PACKED.open. returns False if other process is packing.
+        """
+        if os.path.exists(self.open):
+            try:
+                with open(self.open) as f:
+                    pid = f.readline().strip()
+            except OSError:
+                pid = ''
+            if not re.match(r'\d+$', pid):
+                self.echo("OPEN file exists: %s (PID unknown)" % self.open)
+                return False
+            try:
+                os.kill(int(pid), 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+            if alive:
+                self.echo("OPEN file exists: %s (PID=%s)" % (self.open, pid))
+                return False
+            self.echo("Removing stale %s (PID=%s)" % (self.open, pid))
+        self.echo("creating file: %s" % self.open)
+        with open(self.open, 'w') as w:
+            w.write('%d\n' % os.getpid())
+        return True
+
+    def unlock(self):
+        if os.path.isfile(self.open):
+            self.echo("removing %s" % self.open)
+            os.remove(self.open)
+
+    def secure_series_dir(self, mfiles):
+        """pick item name for mfiles and create its directory, adding
+        suffix on conflict when compact_names is on.
+        returns (warc_series, xfer_dir).
+        """
+        first, last = mfiles[0][0], mfiles[-1][0]
+        suffix = ''
+        while True:
+            warc_series = self.make_item_name(first, last, suffix)
+            if not warc_series:
+                raise PackError("item identifier generation failed")
+            xfer_dir = os.path.join(self.xfer_home, warc_series)
+            if not os.path.isdir(xfer_dir):
+                self.echo("mkdir -p %s" % xfer_dir)
+                os.makedirs(xfer_dir)
+                return warc_series, xfer_dir
+            self.echo("%s exists" % xfer_dir)
+            if not os.path.isfile(os.path.join(xfer_dir, 'PACKED')):
+                # left over from interrupted run - reuse it
+                return warc_series, xfer_dir
+            if not self.compactify:
+                raise PackError("%s/PACKED exists - item name conflict, "
+                                "aborting" % xfer_dir)
+            self.echo("%s/PACKED exists - item name conflict, adding suffix "
+                      "to resolve" % xfer_dir)
+            suffix = '-%d' % (int(suffix or '0', 10) * -1 + 1)
+
+    def move(self, source, target):
+        try:
+            os.rename(source, target)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+            shutil.move(source, target)
+
+    def pack_series(self, mfiles, mode):
+        """move mfiles into a new series directory and write PACKED.
+        returns the name of the series.
+        """
+        msize = sum(size for name, size in mfiles)
+        warc_series, xfer_dir = self.secure_series_dir(mfiles)
+        pack_info = '%s %d %d' % (warc_series, len(mfiles), msize)
+
+        self.echo("files considered for packing:")
+        for i, (name, size) in enumerate(mfiles):
+            self.echo("%5s %s" % ('[%d]' % (i + 1),
+                                  os.path.join(self.job_dir, name)))
+        self.echo("==== %s ====" % pack_info)
+
+        for name, size in mfiles:
+            source = os.path.join(self.job_dir, name)
+            if self.compactify:
+                target = os.path.join(xfer_dir, self.compactify_target(name))
+            else:
+                target = os.path.join(xfer_dir, name)
+            self.echo("mv %s %s" % (source, target))
+            if mode != 'test':
+                self.move(source, target)
+            self.pack_count += 1
+
+        self.echo("PACKED: %s" % pack_info)
+        with open(os.path.join(xfer_dir, 'PACKED'), 'w') as w:
+            w.write(pack_info + '\n')
+        return warc_series
+
+    def check_gzip(self, warcs, mode):
+        """verify gzip container of each warc, moving bad ones aside.
+        returns list of good warcs.
+        """
+        good = []
+        for name, size in warcs:
+            if name.endswith('.gz') and self.verify_gzip:
+                if mode != 'test':
+                    path = os.path.join(self.job_dir, name)
+                    self.echo("  verifying gz: %s" % name)
+                    if not verify_gzip(path):
+                        self.echo("ERROR: bad gzip, skipping file: %s" % path)
+                        self.echo("  mv %s %s.bad" % (path, path))
+                        os.rename(path, path + '.bad')
+                        continue
+                self.gz_OK_count += 1
+            good.append((name, size))
+        return good
+
+    def run(self, force=True, mode='single', on_packed=None):
+        """pack series. returns list of series names packed.
+        on_packed, if given, is called with the name of each series as
+        soon as it is packed."""
+        self.echo(os.path.basename(__file__), time.strftime('%c'))
+        if not os.path.isdir(self.job_dir):
+            raise PackError("job_dir not found: %s" % self.job_dir)
+        self.gz_OK_count = 0
+        self.pack_count = 0
+        packed = []
+        if not self.lock():
+            return packed
+        try:
+            warcs = self.scan()
+            total_size = sum(size for name, size in warcs)
+            for k, v in (('job_dir', self.job_dir),
+                         ('xfer_home', self.xfer_home),
+                         ('warc_naming', self.naming.pattern),
+                         ('item_naming', self.item_name_template),
+                         ('max_series_size', '%d (%sGB)' % (
+                             self.max_size, self.config['max_size'])),
+                         ('total_num_warcs', len(warcs)),
+                         ('total_size_warcs', total_size),
+                         ('FINISH_DRAIN', self.finish_drain),
+                         ('OPEN', self.open),
+                         ('mode', mode),
+                         ('compactify', int(self.compactify))):
+                self.echo("  %-16s = %s" % (k, v))
+            if not force:
+                if input("Continue [Y/n]> ") != 'Y':
+                    self.echo("Aborting.")
+                    return packed
+
+            finish_drain = os.path.isfile(self.finish_drain)
+            if not finish_drain and total_size < self.max_size:
+                self.echo("too few WARCs and FINISH_DRAIN file not found, "
+                          "exiting normally")
+                return packed
+
+            for mfiles in self.plan(warcs, finish_drain):
+                mfiles = self.check_gzip(mfiles, mode)
+                if not mfiles:
+                    continue
+                packed.append(self.pack_series(mfiles, mode))
+                if on_packed:
+                    on_packed(packed[-1])
+                if mode in ('single', 'test'):
+                    self.echo("mode = %s, exiting normally." % mode)
+                    break
+                self.echo(" ")
+        finally:
+            self.unlock()
+        self.echo("%d warcs, %d gz_OK, %d packed, %d series" % (
+                len(warcs), self.gz_OK_count, self.pack_count, len(packed)))
+        self.echo(os.path.basename(__file__), "done.", time.strftime('%c'))
+        return packed
+
+def main(conf, force=True, mode='single', out=None, check_gzip=None):
+    """run packing for DrainConfig conf. returns exit status."""
+    try:
+        WarcPacker(conf, out=out, check_gzip=check_gzip).run(
+            force=force, mode=mode)
+    except (PackError, OSError) as ex:
+        print("ERROR: %s" % ex, file=out or sys.stdout)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    try:
+        conf.validate()
+    except ValueError as ex:
+        print("ERROR: invalid config: %s: %s" % (sys.argv[1], ex))
+        sys.exit(1)
+    force = len(sys.argv) > 2 and sys.argv[2] == '1'
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'single'
+    sys.exit(main(conf, force=force, mode=mode))
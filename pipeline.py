@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""run drain job as a pipeline
+Usage: pipeline.py config
+    config  a YAML config file
+
+drain steps of dtmon.py (pack, manifest, ingest and clean) run as
+stages of a pipeline, connected by tornado.queues. a series moves on to
+the next stage as soon as the previous one is done with it, so that
+while one series is uploaded, others are packed and hashed, and
+uploaded series are cleaned right away.
+
+number of workers of each stage is set with pipeline_workers config
+parameter, like:
+
+    pipeline_workers: {manifest: 1, ingest: 2, clean: 1}
+
+an ingest worker whose files are all waiting for blocking retry gives
+its slot to the next series in the queue until one of them is retried,
+so that a throttled series does not hold up the others.
+
+pack stage always has one worker, as PACKED.open lock allows only one
+packer at a time for a job_dir. series already in xfer_dir are fed to
+the stage they are ready for. pipeline finishes when there is nothing
+left to pack, and all queues have been emptied.
+
+before/on hooks of each step run once per pipeline run: before hook
+before the stage starts, and on hook after the stage is done with all
+series. if before hook fails, the stage is skipped, leaving series for
+the next run.
+
+with RetrySchedule (retrysched.py), series waiting for retry are not
+looked into, and a pipeline can be run for series due for retry only,
+skipping pack and manifest stages.
+
+with SeriesIndex (seriesindex.py), series are fed to stages by their
+state in the index, which is refreshed after each stage.
+
+blocking steps (pack, manifest, clean, index refresh and hooks) run in
+an executor of the pipeline, with a thread for each worker, apart from
+the default executor reading upload bodies, so that neither can starve
+the other.
+"""
+
+import sys, os
+libdir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'lib'))
+if libdir not in sys.path:
+    sys.path.append(libdir)
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+
+from tornado import locks
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+
+import config
+import cleanwarcs, httppool, manifest, packwarcs, s3upload, uploadstats
+
+STAGES = config.PIPELINE_STAGES
+
+# default for pipeline_workers config parameter
+DEFAULT_WORKERS = {'pack': 1, 'manifest': 1, 'ingest': 2, 'clean': 1}
+
+class DrainPipeline(object):
+    def __init__(self, conf, out=None, run_hook=None, retries=None,
+                 index=None, stats=None, window=None):
+        """run_hook, if given, is called as run_hook(step, hook, out)
+        and returns exit status (see dtmon.Project.run_hook).
+        retries is retrysched.RetrySchedule of xfer_dir, and index is
+        seriesindex.SeriesIndex of xfer_dir, or None. upload requests
+        are recorded in uploadstats.UploadStats stats, and limited by
+        uploadwindow.AdaptiveWindow window, if given."""
+        self.config = conf
+        self.retries = retries
+        self.index = index
+        self.out = out or sys.stdout
+        self.run_hook = run_hook
+        self.xfer_dir = conf['xfer_dir']
+        workers = conf['pipeline_workers'] or {}
+        self.workers = dict((stage, workers.get(stage) or
+                             DEFAULT_WORKERS[stage]) for stage in STAGES)
+        self.workers['pack'] = 1
+        # gzip container is checked by manifest stage, in the same pass
+        # as md5 computation.
+        self.packer = packwarcs.WarcPacker(conf, out=self.out,
+                                           check_gzip=False)
+        self.builder = manifest.ManifestBuilder(conf, out=self.out)
+        self.uploader = s3upload.S3Uploader(conf, out=self.out,
+                                            retries=retries, stats=stats,
+                                            window=window)
+        self.cleaner = cleanwarcs.SeriesCleaner(out=self.out)
+        self.queues = dict((stage, Queue()) for stage in STAGES[1:])
+        self.queued = dict((stage, set()) for stage in STAGES[1:])
+        self.enabled = dict((stage, True) for stage in STAGES)
+        self.done = dict((stage, 0) for stage in STAGES)
+        self.errors = dict((stage, 0) for stage in STAGES)
+        # one thread for each worker of any stage (ingest workers refresh
+        # the index), and one for hooks
+        self.executor = ThreadPoolExecutor(
+            max_workers=sum(self.workers.values()) + 1,
+            thread_name_prefix='pipeline')
+
+    def echo(self, msg):
+        print(msg, file=self.out)
+
+    def put(self, stage, d):
+        """queue series directory d for stage"""
+        if not self.enabled[stage] or d in self.queued[stage]:
+            return
+        self.queued[stage].add(d)
+        self.queues[stage].put_nowait(d)
+
+    def series_states(self):
+        """yields (series directory, function testing marker file) of
+        series in xfer_dir"""
+        if self.index is not None:
+            for state in sorted(self.index.all(), key=lambda st: st.name):
+                yield os.path.join(self.xfer_dir, state.name), state.has
+            return
+        for name in sorted(os.listdir(self.xfer_dir)):
+            d = os.path.join(self.xfer_dir, name)
+            if os.path.isdir(d):
+                yield d, (lambda f, d=d: os.path.exists(os.path.join(d, f)))
+
+    def seed(self):
+        """queue series in xfer_dir for the stage they are ready for"""
+        for d, has in self.series_states():
+            if has('SUCCESS'):
+                if not (has('CLEAN') or has('CLEAN.err') or
+                        has('CLEAN.open')):
+                    self.put('clean', d)
+            elif has('MANIFEST'):
+                if self.retries is not None:
+                    deadline = self.retries.deadline(d)
+                    if deadline is not None and time.time() < deadline:
+                        continue
+                self.put('ingest', d)
+            elif has('PACKED') and not has('MANIFEST.open'):
+                self.put('manifest', d)
+
+    async def hook(self, stage, hook):
+        if self.run_hook is None:
+            return 0
+        return await IOLoop.current().run_in_executor(
+            self.executor, self.run_hook, stage, hook, self.out)
+
+    async def pack(self):
+        """pack series until nothing is left, queueing each for manifest
+        stage as soon as it is packed."""
+        loop = IOLoop.current()
+        def on_packed(name):
+            if self.index is not None:
+                self.index.refresh(name)
+            loop.add_callback(self.put, 'manifest',
+                              os.path.join(self.xfer_dir, name))
+        try:
+            pack = functools.partial(self.packer.run, force=True,
+                                     mode='all', on_packed=on_packed)
+            packed = await loop.run_in_executor(self.executor, pack)
+            self.done['pack'] += len(packed)
+        except (packwarcs.PackError, OSError) as ex:
+            self.echo("ERROR: pack: %s" % ex)
+            self.errors['pack'] += 1
+
+    async def process(self, stage, d, slot=None):
+        """run stage on series directory d, holding worker slot.
+        returns True if the series is ready for the next stage."""
+        loop = IOLoop.current()
+        if stage == 'manifest':
+            return await loop.run_in_executor(self.executor,
+                                              self.builder.build, d)
+        elif stage == 'ingest':
+            return (await self.uploader.upload_series(d, slot)) is True
+        elif stage == 'clean':
+            status = await loop.run_in_executor(self.executor,
+                                                self.cleaner.clean, d)
+            if status == 'error':
+                self.errors[stage] += 1
+            return status == 'cleaned'
+
+    async def dispatch(self, stage, nextstage):
+        """start a worker for each series queued for stage, as long as
+        there is a free slot for it, until None is queued"""
+        queue = self.queues[stage]
+        slots = locks.Semaphore(self.workers[stage])
+        async for d in queue:
+            if d is None:
+                queue.task_done()
+                return
+            await slots.acquire()
+            IOLoop.current().spawn_callback(self.worker, stage, nextstage,
+                                            d, slots)
+
+    async def worker(self, stage, nextstage, d, slots):
+        try:
+            try:
+                ok = await self.process(stage, d, slots)
+            except Exception:
+                self.echo("ERROR: %s %s:" % (stage, d))
+                traceback.print_exc(file=self.out)
+                self.errors[stage] += 1
+                ok = False
+            if self.index is not None:
+                await IOLoop.current().run_in_executor(
+                    self.executor, self.index.refresh, d)
+            if ok:
+                self.done[stage] += 1
+                if nextstage:
+                    self.put(nextstage, d)
+        finally:
+            slots.release()
+            self.queues[stage].task_done()
+
+    async def run(self, retry=None):
+        """run pipeline until all stages are done. returns number of
+        errors. if retry is given, only series directories in it are
+        uploaded (and cleaned), without packing or looking into
+        xfer_dir."""
+        try:
+            return await self.run_stages(retry)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def run_stages(self, retry):
+        self.echo("%s %s" % (os.path.basename(__file__), time.strftime('%c')))
+        if retry is not None:
+            self.echo("  retry = %s" % ' '.join(
+                    os.path.basename(d) for d in retry))
+            self.enabled['pack'] = self.enabled['manifest'] = False
+        self.echo("  workers = %s" % ', '.join(
+                '%s:%d' % (stage, self.workers[stage]) for stage in STAGES))
+        for stage in STAGES:
+            if not self.enabled[stage]:
+                continue
+            if await self.hook(stage, 'before') != 0:
+                self.echo("ERROR before%s failed, skipping %s stage" % (
+                        stage, stage))
+                self.enabled[stage] = False
+                self.errors[stage] += 1
+        self.uploader.open()
+        if retry is None:
+            self.seed()
+        else:
+            for d in retry:
+                self.put('ingest', d)
+        for i, stage in enumerate(STAGES[1:], 1):
+            nextstage = STAGES[i + 1] if i + 1 < len(STAGES) else None
+            IOLoop.current().spawn_callback(self.dispatch, stage, nextstage)
+        if self.enabled['pack']:
+            await self.pack()
+        # series only move forward. once a stage is drained, no more
+        # series come to the next one than those already queued.
+        for stage in STAGES:
+            if stage != 'pack':
+                await self.queues[stage].join()
+                self.queues[stage].put_nowait(None)
+            if self.enabled[stage] and await self.hook(stage, 'on') != 0:
+                self.echo("ERROR on%s failed" % stage)
+                self.errors[stage] += 1
+        self.echo("  " + ', '.join('%s:%d done %d errors' % (
+                    stage, self.done[stage], self.errors[stage])
+                                  for stage in STAGES))
+        self.echo("  connections: %s" % self.uploader.client.pool.summary())
+        self.echo("  requests: %s" % uploadstats.summary(
+                self.uploader.stats.total))
+        self.echo("  window: %s" % self.uploader.window.summary())
+        self.echo("%s done. %s" % (os.path.basename(__file__),
+                                   time.strftime('%c')))
+        return sum(self.errors.values())
+
+def main(conf, out=None, run_hook=None, retries=None, retry=None,
+         index=None, stats=None, window=None):
+    """run drain pipeline for DrainConfig conf on the IOLoop shared by
+    the process. returns exit status."""
+    try:
+        pipeline = DrainPipeline(conf, out=out, run_hook=run_hook,
+                                 retries=retries, index=index, stats=stats,
+                                 window=window)
+        errors = httppool.run_sync(pipeline.run(retry=retry))
+    except (s3upload.UploadError, OSError) as ex:
+        print("ERROR: %s" % ex, file=out or sys.stdout)
+        return 1
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    try:
+        conf.validate()
+    except ValueError as ex:
+        print("ERROR: invalid config: %s: %s" % (sys.argv[1], ex))
+        sys.exit(1)
+    sys.exit(main(conf))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""pending RETRY deadlines of series in xfer_dir
+Usage: retrysched.py xfer_job_dir
+
+RETRY files are read once, when RetrySchedule is created. after that,
+the schedule is kept up to date by s3upload.py as it writes and moves
+aside RETRY files, and dtmon.py sleeps until the earliest deadline
+(or sleep_time, whichever comes first), then uploads just the series
+that are due, without scanning xfer_dir.
+
+deadlines are kept in a heap of (epoch, series name). rescheduling or
+cancelling a series leaves its old entry in the heap, which is skipped
+as it comes to the top.
+"""
+
+import sys, os
+import heapq
+import threading
+import time
+
+class RetrySchedule(object):
+    def __init__(self, xfer_dir):
+        self.xfer_dir = xfer_dir
+        self.lock = threading.Lock()
+        self.heap = []
+        # series name -> epoch of current deadline
+        self.deadlines = {}
+        self.load()
+
+    def load(self):
+        """(re)load deadlines from RETRY files in xfer_dir"""
+        with self.lock:
+            self.heap = []
+            self.deadlines = {}
+            try:
+                names = os.listdir(self.xfer_dir)
+            except OSError:
+                return
+            for name in names:
+                try:
+                    with open(os.path.join(self.xfer_dir, name, 'RETRY')) as f:
+                        epoch = int(f.readline().strip() or 0)
+                except ValueError:
+                    # RETRY without valid time is due right away,
+                    # as s3-launch-transfers.sh treats it.
+                    epoch = 0
+                except OSError:
+                    continue
+                self._push(name, epoch)
+
+    def _push(self, name, epoch):
+        self.deadlines[name] = epoch
+        heapq.heappush(self.heap, (epoch, name))
+
+    def _top(self):
+        """drop stale entries from the top of heap"""
+        while self.heap:
+            epoch, name = self.heap[0]
+            if self.deadlines.get(name) == epoch:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+
+    def schedule(self, d, epoch):
+        """schedule retry of series directory d at epoch"""
+        with self.lock:
+            self._push(os.path.basename(d), epoch)
+
+    def cancel(self, d):
+        """forget deadline of series directory d (RETRY moved aside)"""
+        with self.lock:
+            self.deadlines.pop(os.path.basename(d), None)
+
+    def deadline(self, d):
+        """epoch of retry of series directory d, or None"""
+        with self.lock:
+            return self.deadlines.get(os.path.basename(d))
+
+    def next_deadline(self):
+        """epoch of the earliest retry, or None if nothing is pending"""
+        with self.lock:
+            top = self._top()
+            return top and top[0]
+
+    def due(self, now=None):
+        """remove series due for retry at now from the schedule, and
+        return list of their directories, earliest first."""
+        if now is None:
+            now = time.time()
+        due = []
+        with self.lock:
+            while True:
+                top = self._top()
+                if top is None or top[0] > now:
+                    break
+                heapq.heappop(self.heap)
+                del self.deadlines[top[1]]
+                due.append(os.path.join(self.xfer_dir, top[1]))
+        return due
+
+    def __len__(self):
+        return len(self.deadlines)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    sched = RetrySchedule(sys.argv[1])
+    for epoch, name in sorted((e, n) for n, e in sched.deadlines.items()):
+        print(time.strftime('%Y-%m-%dT%H:%M:%S%Z', time.localtime(epoch)),
+              name)
@@ -40,6 +40,7 @@
 PG=$0; test -h $PG && PG=$(readlink $PG)
 BIN=$(dirname $PG)
 : ${GETCONF:=$BIN/config.py}
+: ${ITEMMETA:=$BIN/itemmeta.py}
 
 usage="config [force] [mode=single]"
 
@@ -62,62 +63,6 @@ function echorun {
     "$@"
 }
 
-function parse_warc_name {
-  local re=$(sed -e 's/{[^}]*}/(.*)/g' <<<"$WARC_NAME_PATTERN")
-  local names=($(sed -e 's/[^}]*{\([^}]*\)}[^{]*/\1 /g' <<<"$WARC_NAME_PATTERN") ext gz)
-
-  if [[ "$1" =~ ^$re(\.w?arc(\.gz)?)$ ]]; then
-    read ${names[@]/#/$2} <<<"${BASH_REMATCH[@]:1}"
-  else
-    return 1
-  fi
-}
-
-function set_tHR { # human-readable date format
-    local t=$1
-    date -d "${t:0:4}-${t:4:2}-${t:6:2} ${t:8:2}:${t:10:2}:${t:12:2}"
-}
-
-# ISO 8601 date format
-function set_tISO {
-    local t=$1
-    date +%Y-%m-%dT%T%Z -d "${t:0:4}-${t:4:2}-${t:6:2} ${t:8:2}:${t:10:2}:${t:12:2}"
-}
-
-# we could do something more sophisticated here
-# for more human readable date ranges
-function set_date_range {
-    local t=$(parse_warc_name "$(basename "$1")"; echo $timestamp)
-    first_file_date="$t"
-    start_date_ISO="$(set_tISO "$t")"
-    start_date_HR="$(set_tHR "$t")"
-
-    scandate=${t:0:14}
-    metadate=${t:0:4}
-    
-    # get dates from last file in series
-    last_file_date=$(parse_warc_name $(basename "$2"); echo $timestamp)
-
-    # warc end date (from last file mtime). should (closely) 
-    # correspond to time of last record in series
-    local t=$(date +%Y%m%d%H%M%S -d @"$(stat -c %Y "$2")")
-    last_date=$t
-    end_date_ISO="$(set_tISO "$t")"
-    end_date_HR="$(set_tHR "$t")"
-    
-    date_range="${start_date_ISO} to ${end_date_ISO}"
-}
-
-function warc_software {
-    cat=cat
-    if [[ $1 =~ \.gz$ ]]; then
-	cat=zcat
-    fi
-    # Note: warcinfo record body uses CRLF as EOL marker. this -F option ensures
-    # CR is not included in the return value.
-    $cat $1 2>/dev/null | awk -F '[[:space:]]+' '/^software:/{ print $2 } NR>1&&/^WARC\//{ exit }'
-}
-	
 function echo_curl_output {
     echo "https://${s3}/${bucket}/${filename}" | tee -a $TASK
     echo "  response_code $1" | tee -a $TASK
@@ -341,22 +286,18 @@ if [ ! -f $CONFIG ]; then
     echo "ERROR: config not found: $CONFIG"
     exit 1
 fi
-# validate configuration
-$GETCONF $CONFIG || {
+# validate configuration, and read all parameters at once
+confvars=$($GETCONF --export-shell --prefix=conf_ $CONFIG) || {
     echo "ERROR: invalid config: $CONFIG"
     exit 1
 }
-s3cfg=$($GETCONF $CONFIG s3cfg)
+eval "$confvars"
+s3cfg=$conf_s3cfg
 if [ -z "$s3cfg" ]; then
   echo "ERROR: IAS3 credentials file not found or unreadable"
   exit  1
 fi
-xfer_job_dir=$($GETCONF $CONFIG xfer_dir)
-
-# crawljob is used in description
-crawljob=$($GETCONF $CONFIG crawljob)
-crawlhost=$($GETCONF $CONFIG crawlhost)
-WARC_NAME_PATTERN=$($GETCONF $CONFIG warc_name_pattern_upload)
+xfer_job_dir=$conf_xfer_dir
 
 for d in $(find $xfer_job_dir -mindepth 1 -maxdepth 1 -type d | sort)
 do
@@ -482,101 +423,44 @@ do
       continue
   fi
 
-  first_file=${files[0]}
-  last_file=${files[${#files[@]}-1]}
-
-  # sets first_file_date, start_date_ISO, start_date_HR, scandate,
-  # metadate, last_file_date, last_date, end_date_ISO, end_date_HR
-  # and date_range
-  set_date_range "$first_file" "$last_file"
-
   # get keys
   access_key=`grep access_key $s3cfg | awk '{print $3}'`
   secret_key=`grep secret_key $s3cfg | awk '{print $3}'`
 
   # parse config
-  title_prefix=`$GETCONF $CONFIG title_prefix`
-  block_delay=`$GETCONF $CONFIG block_delay`
-  max_block_count=`$GETCONF $CONFIG max_block_count`
-  retry_delay=`$GETCONF $CONFIG retry_delay`
-
-  # parse series
-  #ws_date=`echo $warc_series | cut -d '-' -f 2`
-  #cdate=`echo ${ws_date:0:6}`
+  block_delay=$conf_block_delay
+  max_block_count=$conf_max_block_count
+  retry_delay=$conf_retry_delay
 
   # bucket metadata
   bucket=${warc_series}
-  title="${title_prefix} ${date_range}"
-  derive=$($GETCONF $CONFIG derive)
+  derive=$conf_derive
 
   num_warcs=${nfiles_manifest}
   size_hint=`cat $PACKED | awk '{print $NF}'`
-  first_serial=$(parse_warc_name "$(basename "$first_file")"; echo $serial)
-  last_serial=$(parse_warc_name "$(basename "$last_file")"; echo $serial)
 
-  # metadata per BK, intended to be like books
-  #   Subject: metadata for the web stuff going into the paired archive
-  #   Date:  2010-09-18T12:16:00PDT
-  metadata=()
-  while read m; do
-      metadata+=("$m")
-  done < <( $GETCONF $CONFIG -m metadata )
-  # scandate (using 14-digits of timestamp of first warc in series)
-  # metadate (like books, the year)
-  crawler_version=$(warc_software ${files[0]})
-  description=`$GETCONF $CONFIG description\
-    | sed -e s/CRAWLHOST/$crawlhost/\
-      -e s/CRAWLJOB/$crawljob/\
-      -e s/START_DATE/"$start_date_HR"/\
-      -e s/END_DATE/"$end_date_HR"/\
-    | tr -s ' '`
-
-  metadata+=(
-      "x-archive-meta-identifier-access:https://archive.org/details/${bucket}"
-      "x-archive-meta-title:${title}"
-      "x-archive-meta-description:${description}"
-      "x-archive-meta-scandate:${scandate}"
-      "x-archive-meta-date:${metadate}"
-      "x-archive-meta-sizehint:${size_hint}"
-      "x-archive-meta-firstfiledate:${first_file_date}"
-      "x-archive-meta-lastfiledate:${last_file_date}"
-      "x-archive-meta-lastdate:${last_date}"
-  )
-  if [ -n "$crawler_version" ]; then
-      metadata+=("x-archive-meta-crawler:${crawler_version}")
-  fi
-  if [ -n "$crawljob" ]; then
-      metadata+=("x-archive-meta-crawljob:${crawljob}")
-  fi
-  if [ -n "$num_warcs" ]; then
-      metadata+=("x-archive.meta-numwarcs:${num_warcs}")
-  fi
-  if [ -n "$first_serial" ]; then
-      metadata+=("x-archive-meta-firstfileserial:${first_serial}")
-  fi
-  if [ -n "$last_serial" ]; then
-      metadata+=("x-archive-meta-lastfileserial:${last_serial}")
-  fi
-  # support multiple arbitrary collections
+  # metadata headers (dates, description, crawler, serials...) and
+  # collections, all built by itemmeta.py at once
   # webwidecrawl/collection/serial
   #   => collection3 = webwidecrawl
   #   => collection2 = collection
   #   => collection1 = serial
+  headers=$($ITEMMETA $CONFIG $d) || {
+      echo "ERROR: failed to build item metadata: $d" | tee -a $OPEN
+      echo "Aborting!" | tee -a $OPEN
+      cp $OPEN $ERROR
+      # leave this series, go on to the next
+      continue
+  }
+  metadata=()
   COLLECTIONS=()
-  colls=($($GETCONF $CONFIG collections | tr '/' ' '))
-  coll_count=${#colls[@]}
-  for c in ${colls[@]}
-  do
-      # --header 'x-archive-meta03-collection:${collection1}'\
-      # --header 'x-archive-meta02-collection:${collection2}'\
-      # --header 'x-archive-meta01-collection:${collection3}'\
-      collection[$coll_count]=$c
-      COLLECTIONS+=(
-	  --header
-	  "$(printf 'x-archive-meta%02d-collection' $coll_count):$c"
-      )
-      ((coll_count--))
-  done
+  while read -r m; do
+      if [[ $m =~ ^x-archive-meta[0-9]+-collection: ]]; then
+	  COLLECTIONS+=(--header "$m")
+      elif [ -n "$m" ]; then
+	  metadata+=("$m")
+      fi
+  done <<< "$headers"
 
   #if [ -z "$creator" -o -z "$sponsor" -o -z "$contributor" -o \
   #     -z "$description" -o -z "$scancenter" -o -z "$operator" ]; then
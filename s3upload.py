@@ -0,0 +1,1157 @@
+#!/usr/bin/env python3
+
+"""upload series to IAS3
+Usage: s3upload.py config [mode]
+    config  a YAML config file
+    mode    single = upload 1 series, then exit
+            test = do not send requests, just print them
+            all = upload all series ready for upload (default)
+
+in-process, concurrent equivalent of s3-launch-transfers.sh, built on
+tornado's AsyncHTTPClient. up to upload_series series are uploaded at
+once, each with up to upload_concurrency concurrent PUTs. requests in
+flight in total are limited by uploadwindow.AdaptiveWindow, which
+grows while IAS3 responds well and shrinks on 503/SlowDown and network
+errors, up to upload_max_connections. file
+content is streamed from disk with body_producer. requests go through
+httppool's KeepAliveHTTPClient, reusing connections across files, series
+and runs in the same process.
+
+files larger than multipart_threshold (MB) are uploaded with S3
+multipart upload API, in parts of multipart_part_size (MB), up to
+upload_concurrency parts at once. before initiating the upload, the
+file is read once to compute MD5 of each part and of the whole file;
+the latter must match MANIFEST. upload ID, part MD5s and ETags of
+completed parts are recorded in <file>.multipart in series directory,
+so that upload resumes from there after crash or RETRY.
+
+blocking retry (after block_delay, on 503 and 4xx) does not hold up
+other uploads: a blocked file gives its slot (of upload_concurrency)
+to other files of the series while waiting, and when all files of a
+series left to upload are blocked, the series gives its slot (of
+upload_series, or of ingest workers of pipeline.py) to other series.
+retries are counted for each file (request) separately.
+
+state of each file of a series is recorded in JOURNAL in series
+directory (see SeriesJournal): pending, sending (from byte offset),
+uploaded (with ETag matching MANIFEST) and verified (.tombstone
+written). when a series is resumed after RETRY (including retryasap of
+admin page) or restart, files uploaded are not sent again, and only
+unfinished ones are.
+
+with remote_resume config parameter, a series resumed after its item
+has been created (BUCKET_OK) looks up the item's files once, in
+<item>_files.xml under download_base. files stored there with the same
+size and MD5 as in MANIFEST get .tombstone without being uploaded
+again, as when dtmon.py died after PUT succeeded but before .tombstone
+was written. files.xml may lag behind recent uploads, so files missing
+from it are uploaded as usual.
+
+marker files are the same as s3-launch-transfers.sh: LAUNCH.open while
+working on a series, BUCKET_OK after auto-make-bucket, a .tombstone per
+uploaded file after ETag matched Content-MD5, TASK with response of
+each request, SUCCESS and TOMBSTONE when all files are uploaded, RETRY
+for non-blocking retry, and ERROR. TASK also has time spent in each
+phase of the request (time_<phase>_seconds, see httppool.py), and
+timings of all requests are aggregated in uploadstats.UploadStats.
+"""
+
+import sys, os, re
+libdir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'lib'))
+if libdir not in sys.path:
+    sys.path.append(libdir)
+import asyncio
+import glob
+import shutil
+import hashlib
+import time
+from urllib.parse import quote
+from xml.etree import ElementTree
+
+from tornado import gen, locks
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+
+import config
+import httppool
+import itemmeta
+import uploadstats
+import uploadwindow
+
+# defaults for config parameters
+S3_ENDPOINT = 'https://s3.us.archive.org'
+DOWNLOAD_BASE = 'http://www.archive.org/download'
+DEFAULT_CONCURRENCY = 2
+DEFAULT_SERIES = 2
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_PART_SIZE_MB = 100
+
+# read size for streaming file content
+BUFSIZE = 1024 * 1024
+
+class UploadError(Exception):
+    pass
+
+class RetryScheduled(Exception):
+    """series is put off until time in RETRY file"""
+
+class SeriesError(Exception):
+    """series is blocked with ERROR file"""
+
+def read_s3cfg(path):
+    """returns (access_key, secret_key) from .ias3cfg"""
+    keys = {}
+    with open(path) as f:
+        for l in f:
+            m = re.match(r'\s*(access_key|secret_key)\s*=\s*(\S+)', l)
+            if m:
+                keys[m.group(1)] = m.group(2)
+    return keys.get('access_key', ''), keys.get('secret_key', '')
+
+def read_first_line(path):
+    with open(path) as f:
+        return f.readline().strip()
+
+def http_header_value(v):
+    """tornado writes header as latin1. send UTF-8 bytes as curl does."""
+    return str(v).encode('utf-8').decode('latin1')
+
+def hash_parts(path, part_size):
+    """read path once, returning (md5, [md5 of each part]) of part_size
+    byte parts."""
+    whole = hashlib.md5()
+    parts = []
+    with open(path, 'rb') as f:
+        while True:
+            h = hashlib.md5()
+            remaining = part_size
+            while remaining > 0:
+                data = f.read(min(BUFSIZE, remaining))
+                if not data: break
+                h.update(data)
+                whole.update(data)
+                remaining -= len(data)
+            if remaining == part_size and parts:
+                break
+            parts.append(h.hexdigest())
+            if remaining > 0:
+                break
+    return whole.hexdigest(), parts
+
+def multipart_etag(parts):
+    """ETag of completed multipart upload of parts (list of md5)"""
+    digests = b''.join(bytes.fromhex(p) for p in parts)
+    return '%s-%d' % (hashlib.md5(digests).hexdigest(), len(parts))
+
+def xml_text(body, name):
+    """text of first element name in XML response body (namespace is
+    ignored). None if not found or body is not XML."""
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return None
+    for e in root.iter():
+        if e.tag.rsplit('}', 1)[-1] == name:
+            return e.text
+    return None
+
+class FilesXmlParser(object):
+    """incremental parser of item files.xml. fed with chunks of the
+    document as they arrive; each <file> element is dropped once
+    read, so that memory does not grow with the size of files.xml.
+    files is {name: (size, md5)}, size and md5 None where missing.
+    """
+    def __init__(self):
+        self.parser = ElementTree.XMLPullParser(events=('end',))
+        self.files = {}
+
+    def feed(self, data):
+        """feed chunk data. raises ElementTree.ParseError."""
+        self.parser.feed(data)
+        self.read_events()
+
+    def close(self):
+        """finish parsing and return files"""
+        self.parser.close()
+        self.read_events()
+        return self.files
+
+    def read_events(self):
+        for event, e in self.parser.read_events():
+            if e.tag != 'file':
+                continue
+            name = e.get('name')
+            if name:
+                size = e.findtext('size')
+                try:
+                    size = int(size)
+                except (TypeError, ValueError):
+                    size = None
+                self.files[name] = (size, e.findtext('md5'))
+            e.clear()
+
+def parse_files_xml(body):
+    """{name: (size, md5)} of files in item files.xml body. size and
+    md5 are None where missing. raises ElementTree.ParseError."""
+    parser = FilesXmlParser()
+    parser.feed(body)
+    return parser.close()
+
+def parse_etag(resp):
+    m = re.match(r'.*"(.*)"', resp.headers.get('ETag', ''))
+    return m.group(1) if m else ''
+
+class PartJournal(object):
+    """record of multipart upload of a file, in <file>.multipart.
+    plan of the upload is written at once, and completed parts are
+    appended one line each:
+
+        upload_id ID
+        size BYTES
+        part_size BYTES
+        md5 MD5
+        part N MD5
+        ...
+        done N ETAG
+    """
+    def __init__(self, path):
+        self.path = path
+        self.upload_id = None
+        self.size = None
+        self.part_size = None
+        self.md5 = None
+        self.parts = []
+        self.done = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for l in f:
+                    fields = l.split()
+                    if len(fields) == 2:
+                        k, v = fields
+                        if k == 'upload_id':
+                            self.upload_id = v
+                        elif k in ('size', 'part_size'):
+                            setattr(self, k, int(v))
+                        elif k == 'md5':
+                            self.md5 = v
+                    elif len(fields) == 3:
+                        k, n, v = fields
+                        if k == 'part':
+                            self.parts.append(v)
+                        elif k == 'done':
+                            self.done[int(n)] = v
+        except FileNotFoundError:
+            pass
+
+    def start(self, upload_id, size, part_size, md5, parts):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as w:
+            w.write('upload_id %s\nsize %d\npart_size %d\nmd5 %s\n' % (
+                    upload_id, size, part_size, md5))
+            for n, p in enumerate(parts, 1):
+                w.write('part %d %s\n' % (n, p))
+            w.flush()
+            os.fsync(w.fileno())
+        os.rename(tmp, self.path)
+        self.upload_id, self.size, self.part_size = upload_id, size, part_size
+        self.md5, self.parts, self.done = md5, list(parts), {}
+
+    def complete(self, n, etag):
+        with open(self.path, 'a') as w:
+            w.write('done %d %s\n' % (n, etag))
+            w.flush()
+            os.fsync(w.fileno())
+        self.done[n] = etag
+
+    def pending(self):
+        return [n for n in range(1, len(self.parts) + 1)
+                if n not in self.done]
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class SeriesJournal(object):
+    """record of upload of each file of a series, in JOURNAL. one line
+    is appended for each change of state of a file; the last one
+    counts:
+
+        pending FILE
+        sending FILE OFFSET
+        uploaded FILE SIZE ETAG
+        verified FILE SIZE ETAG
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    UPLOADED = 'uploaded'
+    VERIFIED = 'verified'
+
+    def __init__(self, path):
+        self.path = path
+        # {filename: [state, args...]}
+        self.files = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for l in f:
+                    fields = l.split()
+                    if len(fields) >= 2:
+                        self.files[fields[1]] = [fields[0]] + fields[2:]
+        except FileNotFoundError:
+            pass
+
+    def record(self, fn, state, *args):
+        fields = [state, fn] + [str(a) for a in args]
+        with open(self.path, 'a') as w:
+            w.write(' '.join(fields) + '\n')
+            w.flush()
+            os.fsync(w.fileno())
+        self.files[fn] = [state] + fields[2:]
+
+    def start(self, filenames):
+        """record files not in journal yet as pending"""
+        new = [fn for fn in filenames if fn not in self.files]
+        if not new:
+            return
+        with open(self.path, 'a') as w:
+            for fn in new:
+                w.write('%s %s\n' % (self.PENDING, fn))
+                self.files[fn] = [self.PENDING]
+            w.flush()
+            os.fsync(w.fileno())
+
+    def state(self, fn):
+        return self.files.get(fn, [self.PENDING])[0]
+
+    def uploaded(self, fn, size, checksum):
+        """ETag of file fn if it has been uploaded with size bytes and
+        ETag matching checksum (MANIFEST md5, or '-' for any), or None.
+        """
+        entry = self.files.get(fn)
+        if not entry or entry[0] not in (self.UPLOADED, self.VERIFIED) \
+                or len(entry) != 3:
+            return None
+        try:
+            if int(entry[1]) != size:
+                return None
+        except ValueError:
+            return None
+        if checksum != '-' and entry[2] != checksum:
+            return None
+        return entry[2]
+
+    def counts(self):
+        """{state: number of files}"""
+        counts = {}
+        for entry in self.files.values():
+            counts[entry[0]] = counts.get(entry[0], 0) + 1
+        return counts
+
+class UploadSeries(object):
+    """one series directory being uploaded"""
+    def __init__(self, d, out):
+        self.dir = d
+        self.name = os.path.basename(d)
+        self.bucket = self.name
+        self.out = out
+        for f in ('PACKED', 'MANIFEST', 'LAUNCH', 'RETRY', 'TASK', 'ERROR',
+                  'SUCCESS', 'TOMBSTONE', 'BUCKET_OK'):
+            setattr(self, f, os.path.join(d, f))
+        self.OPEN = os.path.join(d, 'LAUNCH.open')
+        self.journal = SeriesJournal(os.path.join(d, 'JOURNAL'))
+        self.aborted = None
+        # blocking retries of each request, by URL
+        self.blocks = {}
+        # semaphore of series being uploaded, held while uploading
+        # this series (see S3Uploader.backoff)
+        self.slot = None
+        self.yielded = False
+        # number of whole-file requests left, and blocked of them
+        self.unfinished = 0
+        self.blocked = 0
+        self.resume_lock = locks.Lock()
+        # LAUNCH.open, kept open while the series is being uploaded
+        self.logfile = None
+
+    def echo(self, msg):
+        print(msg, file=self.out)
+
+    def log(self, msg):
+        """echo msg and append it to LAUNCH.open. the file is opened
+        once and line buffered, instead of opened for each line on the
+        IOLoop thread."""
+        self.echo(msg)
+        if self.logfile is None:
+            self.logfile = open(self.OPEN, 'a', buffering=1)
+        self.logfile.write(msg + '\n')
+
+    def close_log(self):
+        """close LAUNCH.open, before it is moved, or the series is
+        done"""
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile = None
+
+    def task(self, url, code, size, elapsed, time_info=None):
+        lines = ['%s' % url, '  response_code %03d' % code,
+                 '  size_upload_bytes %d' % size,
+                 '  total_time_seconds %.3f' % elapsed]
+        for phase in uploadstats.PHASES[:-1]:
+            if time_info and phase in time_info:
+                lines.append('  time_%s_seconds %.3f' % (
+                        phase, time_info[phase]))
+        with open(self.TASK, 'a') as w:
+            for l in lines:
+                self.echo(l)
+                w.write(l + '\n')
+
+    def error(self, msg):
+        self.echo(msg)
+        with open(self.ERROR, 'a') as w:
+            w.write(msg + '\n')
+
+    def read_manifest(self):
+        """returns list of (md5, filename) in MANIFEST"""
+        entries = []
+        with open(self.MANIFEST) as f:
+            for l in f:
+                fields = l.split()
+                if len(fields) >= 2:
+                    entries.append((fields[0], fields[1]))
+        return entries
+
+    @property
+    def size_hint(self):
+        try:
+            return read_first_line(self.PACKED).split()[-1]
+        except (OSError, IndexError):
+            return ''
+
+    def path(self, fn):
+        return os.path.join(self.dir, fn)
+
+    def tombstone(self, fn):
+        return os.path.join(self.dir, fn + '.tombstone')
+
+class FakeResponse(object):
+    """response for test mode"""
+    def __init__(self, code):
+        self.code = code
+        self.headers = {}
+        self.body = b''
+        self.request_time = 0.0
+        self.time_info = {}
+
+class S3Uploader(object):
+    def __init__(self, conf, out=None, retries=None, stats=None,
+                 window=None):
+        """retries, if given, is retrysched.RetrySchedule of xfer_dir,
+        kept up to date with RETRY files written and moved aside.
+        stats is uploadstats.UploadStats requests are recorded in, and
+        window is uploadwindow.AdaptiveWindow limiting requests in
+        flight (new ones if not given)."""
+        self.config = conf
+        self.out = out or sys.stdout
+        self.retries = retries
+        self.stats = stats if stats is not None else \
+            uploadstats.UploadStats()
+        self.xfer_dir = conf['xfer_dir']
+        s3cfg = conf['s3cfg']
+        if not s3cfg:
+            raise UploadError(
+                "IAS3 credentials file not found or unreadable")
+        self.access_key, self.secret_key = read_s3cfg(s3cfg)
+        self.endpoint = (conf['s3_endpoint'] or S3_ENDPOINT).rstrip('/')
+        self.download_base = (conf['download_base'] or
+                              DOWNLOAD_BASE).rstrip('/')
+        self.block_delay = conf['block_delay']
+        self.max_block_count = conf['max_block_count'] or 0
+        self.retry_delay = conf['retry_delay']
+        self.derive = conf['derive']
+        self.concurrency = conf['upload_concurrency'] or DEFAULT_CONCURRENCY
+        self.series_concurrency = conf['upload_series'] or DEFAULT_SERIES
+        self.max_connections = (conf['upload_max_connections'] or
+                                DEFAULT_MAX_CONNECTIONS)
+        if window is None:
+            window = uploadwindow.AdaptiveWindow(self.concurrency,
+                                                 self.max_connections)
+        else:
+            window.set_maximum(self.max_connections)
+        self.window = window
+        # multipart upload is off unless multipart_threshold is set
+        self.multipart_threshold = int(
+            (conf['multipart_threshold'] or 0) * 1024 * 1024)
+        self.part_size = int((conf['multipart_part_size'] or
+                              DEFAULT_PART_SIZE_MB) * 1024 * 1024)
+        self.remote_resume = conf['remote_resume'] == 1
+        self.test = False
+        self.launch_count = 0
+
+    def echo(self, msg):
+        print(msg, file=self.out)
+
+    async def sync(self, write, *args):
+        """run journal write(*args) in executor, so that its fsync does
+        not stall other uploads on the IOLoop thread"""
+        return await IOLoop.current().run_in_executor(None, write, *args)
+
+    @property
+    def auth_header(self):
+        return 'LOW %s:%s' % (self.access_key, self.secret_key)
+
+    def file_producer(self, path, offset=0, length=None):
+        """body_producer streaming content of path (length bytes from
+        offset, or to the end). file is read in executor so that slow
+        disk does not block other uploads. each buffer read goes
+        through httppool.limiter before being sent."""
+        async def producer(write):
+            loop = IOLoop.current()
+            remaining = length
+            with open(path, 'rb') as f:
+                if offset:
+                    f.seek(offset)
+                while remaining is None or remaining > 0:
+                    n = BUFSIZE if remaining is None else min(BUFSIZE,
+                                                              remaining)
+                    data = await loop.run_in_executor(None, f.read, n)
+                    if not data:
+                        break
+                    if remaining is not None:
+                        remaining -= len(data)
+                    await httppool.limiter.consume(len(data))
+                    await write(data)
+        return producer
+
+    async def fetch(self, url, method, headers, path=None, part=None,
+                    body=None):
+        """send one request. request body is content of path (or its
+        part, (offset, length)), or body. returns response, with non-2xx
+        status as well. exceptions are raised for network errors. keys
+        are sent to S3 endpoint only, not to download_base."""
+        if self.test:
+            print('# %s %s' % (method, url), file=sys.stderr)
+            return FakeResponse(200)
+        hdrs = dict((k, http_header_value(v)) for k, v in headers)
+        if url.startswith(self.endpoint + '/'):
+            hdrs['authorization'] = self.auth_header
+        kwargs = {}
+        if path is not None:
+            offset, length = part or (0, os.path.getsize(path))
+            hdrs['Content-Length'] = str(length)
+            kwargs['body_producer'] = self.file_producer(path, offset, length)
+            kwargs['expect_100_continue'] = True
+        elif body is not None:
+            kwargs['body'] = body
+        req = HTTPRequest(url, method=method, headers=hdrs,
+                          connect_timeout=60, request_timeout=0,
+                          follow_redirects=(path is None and body is None),
+                          **kwargs)
+        token = await self.window.acquire()
+        try:
+            resp = await self.client.fetch(req, raise_error=False)
+        except Exception:
+            self.window.release(token, congested=True)
+            raise
+        self.window.release(token, resp.code, self.is_congested(resp))
+        return resp
+
+    def is_congested(self, resp):
+        """True if resp tells IAS3 is overloaded"""
+        if resp.code in uploadwindow.CONGESTION_CODES:
+            return True
+        return resp.code >= 400 and xml_text(resp.body, 'Code') == 'SlowDown'
+
+    def schedule_retry(self, s, retry_count):
+        retry_epoch = int(time.time()) + self.retry_delay
+        s.log("RETRY: attempt (%d) scheduled after %d seconds: %s" % (
+                retry_count, self.retry_delay,
+                time.strftime('%Y-%m-%dT%H:%M:%S%Z',
+                              time.localtime(retry_epoch))))
+        if not os.path.exists(s.RETRY):
+            with open(s.RETRY, 'w') as w:
+                w.write('%d\n' % retry_epoch)
+        if self.retries is not None:
+            try:
+                retry_epoch = int(read_first_line(s.RETRY))
+            except (OSError, ValueError):
+                pass
+            self.retries.schedule(s.dir, retry_epoch)
+        s.aborted = 'RETRY'
+        raise RetryScheduled(s.name)
+
+    async def backoff(self, s, slot=None, whole=True):
+        """wait for block_delay before retrying a request of series s,
+        without holding slot (semaphore held by the caller for the
+        request). if request is for a whole file (whole) and all files
+        left in the series are waiting, series slot is released as
+        well, to be taken again when the first wait is over."""
+        if slot is not None:
+            slot.release()
+        if whole:
+            s.blocked += 1
+            if s.slot is not None and not s.yielded and \
+                    s.blocked >= s.unfinished:
+                s.log("BLOCK: all files blocked, giving way to other series")
+                s.yielded = True
+                s.slot.release()
+        try:
+            await gen.sleep(self.block_delay)
+        finally:
+            if whole:
+                s.blocked -= 1
+            async with s.resume_lock:
+                if s.yielded:
+                    await s.slot.acquire()
+                    s.yielded = False
+            if slot is not None:
+                await slot.acquire()
+
+    async def request(self, s, filename, headers, path=None, method='PUT',
+                      query=None, part=None, body=None, giveup=(),
+                      slot=None):
+        """send request, retrying it as s3-launch-transfers.sh does:
+        blocking retry (after block_delay) on 4xx and 503 up to
+        max_block_count times, then non-blocking retry (RETRY file)
+        after retry_delay. returns successful response, or response
+        with status code in giveup. slot is given to others while
+        waiting for blocking retry (see backoff()).
+        """
+        url = '%s/%s/%s' % (self.endpoint, s.bucket, filename)
+        if query:
+            url += '?' + query
+        if part:
+            size = part[1]
+        elif path:
+            size = os.path.getsize(path)
+        else:
+            size = len(body or b'')
+        whole = part is None and query is None
+        while True:
+            retry_count = s.blocks.get(url, 0)
+            if retry_count > 0:
+                s.log("RETRY attempt (%d) %s" % (retry_count,
+                                                 time.strftime('%c')))
+            s.log("%s %s" % (method, url))
+            for k, v in headers:
+                s.log("  %s:%s" % (k, v))
+            try:
+                resp = await self.fetch(url, method, headers, path, part, body)
+            except Exception as ex:
+                s.log("ERROR: request failed: %s" % ex)
+                s.task(url, 0, 0, 0.0)
+                self.stats.record(self.endpoint, 0, 0, {})
+                s.blocks[url] = retry_count + 1
+                self.schedule_retry(s, retry_count + 1)
+            s.task(url, resp.code, size if resp.code < 300 else 0,
+                   resp.request_time or 0.0, resp.time_info)
+            if not self.test:
+                self.stats.record(self.endpoint, resp.code, size,
+                                  resp.time_info)
+            if resp.code in (200, 201):
+                s.log("SUCCESS: S3 %s succeeded with response_code: %d" % (
+                        method, resp.code))
+                return resp
+            if resp.code in giveup:
+                return resp
+            retry_count += 1
+            s.blocks[url] = retry_count
+            s.log("ERROR: S3 %s failed with response_code: %d at %s" % (
+                    method, resp.code,
+                    time.strftime('%Y-%m-%dT%H:%M:%S%Z')))
+            if resp.code == 503 or 400 <= resp.code < 500:
+                if retry_count > self.max_block_count:
+                    s.log("RETRY count (%d) exceeds max_block_count: %d" % (
+                            retry_count, self.max_block_count))
+                    self.schedule_retry(s, retry_count)
+                s.log("BLOCK: sleep for %d seconds..." % self.block_delay)
+                await self.backoff(s, slot, whole)
+                s.log("done sleeping at %s" % time.strftime(
+                        '%Y-%m-%dT%H:%M:%S%Z'))
+            else:
+                self.schedule_retry(s, retry_count)
+
+    async def make_bucket(self, s, files, num_warcs):
+        """create item with MANIFEST and metadata (auto-make-bucket)"""
+        headers = [h.split(':', 1) for h in itemmeta.item_metadata(
+                self.config, s.bucket, files, num_warcs, s.size_hint)]
+        s.echo("[item metadata]")
+        for k, v in headers:
+            s.echo("  %s = %s" % (re.sub(r'^x-archive.meta[^-]*-', '', k), v))
+        headers += [h.split(':', 1) for h in
+                    itemmeta.collection_headers(self.config)]
+        headers += [('x-archive-queue-derive', '0'),
+                    ('x-archive-auto-make-bucket', '1'),
+                    ('x-archive-size-hint', s.size_hint)]
+        s.log("Creating item: http://archive.org/details/%s" % s.bucket)
+        await self.request(s, 'MANIFEST.txt', headers, path=s.MANIFEST)
+        s.log("creating file: %s" % s.BUCKET_OK)
+        with open(s.BUCKET_OK, 'w') as w:
+            w.write(s.bucket + '\n')
+        s.log("item/bucket created successfully: %s" % s.bucket)
+
+    async def upload_file(self, s, i, nfiles, fn, checksum, derive):
+        """upload one file, verify ETag and write .tombstone"""
+        try:
+            await self.upload_file_slot(s, i, nfiles, fn, checksum, derive)
+        finally:
+            s.unfinished -= 1
+
+    async def upload_file_slot(self, s, i, nfiles, fn, checksum, derive):
+        async with s.slots:
+            if s.aborted:
+                return
+            tombstone = s.tombstone(fn)
+            s.log("----\n[%d/%d]: %s" % (i + 1, nfiles, fn))
+            if os.path.exists(tombstone):
+                s.log("tombstone exists, skipping upload: %s" % tombstone)
+                return
+            size = os.path.getsize(s.path(fn))
+            etag = s.journal.uploaded(fn, size, checksum)
+            if etag is not None:
+                s.log("uploaded before, skipping upload: %s ETag %s" % (
+                        fn, etag))
+            else:
+                headers = [('x-archive-auto-make-bucket', '1')]
+                if not derive:
+                    headers.append(('x-archive-queue-derive', '0'))
+                if self.is_multipart(s.path(fn)):
+                    etag = await self.upload_multipart(s, fn, checksum,
+                                                       headers)
+                else:
+                    if checksum != '-':
+                        headers.insert(0, ('Content-MD5', checksum))
+                    if not self.test:
+                        await self.sync(s.journal.record, fn,
+                                        SeriesJournal.SENDING, 0)
+                    resp = await self.request(s, fn, headers,
+                                              path=s.path(fn), slot=s.slots)
+                    etag = self.verify_etag(s, resp, checksum)
+                if not self.test:
+                    await self.sync(s.journal.record, fn,
+                                    SeriesJournal.UPLOADED, size, etag or '-')
+            download = '%s/%s/%s' % (self.download_base, s.bucket, fn)
+            s.log("writing download:\n  %s\ninto tombstone:\n  %s" % (
+                    download, tombstone))
+            with open(tombstone, 'w') as w:
+                w.write(download + '\n')
+            if not self.test:
+                await self.sync(s.journal.record, fn,
+                                SeriesJournal.VERIFIED, size, etag or '-')
+
+    def verify_etag(self, s, resp, checksum):
+        """returns ETag of resp, after checking it against checksum"""
+        etag = parse_etag(resp)
+        if checksum == '-':
+            s.log("Checksum is turned off")
+            return etag
+        if self.test:
+            return etag
+        if etag != checksum:
+            s.error("ERROR: bad ETag!")
+            s.error("  Content-MD5 request: '%s'" % checksum)
+            s.error("  ETag response      : '%s'" % etag)
+            s.aborted = 'ERROR'
+            raise SeriesError(s.name)
+        s.log("ETag OK: %s" % etag)
+        return etag
+
+    def is_multipart(self, path):
+        return (not self.test and self.multipart_threshold > 0 and
+                os.path.getsize(path) > self.multipart_threshold)
+
+    def abort_series(self, s, *msgs):
+        for msg in msgs:
+            s.error(msg)
+        s.aborted = 'ERROR'
+        raise SeriesError(s.name)
+
+    async def upload_multipart(self, s, fn, checksum, headers):
+        """upload file fn with multipart upload, resuming one recorded
+        in <fn>.multipart. headers are sent with initiate request.
+        returns MD5 of the file."""
+        path = s.path(fn)
+        size = os.path.getsize(path)
+        journal = PartJournal(path + '.multipart')
+        if journal.upload_id and journal.size != size:
+            s.log("file size changed, discarding multipart upload %s" %
+                  journal.upload_id)
+            journal.remove()
+            journal = PartJournal(journal.path)
+        if journal.upload_id:
+            s.log("resuming multipart upload %s: %d of %d parts done" % (
+                    journal.upload_id, len(journal.done),
+                    len(journal.parts)))
+        else:
+            s.log("computing md5 of %d byte parts: %s" % (
+                    self.part_size, path))
+            digest, parts = await IOLoop.current().run_in_executor(
+                None, hash_parts, path, self.part_size)
+            if checksum != '-' and digest != checksum:
+                self.abort_series(
+                    s, "ERROR: md5 does not match MANIFEST: %s" % path,
+                    "  MANIFEST: '%s'" % checksum,
+                    "  file    : '%s'" % digest)
+            resp = await self.request(s, fn, headers, method='POST',
+                                      query='uploads', body=b'')
+            upload_id = xml_text(resp.body, 'UploadId')
+            if not upload_id:
+                self.abort_series(s, "ERROR: no UploadId in response")
+            await self.sync(journal.start, upload_id, size, self.part_size,
+                            digest, parts)
+            s.log("initiated multipart upload %s: %d parts" % (
+                    upload_id, len(parts)))
+        qs = 'uploadId=%s' % quote(journal.upload_id, safe='')
+
+        def expired():
+            s.log("multipart upload %s is gone, starting over" %
+                  journal.upload_id)
+            journal.remove()
+            self.schedule_retry(s, 1)
+
+        slots = locks.Semaphore(self.concurrency)
+        async def upload_part(n):
+            async with slots:
+                if s.aborted:
+                    return
+                offset = (n - 1) * journal.part_size
+                length = min(journal.part_size, size - offset)
+                md5 = journal.parts[n - 1]
+                await self.sync(s.journal.record, fn, SeriesJournal.SENDING,
+                                offset)
+                resp = await self.request(
+                    s, fn, [('Content-MD5', md5)],
+                    path=path, part=(offset, length),
+                    query='partNumber=%d&%s' % (n, qs), giveup=(404,),
+                    slot=slots)
+                if resp.code == 404:
+                    expired()
+                etag = parse_etag(resp)
+                if etag != md5:
+                    self.abort_series(
+                        s, "ERROR: bad ETag for part %d!" % n,
+                        "  Content-MD5 request: '%s'" % md5,
+                        "  ETag response      : '%s'" % etag)
+                await self.sync(journal.complete, n, etag)
+
+        results = await asyncio.gather(*[
+                upload_part(n) for n in journal.pending()],
+                return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+        if s.aborted:
+            # by other uploads of the series
+            raise (RetryScheduled if s.aborted == 'RETRY' else
+                   SeriesError)(s.name)
+
+        body = ['<CompleteMultipartUpload>']
+        for n in range(1, len(journal.parts) + 1):
+            body.append('<Part><PartNumber>%d</PartNumber>'
+                        '<ETag>"%s"</ETag></Part>' % (n, journal.done[n]))
+        body.append('</CompleteMultipartUpload>')
+        resp = await self.request(s, fn, [], method='POST', query=qs,
+                                  body=''.join(body).encode(),
+                                  giveup=(404,))
+        if resp.code == 404:
+            expired()
+        if xml_text(resp.body, 'Code'):
+            # S3 may report failure of completion in 200 response
+            s.log("ERROR: completing multipart upload failed: %s" %
+                  xml_text(resp.body, 'Message'))
+            self.schedule_retry(s, 1)
+        # server verified each part against its Content-MD5, and part
+        # MD5s have been computed in the same read as the file MD5
+        # checked against MANIFEST above.
+        expected = multipart_etag(journal.parts)
+        etag = (xml_text(resp.body, 'ETag') or '').strip('"') or \
+            parse_etag(resp)
+        if etag and etag != expected:
+            self.abort_series(
+                s, "ERROR: bad ETag of multipart upload!",
+                "  expected: '%s'" % expected,
+                "  ETag response: '%s'" % etag)
+        s.log("multipart upload OK: %s md5 %s" % (etag, journal.md5))
+        journal.remove()
+        return journal.md5
+
+    async def remote_inventory(self, s):
+        """{name: (size, md5)} of files in item of series s, from its
+        files.xml. empty if the item or files.xml is not there (yet)."""
+        url = '%s/%s/%s_files.xml' % (self.download_base, s.bucket,
+                                       s.bucket)
+        s.log("fetching item inventory: %s" % url)
+        try:
+            resp = await self.fetch(url, 'GET', [])
+        except Exception as ex:
+            s.log("  failed: %s" % ex)
+            return {}
+        if resp.code != 200:
+            s.log("  failed with response_code: %d" % resp.code)
+            return {}
+        try:
+            return parse_files_xml(resp.body)
+        except ElementTree.ParseError as ex:
+            s.log("  bad files.xml: %s" % ex)
+            return {}
+
+    async def skip_remote(self, s, files):
+        """write .tombstone for files (list of (md5, filename)) already
+        stored in the item with the same size and md5. files whose
+        md5 is unknown ('-') are left alone."""
+        pending = [(checksum, fn) for checksum, fn in files
+                   if checksum != '-' and
+                   not os.path.exists(s.tombstone(fn))]
+        if not pending:
+            return
+        remote = await self.remote_inventory(s)
+        for checksum, fn in pending:
+            size = os.path.getsize(s.path(fn))
+            if remote.get(fn) != (size, checksum):
+                continue
+            tombstone = s.tombstone(fn)
+            download = '%s/%s/%s' % (self.download_base, s.bucket, fn)
+            s.log("found in item, skipping upload: %s" % fn)
+            s.log("writing download:\n  %s\ninto tombstone:\n  %s" % (
+                    download, tombstone))
+            with open(tombstone, 'w') as w:
+                w.write(download + '\n')
+            await self.sync(s.journal.record, fn, SeriesJournal.VERIFIED,
+                            size, checksum)
+
+    def check_retry(self, s):
+        """handle RETRY file. returns False if series is not due yet."""
+        if self.retries is not None:
+            # series known to be waiting is skipped without reading RETRY
+            retry_time = self.retries.deadline(s.dir)
+            if retry_time is not None and time.time() < retry_time:
+                return False
+        if not os.path.exists(s.RETRY):
+            return True
+        try:
+            retry_time = int(read_first_line(s.RETRY))
+        except (OSError, ValueError):
+            retry_time = 0
+        s.log("RETRY file exists: %s [%d]" % (s.RETRY, retry_time))
+        now = int(time.time())
+        if now < retry_time:
+            s.log("  RETRY delay (now=%d < retry_time=%d)" % (now, retry_time))
+            s.log("    skipping series: %s" % s.name)
+            return False
+        s.log("  RETRY OK (now=%d > retry_time=%d)" % (now, retry_time))
+        s.log("  moving aside RETRY file")
+        s.close_log()
+        os.rename(s.RETRY, '%s.%d' % (s.RETRY, retry_time))
+        if self.retries is not None:
+            self.retries.cancel(s.dir)
+        s.echo("moving aside blocking files")
+        for blocker in (s.OPEN, s.ERROR, s.TASK):
+            if os.path.isfile(blocker):
+                s.echo("mv %s %s.%d" % (blocker, blocker, retry_time))
+                os.rename(blocker, '%s.%d' % (blocker, retry_time))
+        return True
+
+    def is_ready(self, s):
+        """True if series s has MANIFEST and is not locked"""
+        if not os.path.exists(s.MANIFEST):
+            return False
+        if not self.check_retry(s):
+            return False
+        if os.path.exists(s.ERROR):
+            self.echo("%s: ERROR file exists" % s.dir)
+            return False
+        for lock in (s.OPEN, s.LAUNCH, s.TASK):
+            if os.path.exists(lock):
+                return False
+        return True
+
+    def write_success(self, s, manifest):
+        """write SUCCESS and TOMBSTONE if all files in manifest have
+        .tombstone. raises SeriesError if not."""
+        if os.path.exists(s.ERROR):
+            s.log("ERROR file exists, could not write SUCCESS file.")
+            return False
+        for checksum, fn in manifest:
+            if not os.path.isfile(s.tombstone(fn)):
+                s.log("ERROR: missing tombstone: %s" % s.path(fn))
+                shutil.copy(s.OPEN, s.ERROR)
+                raise SeriesError(s.name)
+        s.log("copying TASK file:\n    %s\nto SUCCESS file:\n    %s" % (
+                s.TASK, s.SUCCESS))
+        if os.path.exists(s.TASK):
+            shutil.copy(s.TASK, s.SUCCESS)
+        else:
+            open(s.SUCCESS, 'w').close()
+        s.log("compiling TOMBSTONE:\n    %s" % s.TOMBSTONE)
+        with open(s.TOMBSTONE, 'a') as w:
+            for t in sorted(glob.glob(os.path.join(s.dir, '*.tombstone'))):
+                with open(t) as f:
+                    w.write(f.read())
+        return True
+
+    async def upload_series(self, d, slot=None):
+        """upload series in directory d. returns True if launched
+        (LAUNCH written), False on failure, None if series is not ready.
+        slot is a semaphore the caller holds for the series, which is
+        released while all its files wait for blocking retry, and held
+        again on return.
+        """
+        s = UploadSeries(d, self.out)
+        s.slot = slot
+        try:
+            return await self.upload_open_series(s)
+        finally:
+            s.close_log()
+
+    async def upload_open_series(self, s):
+        if not self.is_ready(s):
+            return None
+        s.log("==== %s ====" % s.name)
+        s.log("crawldata: %s" % s.dir)
+        for k in ('MANIFEST', 'OPEN', 'TASK', 'SUCCESS', 'TOMBSTONE'):
+            s.log("  %-10s %s" % (k + ':', getattr(s, k)))
+
+        s.log("parsing MANIFEST:\n  %s" % s.MANIFEST)
+        manifest = s.read_manifest()
+        files = []
+        for checksum, fn in manifest:
+            if os.path.isfile(s.path(fn)):
+                files.append((checksum, fn))
+            elif not os.path.isfile(s.tombstone(fn)):
+                # allow for re-uploading some files after the itemdir
+                # has been cleaned.
+                s.log("ERROR: file not found: %s" % s.path(fn))
+                s.log("Aborting!")
+                shutil.copy(s.OPEN, s.ERROR)
+                return False
+        s.log("  nfiles_manifest = %d" % len(manifest))
+        if not self.test:
+            await self.sync(s.journal.start,
+                            [fn for checksum, fn in manifest])
+            counts = s.journal.counts()
+            s.log("  journal: %s" % ', '.join(
+                    '%s %d' % (state, counts.get(state, 0)) for state in (
+                        SeriesJournal.PENDING, SeriesJournal.SENDING,
+                        SeriesJournal.UPLOADED, SeriesJournal.VERIFIED)))
+
+        try:
+            if not files:
+                s.log("%s: no files to upload" % s.name)
+            elif os.path.exists(s.BUCKET_OK):
+                s.echo("BUCKET_OK exists, skipping auto-make-bucket")
+                if self.remote_resume and not self.test:
+                    await self.skip_remote(s, files)
+            else:
+                # bucket check (HEAD) of s3-launch-transfers.sh is skipped
+                # when BUCKET_OK exists, which is always the case after
+                # successful auto-make-bucket.
+                s.unfinished = 1
+                await self.make_bucket(
+                    s, [s.path(fn) for c, fn in files], len(manifest))
+
+            s.log("----\nUploading (%d) warcs with size hint: %s bytes" % (
+                    len(manifest), s.size_hint))
+            # turn on derive on the last file UNLESS derive is disabled.
+            # the last file is uploaded after all others have completed, so
+            # that derive runs on the complete item.
+            s.slots = locks.Semaphore(self.concurrency)
+            nfiles = len(files)
+            s.unfinished = max(nfiles - 1, 0)
+            results = await asyncio.gather(*[
+                    self.upload_file(s, i, nfiles, fn, checksum, False)
+                    for i, (checksum, fn) in enumerate(files[:-1])],
+                    return_exceptions=True)
+            for r in results:
+                if isinstance(r, Exception) and \
+                        not isinstance(r, (RetryScheduled, SeriesError)):
+                    raise r
+            if files and not s.aborted:
+                s.unfinished = 1
+                checksum, fn = files[-1]
+                await self.upload_file(s, nfiles - 1, nfiles, fn, checksum,
+                                       self.derive == 1)
+        except (RetryScheduled, SeriesError):
+            pass
+        if s.aborted:
+            s.log("Aborting warc_series: %s" % s.name)
+            return False
+
+        try:
+            self.write_success(s, manifest)
+        except SeriesError:
+            return False
+        s.echo("mv open file to LAUNCH: %s" % s.LAUNCH)
+        s.close_log()
+        os.rename(s.OPEN, s.LAUNCH)
+        self.launch_count += 1
+        return True
+
+    def ready_series(self):
+        for name in sorted(os.listdir(self.xfer_dir)):
+            d = os.path.join(self.xfer_dir, name)
+            if os.path.isdir(d) and os.path.exists(os.path.join(d, 'MANIFEST')):
+                yield d
+
+    def open(self, mode='all'):
+        """get ready for upload_series() on current IOLoop"""
+        self.test = (mode == 'test')
+        # shared by all S3Uploaders (and Verifiers) on this IOLoop, with
+        # the largest max_clients asked for
+        self.client = httppool.KeepAliveHTTPClient(
+            max_clients=self.max_connections)
+
+    async def run(self, mode='all'):
+        self.echo("%s %s" % (os.path.basename(__file__), time.strftime('%c')))
+        self.open(mode)
+        try:
+            if mode in ('single', 'test'):
+                for d in self.ready_series():
+                    if await self.upload_series(d):
+                        self.echo("mode = %s, exiting normally." % mode)
+                        break
+            else:
+                slots = locks.Semaphore(self.series_concurrency)
+                async def upload(d):
+                    async with slots:
+                        return await self.upload_series(d, slots)
+                await asyncio.gather(*[upload(d)
+                                       for d in self.ready_series()])
+        finally:
+            self.echo("connections: %s" % self.client.pool.summary())
+            self.echo("requests: %s" % uploadstats.summary(
+                    self.stats.total))
+            self.echo("window: %s" % self.window.summary())
+        self.echo("%d buckets filled" % self.launch_count)
+        self.echo("%s done. %s" % (os.path.basename(__file__),
+                                   time.strftime('%c')))
+        return self.launch_count
+
+def main(conf, mode='all', out=None, stats=None, window=None):
+    """upload series for DrainConfig conf. requests are recorded in
+    uploadstats.UploadStats stats, and limited by
+    uploadwindow.AdaptiveWindow window, if given. returns exit
+    status."""
+    try:
+        uploader = S3Uploader(conf, out=out, stats=stats, window=window)
+        httppool.run_sync(uploader.run(mode=mode))
+    except (UploadError, OSError) as ex:
+        print("ERROR: %s" % ex, file=out or sys.stdout)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    try:
+        conf.validate()
+    except ValueError as ex:
+        print("ERROR: invalid config: %s: %s" % (sys.argv[1], ex))
+        sys.exit(1)
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'all'
+    sys.exit(main(conf, mode=mode))
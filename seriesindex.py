@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""index of series states in xfer_dir, in SQLite
+Usage: seriesindex.py xfer_job_dir [rebuild | series ...]
+
+state of a series is the set of marker files in its directory (PACKED,
+MANIFEST(.open), LAUNCH(.open), TASK, SUCCESS, ERROR, TOMBSTONE, RETRY,
+CLEAN...), along with RETRY time and W/ARC counts. SeriesIndex keeps it
+in xfer_dir/.seriesindex.db, keyed by series name, so that dtmon.py
+and its admin page look up a series with a query, instead of probing
+each marker file.
+
+each row is written from a single scandir of the series directory
+when the series is refreshed: pipeline.py does this after each step on
+a series, and the index is rebuilt from marker files when dtmon.py
+starts, so that it recovers from crash. rows also record mtime of the
+series directory. as marker files are created and renamed, a row with
+different mtime is out of date and is refreshed on lookup, which keeps
+the index right for steps run outside dtmon.py. likewise, series are
+added and removed when mtime of xfer_dir changes.
+
+with series names, prints their state. with rebuild, rebuilds the
+index. without either, prints state of all series.
+"""
+
+import sys, os, re
+import sqlite3
+import threading
+
+INDEX_NAME = '.seriesindex.db'
+
+# marker files recorded in the index
+MARKERS = frozenset([
+        'PACKED', 'PACKED.open', 'MANIFEST', 'MANIFEST.open', 'LAUNCH',
+        'LAUNCH.open', 'TASK', 'TASK.open', 'SUCCESS', 'ERROR', 'TOMBSTONE',
+        'TOMBSTONE.open', 'RETRY', 'BUCKET_OK', 'CLEAN', 'CLEAN.open',
+        'CLEAN.err'])
+
+WARC_RE = re.compile(r'.*\.w?arc(\.gz)?$')
+TOMBSTONE_RE = re.compile(r'.*\.w?arc(\.gz)?\.tombstone$')
+
+# bumped when table schema changes. index is rebuilt then.
+SCHEMA_VERSION = 2
+
+SCHEMA = ("""
+CREATE TABLE IF NOT EXISTS series (
+  name TEXT PRIMARY KEY,
+  mtime REAL NOT NULL,
+  markers TEXT NOT NULL,
+  retry TEXT,
+  warcs INTEGER NOT NULL,
+  warcs_done INTEGER NOT NULL,
+  status TEXT NOT NULL
+)""", """
+CREATE INDEX IF NOT EXISTS series_mtime ON series (mtime, name)
+""")
+
+COLUMNS = 'name, mtime, markers, retry, warcs, warcs_done'
+INSERT = ('INSERT OR REPLACE INTO series (%s, status)'
+          ' VALUES (?, ?, ?, ?, ?, ?, ?)' % COLUMNS)
+
+# status filters of iter(): SQL condition on a row and the same test on
+# SeriesState (for rows refreshed while iterating)
+def _marker_sql(marker):
+    return "' ' || markers || ' ' LIKE '%% %s %%'" % marker
+
+STATUS_FILTERS = {
+    'completed': ("status = 'completed'", lambda st: st.status == 'completed'),
+    'active': ("status != 'completed'", lambda st: st.status != 'completed'),
+    'running': ("status = 'running'", lambda st: st.status == 'running'),
+    'retry': (_marker_sql('RETRY'), lambda st: st.has('RETRY')),
+    'error': (_marker_sql('ERROR'), lambda st: st.has('ERROR')),
+    }
+
+# rows fetched at a time by iter()
+BATCH_SIZE = 256
+
+class SeriesState(object):
+    """state of one series, as recorded in the index. a snapshot, not
+    to be modified: a new one is made when the series changes."""
+    __slots__ = ('name', 'mtime', 'markers', 'retry', 'warcs', 'warcs_done')
+
+    def __init__(self, name, mtime, markers, retry, warcs, warcs_done):
+        self.name = name
+        self.mtime = mtime
+        self.markers = frozenset(markers.split())
+        self.retry = retry
+        self.warcs = warcs
+        self.warcs_done = warcs_done
+
+    def has(self, marker):
+        return marker in self.markers
+
+    @property
+    def status(self):
+        """'completed', 'running' or ''"""
+        if 'SUCCESS' in self.markers:
+            return 'completed'
+        if 'RETRY' not in self.markers and (
+            'LAUNCH.open' in self.markers or 'MANIFEST.open' in self.markers):
+            return 'running'
+        return ''
+
+    def row(self):
+        return (self.name, self.mtime, ' '.join(sorted(self.markers)),
+                self.retry, self.warcs, self.warcs_done, self.status)
+
+    def __repr__(self):
+        return '<SeriesState %s %s>' % (self.name,
+                                        ' '.join(sorted(self.markers)))
+
+def scan_series(d):
+    """SeriesState of series directory d from its marker files, or None
+    if d does not exist."""
+    markers = []
+    warcs = warcs_done = 0
+    retry = None
+    try:
+        # mtime is taken before scan. if the directory changes during
+        # the scan, the row is refreshed at the next lookup.
+        mtime = os.stat(d).st_mtime
+        with os.scandir(d) as entries:
+            for e in entries:
+                fn = e.name
+                if fn in MARKERS:
+                    if e.is_file():
+                        markers.append(fn)
+                elif WARC_RE.match(fn):
+                    warcs += 1
+                elif TOMBSTONE_RE.match(fn):
+                    warcs_done += 1
+    except OSError:
+        return None
+    if 'RETRY' in markers:
+        try:
+            with open(os.path.join(d, 'RETRY')) as f:
+                retry = f.read().rstrip()
+        except OSError:
+            retry = '?'
+    return SeriesState(os.path.basename(d), mtime, ' '.join(markers), retry,
+                       warcs, warcs_done)
+
+class SeriesIndex(object):
+    def __init__(self, xfer_dir, path=None):
+        self.xfer_dir = xfer_dir
+        self.path = path or os.path.join(xfer_dir, INDEX_NAME)
+        self.lock = threading.Lock()
+        # mtime of xfer_dir when series were last added/removed
+        self.xfer_mtime = None
+        try:
+            self.db = self.connect(self.path)
+        except sqlite3.Error as ex:
+            # index can always be rebuilt. keep it in memory if it
+            # cannot be written to xfer_dir.
+            print("%s: %s, using in-memory index" % (self.path, ex),
+                  file=sys.stderr)
+            self.path = ':memory:'
+            self.db = self.connect(self.path)
+
+    def connect(self, path):
+        # shared by pipeline stages running in executor threads,
+        # serialized with self.lock.
+        db = sqlite3.connect(path, check_same_thread=False,
+                             isolation_level=None)
+        # WAL keeps journal files in place, so that writes do not
+        # change mtime of xfer_dir.
+        db.execute('PRAGMA journal_mode = WAL')
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            db.execute('DROP TABLE IF EXISTS series')
+            db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        for stmt in SCHEMA:
+            db.execute(stmt)
+        return db
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def series_dir(self, name):
+        return os.path.join(self.xfer_dir, name)
+
+    def store(self, state):
+        with self.lock:
+            self.db.execute(INSERT, state.row())
+
+    def remove(self, name):
+        with self.lock:
+            self.db.execute('DELETE FROM series WHERE name = ?', (name,))
+
+    def refresh(self, name):
+        """re-read state of series name from its marker files. returns
+        SeriesState, or None if the series is gone."""
+        name = os.path.basename(name)
+        state = scan_series(self.series_dir(name))
+        if state is None:
+            self.remove(name)
+        else:
+            self.store(state)
+        return state
+
+    def rebuild(self):
+        """rebuild the whole index from marker files in xfer_dir"""
+        states = []
+        try:
+            self.xfer_mtime = os.stat(self.xfer_dir).st_mtime
+            names = os.listdir(self.xfer_dir)
+        except OSError:
+            names = []
+        for name in names:
+            d = self.series_dir(name)
+            if os.path.isdir(d):
+                state = scan_series(d)
+                if state:
+                    states.append(state.row())
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('DELETE FROM series')
+                self.db.executemany(INSERT, states)
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        return len(states)
+
+    def names(self):
+        with self.lock:
+            return set(r[0] for r in self.db.execute(
+                    'SELECT name FROM series').fetchall())
+
+    def sync(self):
+        """add and remove series created and removed in xfer_dir outside
+        of the index, if xfer_dir has changed."""
+        try:
+            mtime = os.stat(self.xfer_dir).st_mtime
+            if mtime == self.xfer_mtime:
+                return
+            names = set(name for name in os.listdir(self.xfer_dir)
+                        if os.path.isdir(self.series_dir(name)))
+        except OSError:
+            return
+        indexed = self.names()
+        for name in names - indexed:
+            self.refresh(name)
+        for name in indexed - names:
+            self.remove(name)
+        self.xfer_mtime = mtime
+
+    def is_current(self, state):
+        try:
+            return os.stat(self.series_dir(state.name)).st_mtime == \
+                state.mtime
+        except OSError:
+            return False
+
+    def get(self, name):
+        """SeriesState of series name, or None if there is no such
+        series"""
+        with self.lock:
+            row = self.db.execute('SELECT %s FROM series WHERE name = ?' %
+                                  COLUMNS, (name,)).fetchone()
+        state = row and SeriesState(*row)
+        if state is None or not self.is_current(state):
+            return self.refresh(name)
+        return state
+
+    def iter(self, status=None, limit=None, offset=0):
+        """yields SeriesState of series, most recently updated first.
+        status is one of STATUS_FILTERS keys. rows are read BATCH_SIZE
+        at a time, and series changed since indexed are refreshed as
+        they are yielded (and skipped if no longer matching status)."""
+        if status and status not in STATUS_FILTERS:
+            raise ValueError('unknown status %r' % status)
+        self.sync()
+        cond, match = STATUS_FILTERS[status] if status else ('1', None)
+        remaining = limit
+        last = None
+        while remaining is None or remaining > 0:
+            n = BATCH_SIZE if remaining is None else min(BATCH_SIZE,
+                                                         remaining)
+            # offset applies to the first batch. later ones continue
+            # from the last row, in (mtime DESC, name) order.
+            if last is None:
+                where, params = cond, (n, offset)
+            else:
+                where = ('(%s) AND (mtime < ? OR (mtime = ? AND name > ?))' %
+                         cond)
+                params = (last[0], last[0], last[1], n, 0)
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT %s FROM series WHERE %s ORDER BY mtime DESC,'
+                    ' name LIMIT ? OFFSET ?' % (COLUMNS, where),
+                    params).fetchall()
+            for row in rows:
+                state = SeriesState(*row)
+                if not self.is_current(state):
+                    state = self.refresh(state.name)
+                    if state is None or (match and not match(state)):
+                        continue
+                yield state
+            if len(rows) < n:
+                break
+            last = (rows[-1][1], rows[-1][0])
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def all(self):
+        """SeriesState of all series, most recently updated first"""
+        return list(self.iter())
+
+    def count(self, status=None):
+        """number of series with status (as of last refresh)"""
+        self.sync()
+        cond = STATUS_FILTERS[status][0] if status else '1'
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM series WHERE %s' %
+                                   cond).fetchone()[0]
+
+    def with_marker(self, marker):
+        """names of series that have marker file (as of last refresh)"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name FROM series WHERE ' ' || markers || ' '"
+                " LIKE ? ORDER BY name", ('% ' + marker + ' %',)).fetchall()
+        return [r[0] for r in rows]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM series').fetchone()[0]
+
+def format_state(state):
+    return '%s %d/%d %s%s' % (state.name, state.warcs, state.warcs_done,
+                              ' '.join(sorted(state.markers)),
+                              ' RETRY=%s' % state.retry if state.retry else '')
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    index = SeriesIndex(sys.argv[1])
+    args = sys.argv[2:]
+    if args == ['rebuild']:
+        print("%d series indexed" % index.rebuild())
+    elif args:
+        rc = 0
+        for name in args:
+            state = index.get(name)
+            if state is None:
+                print("%s: no such series" % name, file=sys.stderr)
+                rc = 1
+            else:
+                print(format_state(state))
+        sys.exit(rc)
+    else:
+        for state in index.all():
+            print(format_state(state))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""sample W/ARCs and disk space of job_dir in background
+Usage: sourcestats.py config
+    config  a YAML config file
+
+SourceSampler keeps a snapshot of W/ARC count and total size in
+job_dir, free and total space of its disk, and the rate the disk is
+filling up at, refreshed every source_sample_interval seconds (60 by
+default). dtmon.py admin page shows the snapshot, instead of listing
+job_dir and stat-ing every W/ARC for each page view.
+
+W/ARC sizes are remembered by name. job_dir is listed again only when
+its mtime has changed, and only W/ARCs new since the last listing are
+stat-ed; finished W/ARCs do not change size.
+"""
+
+import sys, os, re
+import threading
+import time
+
+import config
+
+WARC_RE = re.compile(r'.*\.w?arc(\.gz)?$')
+
+# default for source_sample_interval config parameter (seconds)
+DEFAULT_INTERVAL = 60
+
+# weight of the latest sample in fill_rate (exponential moving average)
+FILL_RATE_WEIGHT = 0.3
+
+class SourceStats(object):
+    """snapshot of job_dir. fill_rate is bytes/s of disk space used,
+    None until two samples have been taken."""
+    __slots__ = ('exists', 'free', 'total', 'warcs', 'warcs_size',
+                 'fill_rate', 'time')
+
+    def __init__(self, exists, free=0, total=0, warcs=0, warcs_size=0,
+                 fill_rate=None, sampled=None):
+        self.exists = exists
+        self.free = free
+        self.total = total
+        self.warcs = warcs
+        self.warcs_size = warcs_size
+        self.fill_rate = fill_rate
+        self.time = sampled or time.time()
+
+class SourceSampler(threading.Thread):
+    def __init__(self, job_dir, interval=None):
+        threading.Thread.__init__(self, name='sourcestats', daemon=True)
+        self.job_dir = job_dir
+        self.interval = interval or DEFAULT_INTERVAL
+        self.sizes = {}
+        self.dir_mtime = None
+        self.stopped = threading.Event()
+        # first sample is taken right away, so that there always is one.
+        self.snapshot = None
+        self.sample()
+
+    def scan(self):
+        """update self.sizes if job_dir has changed"""
+        mtime = os.stat(self.job_dir).st_mtime
+        if mtime == self.dir_mtime:
+            return
+        sizes = {}
+        with os.scandir(self.job_dir) as entries:
+            for e in entries:
+                if not WARC_RE.match(e.name):
+                    continue
+                size = self.sizes.get(e.name)
+                if size is None:
+                    try:
+                        size = e.stat().st_size
+                    except OSError:
+                        continue
+                sizes[e.name] = size
+        self.sizes = sizes
+        self.dir_mtime = mtime
+
+    def sample(self):
+        """take a new snapshot"""
+        now = time.time()
+        try:
+            self.scan()
+            st = os.statvfs(self.job_dir)
+        except OSError:
+            self.sizes = {}
+            self.dir_mtime = None
+            self.snapshot = SourceStats(False, sampled=now)
+            return self.snapshot
+        free = st.f_bfree * st.f_bsize
+        total = st.f_blocks * st.f_bsize
+        prev = self.snapshot
+        fill_rate = None
+        if prev and prev.exists and now > prev.time:
+            rate = float(prev.free - free) / (now - prev.time)
+            if prev.fill_rate is None:
+                fill_rate = rate
+            else:
+                fill_rate = (FILL_RATE_WEIGHT * rate +
+                             (1 - FILL_RATE_WEIGHT) * prev.fill_rate)
+        # a new object, so that readers never see half-updated snapshot
+        self.snapshot = SourceStats(True, free, total, len(self.sizes),
+                                    sum(self.sizes.values()), fill_rate, now)
+        return self.snapshot
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+
+def format_stats(s):
+    if not s.exists:
+        return "job_dir does not exist"
+    return ("%d W/ARCs (%.2fGB), free %.2fGB/%.2fGB%s" % (
+            s.warcs, s.warcs_size / 1024.0**3, s.free / 1024.0**3,
+            s.total / 1024.0**3, '' if s.fill_rate is None else
+            ', filling %.2fMB/s' % (s.fill_rate / 1024.0**2)))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    sampler = SourceSampler(conf['job_dir'], conf['source_sample_interval'])
+    print(time.strftime('%c'), format_stats(sampler.snapshot))
+    try:
+        while True:
+            time.sleep(sampler.interval)
+            print(time.strftime('%c'), format_stats(sampler.sample()))
+    except KeyboardInterrupt:
+        pass
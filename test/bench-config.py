@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+"""compare time for reading config in shell scripts: one config.py
+per parameter (as s3-launch-transfers.sh used to do) vs. a single
+config.py --export-shell.
+Usage: bench-config.py [runs]
+"""
+
+import sys
+import os
+import subprocess
+import time
+
+from testutils import *
+
+# config.py calls made by s3-launch-transfers.sh for a single series,
+# before --export-shell.
+PARAMS = [[], ['s3cfg'], ['xfer_dir'], ['crawljob'], ['crawlhost'],
+          ['warc_name_pattern_upload'], ['title_prefix'], ['block_delay'],
+          ['max_block_count'], ['retry_delay'], ['derive'],
+          ['-m', 'metadata'], ['description'], ['collections']]
+
+def per_param(configpath):
+    for args in PARAMS:
+        subprocess.check_output([bin('config.py'), configpath] + args)
+
+def export_shell(configpath):
+    subprocess.check_output([bin('config.py'), '--export-shell',
+                             '--prefix=conf_', configpath])
+
+def bench(f, configpath, runs):
+    t0 = time.time()
+    for i in range(runs):
+        f(configpath)
+    return (time.time() - t0) / runs
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    ws = TestSpace(TESTCONF)
+    ws.write_s3cfg()
+    t_param = bench(per_param, ws.configpath, runs)
+    t_export = bench(export_shell, ws.configpath, runs)
+    print("%d config.py calls: %.3fs" % (len(PARAMS), t_param))
+    print("1 config.py --export-shell: %.3fs" % t_export)
+    print("%.1fx faster" % (t_param / t_export))
@@ -3,14 +3,17 @@
 import sys
 import os
 import re
+import json
 import unittest
 import subprocess
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import NamedTemporaryFile, mkdtemp
 from io import StringIO
 
 sys.path.append(os.path.abspath(
     os.path.join(os.path.dirname(__file__), "../")))
 
+import config
 from config import DrainConfig
 
 # job_dir and xfer_dir have"/tmp" to keep validate() happy.
@@ -227,5 +230,93 @@ class ConfigTestCase(unittest.TestCase):
 
         self.assertRaises(ValueError, cf.validate)
 
+    def testExportShell(self):
+        """--export-shell values are the same as config.py prints for
+        each param"""
+        cf = self._conf(TESTCONF_1 + "title_prefix: \"it's $HOME `x`\"\n")
+        f = StringIO()
+        cf.export_shell(prefix='conf_', out=f)
+        for param, fmt in (('title_prefix', None), ('xfer_dir', None),
+                           ('collections', None), ('derive', None),
+                           ('item_name_template_sh', None),
+                           ('description', None), ('metadata', 'header')):
+            out = subprocess.check_output(
+                ['bash', '-c', f.getvalue() + 'echo "$conf_' + param + '"'])
+            expected = StringIO()
+            cf.pprint(param, format=fmt, out=expected)
+            self.assertEqual(expected.getvalue(), out.decode('utf-8'), param)
+
+    def testExportJson(self):
+        cf = self._conf(TESTCONF_1)
+        f = StringIO()
+        cf.export_json(out=f)
+        params = json.loads(f.getvalue())
+        self.assertEqual('webwidecrawl/widecrawl/wide00004',
+                         params['collections'])
+        self.assertEqual('Other Sponsor', params['metadata']['sponsor'])
+        self.assertEqual(10, params['max_size'])
+        self.assertEqual(cf['item_name_template'],
+                         params['item_name_template'])
+
+class ConfigCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'warcs'))
+        self.path = os.path.join(self.dir, 'drain.yml')
+        self.write(TESTCONF_1.replace('/tmp', 'warcs'))
+        config.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, s, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(s)
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def testCacheHit(self):
+        cf = DrainConfig(self.path)
+        cf.validate()
+        # cfg of each DrainConfig is a copy, modifying it does not
+        # affect others.
+        cf.cfg['sleep_time'] = 1
+        yaml_load = config.yaml_loader.load
+        def fail(*args, **kwargs):
+            raise AssertionError('config parsed again')
+        config.yaml_loader.load = fail
+        try:
+            cf2 = DrainConfig(self.path)
+        finally:
+            config.yaml_loader.load = yaml_load
+        self.assertEqual(300, cf2['sleep_time'])
+        # directories are not checked again
+        os.rmdir(os.path.join(self.dir, 'warcs'))
+        self.assertTrue(cf2.validate())
+
+    def testCacheModifiedCfg(self):
+        """validation is not skipped for cfg modified after loading"""
+        DrainConfig(self.path).validate()
+        cf = DrainConfig(self.path)
+        cf.cfg['sleep_time'] = 'x'
+        self.assertRaises(ValueError, cf.validate)
+
+    def testCacheInvalidated(self):
+        st = os.stat(self.path)
+        cf = DrainConfig(self.path)
+        cf.validate()
+        # same size, different mtime
+        self.write(TESTCONF_1.replace('/tmp', 'warcs').replace(
+                'sleep_time: 300', 'sleep_time: 301'), st.st_mtime + 10)
+        cf = DrainConfig(self.path)
+        self.assertEqual(301, cf['sleep_time'])
+        # same mtime, different size
+        self.write(TESTCONF_1.replace('/tmp', 'warcs').replace(
+                'sleep_time: 300', 'sleep_time: 3000'), st.st_mtime + 10)
+        cf = DrainConfig(self.path)
+        self.assertEqual(3000, cf['sleep_time'])
+        os.rmdir(os.path.join(self.dir, 'warcs'))
+        self.assertRaises(ValueError, cf.validate)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import threading
+import time
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import dtmon
+import seriesindex
+
+def wait_for(cond, timeout=10):
+    limit = time.time() + timeout
+    while not cond():
+        if time.time() > limit:
+            return False
+        time.sleep(0.01)
+    return True
+
+class UpLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.spaces = [TestSpace(TESTCONF) for i in range(2)]
+        for ws in self.spaces:
+            open(os.path.join(ws.jobdir, 'DRAINME'), 'w').close()
+        self.drains = [0, 0]
+
+    def patch_min_retry_sleep(self, v):
+        saved = dtmon.MIN_RETRY_SLEEP
+        dtmon.MIN_RETRY_SLEEP = v
+        self.addCleanup(setattr, dtmon, 'MIN_RETRY_SLEEP', saved)
+
+    def start(self, sleep, drain, retry=None):
+        dt = dtmon.UpLoader([ws.configpath for ws in self.spaces],
+                            sleep=sleep)
+        for pj in dt.projects:
+            pj.start_drain_job = (lambda pj=pj: drain(pj))
+            if retry:
+                pj.start_retry_job = (lambda pj=pj: retry(pj))
+        threading.Thread(target=dt.run, daemon=True).start()
+        return dt
+
+    def testIndependent(self):
+        """project blocked in drain does not hold up other projects"""
+        release = threading.Event()
+        def drain(pj):
+            self.drains[pj.id] += 1
+            if pj.id == 0:
+                release.wait()
+        self.start(0.01, drain)
+        assert wait_for(lambda: self.drains[1] >= 3)
+        self.assertEqual(1, self.drains[0])
+        release.set()
+        assert wait_for(lambda: self.drains[0] >= 2)
+
+    def testWakeup(self):
+        """each project sleeps for its own sleep_time until woken up"""
+        def drain(pj):
+            self.drains[pj.id] += 1
+        dt = self.start(None, drain)
+        assert wait_for(lambda: all(pj.next_wakeup for pj in dt.projects))
+        self.assertEqual([1, 1], self.drains)
+        dt.wakeup(dt.projects[1])
+        assert wait_for(lambda: self.drains[1] == 2)
+        self.assertEqual(1, self.drains[0])
+        dt.wakeup()
+        assert wait_for(lambda: self.drains == [2, 3])
+
+    def testSteadyRetries(self):
+        """retry jobs do not put off full drain"""
+        self.patch_min_retry_sleep(0.01)
+        retries = [0, 0]
+        def schedule(pj):
+            d = os.path.join(pj.xfer_dir, 'ITEM')
+            pj.retries.schedule(d, time.time() + 0.02)
+        def drain(pj):
+            self.drains[pj.id] += 1
+            schedule(pj)
+        def retry(pj):
+            retries[pj.id] += 1
+            pj.retries.due()
+            schedule(pj)
+        self.start(0.3, drain, retry)
+        assert wait_for(lambda: self.drains[0] >= 3, timeout=5)
+        self.assertGreater(retries[0], self.drains[0])
+
+    def testInvalidConfig(self):
+        """project with invalid config stops draining until it is
+        fixed, and others go on"""
+        def drain(pj):
+            self.drains[pj.id] += 1
+        dt = self.start(0.01, drain)
+        assert wait_for(lambda: self.drains[0] >= 1)
+        path = self.spaces[0].configpath
+        with open(path) as f:
+            good = f.read()
+        with open(path, 'a') as w:
+            w.write('sleep_time: x\n')
+        pj = dt.projects[0]
+        assert wait_for(lambda: pj.config_error)
+        n = self.drains[0]
+        m = self.drains[1]
+        assert wait_for(lambda: self.drains[1] >= m + 3)
+        self.assertEqual(n, self.drains[0])
+        with open(path, 'w') as w:
+            w.write(good)
+        assert wait_for(lambda: self.drains[0] > n)
+        self.assertEqual(None, pj.config_error)
+
+    def testOverdueRetryNotDraining(self):
+        """project not draining does not spin on overdue retry"""
+        checks = [0, 0]
+        configs = [ws.configpath for ws in self.spaces]
+        is_draining = dtmon.Project.is_draining
+        def counted(pj):
+            # (projects of other tests may still be running)
+            if pj.config_fname in configs:
+                checks[configs.index(pj.config_fname)] += 1
+            return is_draining(pj)
+        dtmon.Project.is_draining = counted
+        self.addCleanup(setattr, dtmon.Project, 'is_draining', is_draining)
+        for ws in self.spaces:
+            os.remove(os.path.join(ws.jobdir, 'DRAINME'))
+            os.mkdir(os.path.join(ws.xferdir, 'ITEM'))
+            with open(os.path.join(ws.xferdir, 'ITEM', 'RETRY'), 'w') as w:
+                w.write('%d\n' % (time.time() - 10))
+        self.start(0.5, lambda pj: None)
+        time.sleep(1.2)
+        # about once per sleep_time, not thousands of times
+        assert 0 < max(checks) < 10, checks
+
+    def testFailure(self):
+        """exception in drain does not stop the project"""
+        def drain(pj):
+            self.drains[pj.id] += 1
+            raise Exception('drain failed')
+        self.start(0.01, drain)
+        assert wait_for(lambda: self.drains[0] >= 2)
+
+class ProjectTest(unittest.TestCase):
+    @unittest.skipUnless(dtmon.inotify.available(), "no inotify")
+    def testInotifyWakeup(self):
+        """closing W/ARCs of max_size in job_dir wakes up project"""
+        ws = TestSpace(dict(TESTCONF, max_size=1.0/1024**2, inotify=1))
+        pj = dtmon.Project(0, ws.configpath, None)
+        pj.loadconfig()
+        pj.update_watcher()
+        try:
+            assert pj.watcher and pj.watcher.is_alive()
+            self.assertFalse(pj.wakeup_event.is_set())
+            ws.create_warcs(['WIDE-20101212000000-00000-2145~localhost~9443'],
+                            size=2048)
+            assert pj.wakeup_event.wait(5)
+        finally:
+            pj.watcher.stop()
+
+    def testSleepTimeout(self):
+        """sleep is cut short by the earliest retry deadline"""
+        ws = TestSpace(TESTCONF)
+        pj = dtmon.Project(0, ws.configpath, None)
+        pj.loadconfig()
+        pj.update_retries()
+        open(pj.DRAINME, 'w').close()
+        self.assertEqual((300, False), pj.sleep_timeout(300))
+        pj.retries.schedule(os.path.join(ws.xferdir, 'a'), time.time() + 10)
+        timeout, retry = pj.sleep_timeout(300)
+        assert retry and 9 < timeout <= 10
+        self.assertEqual((5, False), pj.sleep_timeout(5))
+
+    def testSleepTimeoutNotDraining(self):
+        """overdue retry does not cut sleep short when not draining, nor
+        down to nothing when draining"""
+        ws = TestSpace(TESTCONF)
+        pj = dtmon.Project(0, ws.configpath, None)
+        pj.loadconfig()
+        pj.update_retries()
+        pj.retries.schedule(os.path.join(ws.xferdir, 'a'), time.time() - 10)
+        assert not pj.is_draining()
+        self.assertEqual((300, False), pj.sleep_timeout(300))
+        open(pj.DRAINME, 'w').close()
+        self.assertEqual((dtmon.MIN_RETRY_SLEEP, True), pj.sleep_timeout(300))
+
+    def testSeriesCache(self):
+        """Series are reused until series directory changes"""
+        ws = TestSpace(TESTCONF)
+        ws.prepare_launch_transfers('ITEM1', ['W-1', 'W-2'])
+        pj = dtmon.Project(0, ws.configpath, None)
+        pj.loadconfig()
+        [s] = pj.uploads()
+        self.assertEqual(('PACKED', 'MANIFEST', None), (s.packed, s.manifest,
+                                                        s.launch))
+        self.assertEqual((2, 0), (s.warcs, s.warcs_done))
+        assert pj.get_series('ITEM1') is s
+        self.assertEqual(None, pj.get_series('ITEM2'))
+        self.assertEqual(None, pj.get_series('../ITEM1'))
+
+        d = os.path.join(ws.xferdir, 'ITEM1')
+        open(os.path.join(d, 'LAUNCH.open'), 'w').close()
+        os.utime(d, (s.mtime + 1, s.mtime + 1))
+        s2 = pj.get_series('ITEM1')
+        assert s2 is not s
+        self.assertEqual(('LAUNCH.open', 'running'), (s2.launch, s2.status))
+        self.assertEqual([s2], list(pj.uploads()))
+
+    def testSeriesCacheSize(self):
+        """least recently used Series are dropped from cache"""
+        self.addCleanup(setattr, dtmon, 'SERIES_CACHE_SIZE',
+                        dtmon.SERIES_CACHE_SIZE)
+        dtmon.SERIES_CACHE_SIZE = 2
+        ws = TestSpace(TESTCONF)
+        for name in ('ITEM1', 'ITEM2', 'ITEM3'):
+            ws.prepare_launch_transfers(name, ['W-1'])
+        pj = dtmon.Project(0, ws.configpath, None)
+        pj.loadconfig()
+        for offset in range(3):
+            [s] = pj.uploads(limit=1, offset=offset)
+            assert len(pj.series_cache) <= 2
+        self.assertEqual(3, len(list(pj.uploads())))
+        self.assertEqual(2, len(pj.series_cache))
+
+        s1 = pj.get_series('ITEM1')
+        s2 = pj.get_series('ITEM2')
+        assert pj.get_series('ITEM1') is s1
+        pj.get_series('ITEM3')
+        assert pj.get_series('ITEM1') is s1
+        assert pj.get_series('ITEM2') is not s2
+
+    def testUploadWindow(self):
+        """upload window starts at upload_concurrency, and is kept across
+        config reloads"""
+        ws = TestSpace(dict(TESTCONF, upload_concurrency=7,
+                            upload_max_connections=9))
+        pj = dtmon.Project(0, ws.configpath, None)
+        pj.loadconfig()
+        window = pj.upload_window
+        self.assertEqual((7, 9), (window.limit, window.maximum))
+        pj.loadconfig(force=True)
+        assert pj.upload_window is window
+
+    def testIndexRebuild(self):
+        """index is rebuilt from marker files when project is loaded"""
+        ws = TestSpace(TESTCONF)
+        ws.prepare_launch_transfers('ITEM1', ['W-1', 'W-2'])
+        d = os.path.join(ws.xferdir, 'ITEM1')
+        index = seriesindex.SeriesIndex(ws.xferdir)
+        index.rebuild()
+        # stale row, not caught by mtime of the series directory
+        st = os.stat(d)
+        open(os.path.join(d, 'SUCCESS'), 'w').close()
+        os.utime(d, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual('', index.get('ITEM1').status)
+        pj = dtmon.Project(0, ws.configpath, None)
+        pj.loadconfig()
+        self.assertEqual('completed', pj.index.get('ITEM1').status)
+
+if __name__ == '__main__':
+    unittest.main()
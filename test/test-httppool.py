@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import asyncio
+import threading
+import time
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import httppool
+from tornado import web, gen
+from tornado.httpclient import HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.simple_httpclient import HTTPTimeoutError
+from tornado.testing import bind_unused_port
+
+class EchoHandler(web.RequestHandler):
+    async def get(self):
+        if self.get_query_argument('stall', None):
+            self.set_header('Content-Length', '10')
+            self.write('hello')
+            await self.flush()
+            await gen.sleep(float(self.get_query_argument('stall')))
+            self.write('hello')
+        elif self.get_query_argument('redirect', None):
+            self.redirect(self.get_query_argument('redirect'))
+        elif self.get_query_argument('auth', None):
+            self.write(self.request.headers.get('Authorization', ''))
+        elif self.get_query_argument('chunked', None):
+            for i in range(3):
+                self.write('chunk%d' % i)
+                self.flush()
+        else:
+            self.write('hello')
+
+    def put(self):
+        self.write('%d %s' % (len(self.request.body),
+                              self.request.headers.get('Expect', '')))
+
+    post = put
+
+class KeepAliveHTTPClientTest(unittest.TestCase):
+    def run_with_server(self, test, client_args={}, **server_args):
+        async def run():
+            app = web.Application([(r'/.*', EchoHandler)])
+            sock, port = bind_unused_port()
+            server = HTTPServer(app, **server_args)
+            server.add_sockets([sock])
+            client = httppool.KeepAliveHTTPClient(force_instance=True,
+                                                  **client_args)
+            try:
+                return await test(client, 'http://localhost:%d' % port)
+            finally:
+                client.close()
+                server.stop()
+        return asyncio.run(run())
+
+    def testReuse(self):
+        async def test(client, base):
+            for i in range(5):
+                resp = await client.fetch(base + '/')
+                self.assertEqual(b'hello', resp.body)
+            return client.pool.stats
+        stats = self.run_with_server(test)
+        self.assertEqual(5, stats['requests'])
+        self.assertEqual(1, stats['opened'])
+        self.assertEqual(4, stats['reused'])
+        self.assertEqual(1, stats['dns_lookups'])
+
+    def testBodyProducer(self):
+        """request body is sent after 100 Continue, and connection is
+        reused after it"""
+        async def producer(write):
+            for i in range(10):
+                await write(b'x' * 1000)
+        async def test(client, base):
+            resp = await client.fetch(HTTPRequest(
+                    base + '/put', method='PUT', body_producer=producer,
+                    headers={'Content-Length': '10000'},
+                    expect_100_continue=True))
+            self.assertEqual(b'10000 100-continue', resp.body)
+            # without Content-Length, body is sent chunked
+            resp = await client.fetch(HTTPRequest(
+                    base + '/put', method='PUT', body_producer=producer))
+            self.assertEqual(b'10000 ', resp.body)
+            resp = await client.fetch(HTTPRequest(
+                    base + '/post', method='POST', body=b'abc'))
+            self.assertEqual(b'3 ', resp.body)
+            return client.pool.stats
+        stats = self.run_with_server(test)
+        self.assertEqual(1, stats['opened'])
+
+    def testTimeInfo(self):
+        """time_info has time spent in each phase of request. connect
+        time is counted for the first request on a connection only."""
+        async def producer(write):
+            await write(b'x' * 1000)
+        async def test(client, base):
+            infos = []
+            for i in range(2):
+                resp = await client.fetch(HTTPRequest(
+                        base + '/put', method='PUT', body_producer=producer,
+                        headers={'Content-Length': '1000'},
+                        expect_100_continue=True))
+                infos.append(resp.time_info)
+            return infos
+        first, second = self.run_with_server(test)
+        for info in first, second:
+            for phase in ('queue', 'connect', 'tls', 'continue', 'send',
+                          'response', 'recv', 'total'):
+                self.assertGreaterEqual(info[phase], 0.0, phase)
+            self.assertGreaterEqual(info['total'], sum(
+                    info[p] for p in ('connect', 'continue', 'send',
+                                      'response', 'recv')) - 0.001)
+        self.assertGreater(first['connect'], 0.0)
+        self.assertEqual(0.0, second['connect'])
+        self.assertEqual(0.0, first['tls'])
+
+    def testStreaming(self):
+        async def test(client, base):
+            chunks = []
+            resp = await client.fetch(HTTPRequest(
+                    base + '/?chunked=1', streaming_callback=chunks.append))
+            self.assertEqual(b'chunk0chunk1chunk2', b''.join(chunks))
+            resp = await client.fetch(base + '/?chunked=1')
+            self.assertEqual(b'chunk0chunk1chunk2', resp.body)
+            return client.pool.stats
+        stats = self.run_with_server(test)
+        self.assertEqual(1, stats['opened'])
+
+    def testRedirectAuthorization(self):
+        """Authorization is kept on redirect to the same host only"""
+        async def test(client, base):
+            other = base.replace('localhost', '127.0.0.1')
+            headers = {'Authorization': 'LOW a:b'}
+            resp = await client.fetch(HTTPRequest(
+                    base + '/?redirect=/%3Fauth=1', headers=headers))
+            self.assertEqual(b'LOW a:b', resp.body)
+            resp = await client.fetch(HTTPRequest(
+                    base + '/?redirect=%s/%%3Fauth=1' % other,
+                    headers=headers))
+            self.assertEqual(b'', resp.body)
+            self.assertEqual('LOW a:b', headers['Authorization'])
+        self.run_with_server(test)
+
+    def testServerClose(self):
+        """connection closed by server while idle is not used"""
+        async def test(client, base):
+            await client.fetch(base + '/')
+            await gen.sleep(0.3)
+            resp = await client.fetch(base + '/')
+            self.assertEqual(b'hello', resp.body)
+            return client.pool.stats
+        stats = self.run_with_server(test, idle_connection_timeout=0.1)
+        self.assertEqual(2, stats['opened'])
+
+    def testStaleRetry(self):
+        """request on stale connection is retried once, on a fresh one"""
+        dropped = []
+        async def handle(reader, writer):
+            # answers the first request on each connection only
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n'
+                         b'hello')
+            try:
+                await reader.readuntil(b'\r\n\r\n')
+                dropped.append(1)
+            except asyncio.IncompleteReadError:
+                pass
+            writer.close()
+        async def test():
+            sock, port = bind_unused_port()
+            server = await asyncio.start_server(handle, sock=sock)
+            client = httppool.KeepAliveHTTPClient(force_instance=True)
+            try:
+                url = 'http://localhost:%d/' % port
+                await asyncio.gather(*[client.fetch(url) for i in range(3)])
+                self.assertEqual(3, client.pool.stats['opened'])
+                resp = await client.fetch(url)
+                self.assertEqual(b'hello', resp.body)
+                return client.pool.stats
+            finally:
+                client.close()
+                server.close()
+        stats = asyncio.run(test())
+        self.assertEqual(1, len(dropped))
+        self.assertEqual((4, 1), (stats['opened'], stats['reused']))
+
+    def testConnectError(self):
+        async def test(client, base):
+            sock, port = bind_unused_port()
+            sock.close()
+            # raised even with raise_error=False, as SimpleAsyncHTTPClient
+            with self.assertRaises(IOError):
+                await client.fetch('http://localhost:%d/' % port,
+                                   raise_error=False)
+        self.run_with_server(test)
+
+    def testStall(self):
+        """request fails when nothing is received for stall_timeout"""
+        async def test(client, base):
+            resp = await client.fetch(base + '/?stall=0.1')
+            self.assertEqual(b'hellohello', resp.body)
+            start = time.monotonic()
+            # raised even with raise_error=False, as SimpleAsyncHTTPClient
+            with self.assertRaises(HTTPTimeoutError) as cm:
+                await client.fetch(base + '/?stall=2', raise_error=False)
+            self.assertIn('stalled', str(cm.exception))
+            self.assertLess(time.monotonic() - start, 1.0)
+        self.run_with_server(test, client_args=dict(stall_timeout=0.3))
+
+    def testMaxClients(self):
+        """shared client is raised to the largest max_clients asked"""
+        async def test():
+            client = httppool.KeepAliveHTTPClient(max_clients=2)
+            try:
+                self.assertIs(client,
+                              httppool.KeepAliveHTTPClient(max_clients=8))
+                self.assertEqual(8, client.max_clients)
+                httppool.KeepAliveHTTPClient(max_clients=4)
+                self.assertEqual(8, client.max_clients)
+                # all 8 slots can be taken at once
+                for i in range(8):
+                    await asyncio.wait_for(client.slots.acquire(), 1)
+            finally:
+                client.close()
+        asyncio.run(test())
+
+    def testBandwidthLimiter(self):
+        async def test():
+            limiter = httppool.BandwidthLimiter(1000000, burst=0.05)
+            start = time.monotonic()
+            for i in range(5):
+                await limiter.consume(100000)
+            elapsed = time.monotonic() - start
+            # rate can be changed while in use
+            limiter.set_rate(None)
+            start = time.monotonic()
+            await limiter.consume(10 * 1000000)
+            return elapsed, time.monotonic() - start, limiter
+        elapsed, unlimited, limiter = asyncio.run(test())
+        # 500000 bytes at 1000000 bytes/s, less 0.05s of burst
+        self.assertGreater(elapsed, 0.4)
+        self.assertLess(elapsed, 0.6)
+        self.assertLess(unlimited, 0.01)
+        self.assertEqual(10500000, limiter.bytes)
+        self.assertGreater(limiter.waited, 0.4)
+
+    def testParseRate(self):
+        self.assertEqual(1000, httppool.parse_rate('1000'))
+        self.assertEqual(50 * 1024**2, httppool.parse_rate('50M'))
+        self.assertEqual(1536, httppool.parse_rate('1.5k'))
+        self.assertEqual(1024**3, httppool.parse_rate(' 1GB '))
+        self.assertIsNone(httppool.parse_rate('0'))
+        self.assertIsNone(httppool.parse_rate(None))
+        self.assertIsNone(httppool.parse_rate(''))
+        self.assertRaises(ValueError, httppool.parse_rate, '10X')
+
+    def testRunSync(self):
+        """coroutines from different threads run on the shared IOLoop"""
+        async def loop_id():
+            return id(asyncio.get_running_loop())
+        ids = []
+        threads = [threading.Thread(
+                target=lambda: ids.append(httppool.run_sync(loop_id())))
+                   for i in range(3)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(3, len(ids))
+        self.assertEqual(1, len(set(ids)))
+
+if __name__ == '__main__':
+    unittest.main()
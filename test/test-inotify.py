@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import threading
+from io import StringIO
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import inotify
+
+@unittest.skipUnless(inotify.available(), "inotify is not available")
+class JobDirWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.ws = TestSpace(TESTCONF)
+        self.wakeups = threading.Semaphore(0)
+        self.watcher = inotify.JobDirWatcher(
+            self.ws.jobdir, 3000, self.wakeups.release, out=StringIO())
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.watcher.join()
+
+    def write_warc(self, name, size):
+        """write W/ARC as Heritrix does, as .open and rename"""
+        path = os.path.join(self.ws.jobdir, name)
+        with open(path + '.open', 'wb') as f:
+            f.write(b'x' * size)
+        os.rename(path + '.open', path)
+
+    def woken(self):
+        return self.wakeups.acquire(timeout=5)
+
+    def testMaxSize(self):
+        self.write_warc('a.warc.gz', 2000)
+        self.assertFalse(self.wakeups.acquire(timeout=0.2))
+        self.write_warc('b.warc.gz', 2000)
+        assert self.woken()
+        self.assertEqual(4000, self.watcher.ready_size)
+        # no more wakeups until size goes below max_size again
+        self.write_warc('c.warc.gz', 2000)
+        self.assertFalse(self.wakeups.acquire(timeout=0.2))
+
+    def testPacked(self):
+        """W/ARCs moved out by packing are no longer counted"""
+        self.write_warc('a.warc.gz', 2000)
+        self.write_warc('b.warc.gz', 2000)
+        assert self.woken()
+        for name in ('a.warc.gz', 'b.warc.gz'):
+            os.rename(os.path.join(self.ws.jobdir, name),
+                      os.path.join(self.ws.xferdir, name))
+        self.write_warc('c.warc.gz', 2000)
+        self.assertFalse(self.wakeups.acquire(timeout=0.2))
+        self.assertEqual(2000, self.watcher.ready_size)
+        self.write_warc('d.warc.gz', 2000)
+        assert self.woken()
+
+    def testDrainme(self):
+        open(os.path.join(self.ws.jobdir, 'DRAINME'), 'w').close()
+        assert self.woken()
+
+if __name__ == '__main__':
+    unittest.main()
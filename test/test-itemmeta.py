@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import gzip
+import subprocess
+import time
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import config
+import itemmeta
+
+ITEMID = 'WIDE-20130209104118-00000-00002-localhost'
+WARCS = ['WIDE-20130209104118%03d-%05d-2145~localhost~9443' % (n, n)
+         for n in range(3)]
+
+class ItemMetaTest(unittest.TestCase):
+    def setUp(self):
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+        self.ws = TestSpace(dict(
+                TESTCONF, collections='webwidecrawl/collection/serial',
+                description='CRAWLJOB  from START_DATE to END_DATE.'))
+        self.ws.write_s3cfg()
+        warcs = self.ws.prepare_launch_transfers(ITEMID, WARCS)
+        self.itemdir = os.path.join(self.ws.xferdir, ITEMID)
+        self.paths = [os.path.join(self.itemdir, w[0]) for w in warcs]
+        # warcinfo in its own gzip member, followed by records
+        with gzip.open(self.paths[0], 'wb') as z:
+            z.write(TEST_WARCINFO.encode())
+        with gzip.open(self.paths[0], 'ab') as z:
+            z.write(b'software: not-warcinfo/1.0\r\n' + os.urandom(100000))
+        # 2013-02-10 00:00:00 UTC
+        os.utime(self.paths[-1], (1360454400, 1360454400))
+
+    def testWarcSoftware(self):
+        self.assertEqual('Heritrix/3.1.2-SNAPSHOT-20120911.190842',
+                         itemmeta.warc_software(self.paths[0]))
+        # not gzipped
+        path = os.path.join(self.ws.dir, 'a.warc')
+        with open(path, 'w') as w:
+            w.write(TEST_WARCINFO + 'WARC/1.0\r\nsoftware: other/1.0\r\n')
+        self.assertEqual('Heritrix/3.1.2-SNAPSHOT-20120911.190842',
+                         itemmeta.warc_software(path))
+        # no warcinfo
+        self.assertEqual('', itemmeta.warc_software(self.paths[1]))
+        self.assertEqual('', itemmeta.warc_software(path + '.missing'))
+
+    def testItemMetadata(self):
+        conf = config.DrainConfig(self.ws.configpath)
+        headers = itemmeta.item_metadata(conf, ITEMID, self.paths, 3, '3072')
+        meta = dict(h.split(':', 1) for h in headers)
+        self.assertEqual('Webwide Crawldata 2013-02-09T10:41:18UTC to'
+                         ' 2013-02-10T00:00:00UTC',
+                         meta['x-archive-meta-title'])
+        self.assertEqual('wide from Sat Feb 9 10:41:18 UTC 2013 to'
+                         ' Sun Feb 10 00:00:00 UTC 2013.',
+                         meta['x-archive-meta-description'])
+        self.assertEqual('20130209104118', meta['x-archive-meta-scandate'])
+        self.assertEqual('2013', meta['x-archive-meta-date'])
+        self.assertEqual('3072', meta['x-archive-meta-sizehint'])
+        self.assertEqual('20130209104118000',
+                         meta['x-archive-meta-firstfiledate'])
+        self.assertEqual('20130209104118002',
+                         meta['x-archive-meta-lastfiledate'])
+        self.assertEqual('20130210000000', meta['x-archive-meta-lastdate'])
+        self.assertEqual('Heritrix/3.1.2-SNAPSHOT-20120911.190842',
+                         meta['x-archive-meta-crawler'])
+        self.assertEqual('3', meta['x-archive.meta-numwarcs'])
+        self.assertEqual('00000', meta['x-archive-meta-firstfileserial'])
+        self.assertEqual('00002', meta['x-archive-meta-lastfileserial'])
+        self.assertEqual(['x-archive-meta03-collection:webwidecrawl',
+                          'x-archive-meta02-collection:collection',
+                          'x-archive-meta01-collection:serial'],
+                         itemmeta.collection_headers(conf))
+
+    def testCommand(self):
+        """itemmeta.py prints the headers s3-launch-transfers.sh sends"""
+        out = subprocess.check_output([bin('itemmeta.py'),
+                                       self.ws.configpath, self.itemdir])
+        conf = config.DrainConfig(self.ws.configpath)
+        self.assertEqual(
+            itemmeta.item_metadata(conf, ITEMID, self.paths, 3, '3072') +
+            itemmeta.collection_headers(conf),
+            out.decode('utf-8').splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -46,6 +46,33 @@ class LaunchTransfersTest(unittest.TestCase):
             assert re.search(r'--upload-file \S+\.warc\.gz ', l)
             assert re.search(r' https://s3\.us\.archive\.org/'+ITEMID+'/.*\.warc\.gz ', l)
 
+    def testItemMetaFailure(self):
+        """failure of itemmeta.py aborts the series only"""
+        ws = TestSpace(TESTCONF)
+        ITEMIDS = ['WIDE-20130209104118', 'WIDE-20130209114118']
+        for itemid in ITEMIDS:
+            ws.prepare_launch_transfers(itemid, ['%s-00000' % itemid])
+        # fails for the first series
+        itemmeta = os.path.join(ws.jobdir, 'itemmeta.sh')
+        with open(itemmeta, 'w') as w:
+            w.write('#!/bin/bash\n'
+                    'case $2 in */%s) exit 1;; esac\n'
+                    'exec %s "$@"\n' % (ITEMIDS[0], bin('itemmeta.py')))
+        os.chmod(itemmeta, 0o755)
+
+        p = subprocess.Popen([bin('s3-launch-transfers.sh'),
+                              ws.configpath, '1', 'test'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=dict(os.environ, ITEMMETA=itemmeta))
+        out, err = p.communicate()
+        self.assertEqual(0, p.wait())
+
+        d0, d1 = [os.path.join(ws.xferdir, itemid) for itemid in ITEMIDS]
+        with open(os.path.join(d0, 'ERROR')) as f:
+            assert 'ERROR: failed to build item metadata' in f.read()
+        assert not os.path.exists(os.path.join(d0, 'LAUNCH'))
+        assert os.path.exists(os.path.join(d1, 'LAUNCH'))
+
             
         
         
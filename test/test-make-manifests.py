@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import gzip
+import shutil
+from tempfile import mkdtemp
+from io import StringIO
+from hashlib import md5
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import config
+import manifest
+
+class GzipCheckerTest(unittest.TestCase):
+    def check(self, data, chunk=7):
+        gz = manifest.GzipChecker()
+        for i in range(0, len(data), chunk):
+            gz.update(data[i:i+chunk])
+        return gz.ok()
+
+    def testMultiMember(self):
+        data = gzip.compress(b'WARC/1.0\r\n' * 100) + gzip.compress(b'x' * 999)
+        assert self.check(data)
+        assert self.check(data, chunk=len(data))
+        # trailing zero padding is okay
+        assert self.check(data + b'\0' * 100)
+
+    def testBad(self):
+        data = gzip.compress(b'WARC/1.0\r\n' * 100)
+        # truncated
+        assert not self.check(data[:-10])
+        # corrupted CRC
+        assert not self.check(data[:-8] + b'\0\0\0\0' + data[-4:])
+        # not gzip
+        assert not self.check(b'WARC/1.0\r\n' * 10)
+        # trailing garbage
+        assert not self.check(data + b'garbage')
+        # empty
+        assert not self.check(b'')
+
+class ManifestBuilderTest(unittest.TestCase):
+    def testListWarcs(self):
+        """files are sorted together, like ls of make-manifests.sh"""
+        d = mkdtemp(prefix='manifesttest')
+        self.addCleanup(shutil.rmtree, d)
+        names = ['A-2.warc.gz', 'A-1.arc', 'A-3.warc', 'A-0.arc.gz',
+                 'A-4.txt', 'A-5.warc.gz.bad', 'PACKED']
+        for fn in names:
+            open(os.path.join(d, fn), 'w').close()
+        self.assertEqual(['A-0.arc.gz', 'A-1.arc', 'A-2.warc.gz', 'A-3.warc'],
+                         manifest.list_warcs(d))
+
+    def testBuild(self):
+        ws = TestSpace(TESTCONF)
+        names = ['WIDE-20130209104118-%05d' % n for n in range(3)]
+        warcs = ws.prepare_launch_transfers('WIDE-20130209104118', names)
+        itemdir = os.path.join(ws.xferdir, 'WIDE-20130209104118')
+        # prepare_launch_transfers creates MANIFEST and non-gzip files.
+        os.remove(os.path.join(itemdir, 'MANIFEST'))
+        expected = []
+        for i, (name, md5sum) in enumerate(warcs):
+            path = os.path.join(itemdir, name)
+            if i == 1:
+                # leave this one corrupted
+                continue
+            with open(path, 'wb') as w:
+                w.write(gzip.compress(TEST_WARCINFO.encode()))
+            with open(path, 'rb') as f:
+                expected.append('%s  %s\n' % (md5(f.read()).hexdigest(), name))
+
+        with open(os.path.join(itemdir, 'PACKED')) as f:
+            name, count, size = f.readline().split()
+        bad_size = os.path.getsize(os.path.join(itemdir, warcs[1][0]))
+
+        conf = config.DrainConfig(ws.configpath)
+        out = StringIO()
+        builder = manifest.ManifestBuilder(conf, out=out)
+        self.assertEqual(1, builder.run())
+        sys.stderr.write(out.getvalue())
+
+        assert not os.path.exists(os.path.join(itemdir, 'MANIFEST.open'))
+        with open(os.path.join(itemdir, 'MANIFEST')) as f:
+            self.assertEqual(expected, f.readlines())
+        bad = os.path.join(itemdir, warcs[1][0])
+        assert not os.path.exists(bad)
+        assert os.path.exists(bad + '.bad')
+        # left out of PACKED, and reported in ERROR
+        with open(os.path.join(itemdir, 'PACKED')) as f:
+            self.assertEqual('%s %d %d\n' % (name, int(count) - 1,
+                                             int(size) - bad_size),
+                             f.read())
+        with open(os.path.join(itemdir, 'ERROR')) as f:
+            self.assertEqual(['ERROR: bad gzip, left out of MANIFEST: %s.bad'
+                              % bad], f.read().splitlines())
+
+        # MANIFEST exists - nothing to do
+        self.assertEqual(0, manifest.ManifestBuilder(conf, out=out).run())
+
+    def testNoMd5sum(self):
+        ws = TestSpace(dict(TESTCONF, md5sum=0, verify_gzip=0))
+        warcs = ws.prepare_launch_transfers('WIDE-20130209104118',
+                                            ['WIDE-20130209104118-00000'])
+        itemdir = os.path.join(ws.xferdir, 'WIDE-20130209104118')
+        os.remove(os.path.join(itemdir, 'MANIFEST'))
+
+        conf = config.DrainConfig(ws.configpath)
+        manifest.ManifestBuilder(conf, out=StringIO()).run()
+        with open(os.path.join(itemdir, 'MANIFEST')) as f:
+            self.assertEqual(['-  %s\n' % warcs[0][0]], f.readlines())
+
+    def testParallel(self):
+        """multiple series are hashed concurrently, each MANIFEST
+        listing files in order."""
+        # prepare_launch_transfers creates non-gzip files
+        ws = TestSpace(dict(TESTCONF, manifest_workers=3, verify_gzip=0))
+        expected = {}
+        for s in range(3):
+            iid = 'WIDE-2013020910411%d' % s
+            names = ['%s-%05d' % (iid, n) for n in range(5)]
+            warcs = ws.prepare_launch_transfers(iid, names)
+            os.remove(os.path.join(ws.xferdir, iid, 'MANIFEST'))
+            expected[iid] = ['%s  %s\n' % (h, fn) for fn, h in warcs]
+
+        conf = config.DrainConfig(ws.configpath)
+        conf.validate()
+        builder = manifest.ManifestBuilder(conf, out=StringIO())
+        self.assertEqual(3, builder.workers)
+        self.assertEqual(3, builder.run(mode='all'))
+        for iid, lines in expected.items():
+            with open(os.path.join(ws.xferdir, iid, 'MANIFEST')) as f:
+                self.assertEqual(lines, f.readlines())
+
+    def testFailure(self):
+        """unexpected failure leaves no MANIFEST.open behind"""
+        ws = TestSpace(dict(TESTCONF, verify_gzip=0))
+        iids = ['WIDE-2013020910411%d' % s for s in range(3)]
+        for iid in iids:
+            ws.prepare_launch_transfers(iid, ['%s-00000' % iid])
+            os.remove(os.path.join(ws.xferdir, iid, 'MANIFEST'))
+
+        conf = config.DrainConfig(ws.configpath)
+        builder = manifest.ManifestBuilder(conf, out=StringIO())
+        def hash_file(d, fn):
+            raise RuntimeError('hash failed')
+        builder.hash_file = hash_file
+        self.assertRaises(RuntimeError, builder.run, mode='all')
+        for iid in iids:
+            self.assertEqual([], [fn for fn in os.listdir(
+                        os.path.join(ws.xferdir, iid)) if 'MANIFEST' in fn])
+        # and they are made next time
+        builder = manifest.ManifestBuilder(conf, out=StringIO())
+        self.assertEqual(3, builder.run(mode='all'))
+
+if __name__ == '__main__':
+    unittest.main()
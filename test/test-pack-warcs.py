@@ -4,6 +4,7 @@ import sys
 import os
 import unittest
 from tempfile import NamedTemporaryFile, mkdtemp
+from io import StringIO
 import shutil
 import random
 import gzip
@@ -11,6 +12,11 @@ import subprocess
 
 from testutils import *
 
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+import config
+import packwarcs
+
 class PackWarcsTest(unittest.TestCase):
     
     def testStandardPack(self):
@@ -60,7 +66,8 @@ class PackWarcsTest(unittest.TestCase):
         # until we write separate test-scripts for them. not doing
         # programmatic check of their behavior. script output must be
         # examined.
-        p = subprocess.Popen([bin('make-manifests.sh'), ws.xferdir])
+        p = subprocess.Popen([bin('make-manifests.sh'), ws.configpath,
+                              ws.xferdir])
         rc = p.wait()
         self.assertEqual(0, rc)
 
@@ -138,5 +145,85 @@ class PackWarcsTest(unittest.TestCase):
                          "PACKED 3rd field, total size, expected %s, got %s" %
                          (total_size, packed_fields[2]))
 
+class WarcPackerTest(unittest.TestCase):
+    """in-process pack engine (packwarcs.py). uses fractional max_size
+    to keep test data small."""
+
+    MAX_SIZE = 1.0/1024 # 1MB
+
+    def pack(self, ws, mode='single'):
+        conf = config.DrainConfig(ws.configpath)
+        conf.validate()
+        out = StringIO()
+        packed = packwarcs.WarcPacker(conf, out=out).run(mode=mode)
+        sys.stderr.write(out.getvalue())
+        return packed
+
+    def testStandardPack(self):
+        ws = TestSpace(dict(TESTCONF, max_size=self.MAX_SIZE))
+
+        ITEM_SIZE = int(self.MAX_SIZE*(1024**3))
+        wnames = ('WIDE-2010121200%02d00-%05d-2145~localhost~9443' % (n, n)
+                  for n in range(10))
+        warcs = ws.create_warcs(wnames, size=ITEM_SIZE//9+1)
+        warcs_packed = []
+        total_size = 0
+        for w in warcs:
+            size = os.path.getsize(w)
+            if total_size + size > ITEM_SIZE: break
+            warcs_packed.append(w)
+            total_size += size
+        assert len(warcs_packed) == 8
+
+        packed = self.pack(ws)
+
+        EXPECTED_ITEM_NAME = 'WIDE-20101212000000-%05d-%05d-localhost' % (0, 7)
+        self.assertEqual([EXPECTED_ITEM_NAME], packed)
+        assert not os.path.exists(os.path.join(ws.jobdir, 'PACKED.open'))
+        for w in warcs_packed:
+            assert not os.path.exists(w), "%s was not packed" % w
+        self.check_item_dir(ws, EXPECTED_ITEM_NAME, warcs_packed, total_size)
+
+    def testCompactNamesConflict(self):
+        """compact_names renames WARCs and adds suffix to item name
+        when it conflicts with already packed series."""
+        conf = dict(TESTCONF, max_size=self.MAX_SIZE, compact_names=1)
+        ws = TestSpace(conf)
+        open(os.path.join(ws.jobdir, 'FINISH_DRAIN'), 'w').close()
+
+        ITEM_SIZE = int(self.MAX_SIZE*(1024**3))
+        # two series sharing the first 14 digits of timestamp
+        wnames = ['WIDE-20101212000000%03d-%05d-2145~crawl.example.org~9443'
+                  % (n, n) for n in range(4)]
+        ws.create_warcs(wnames, size=ITEM_SIZE//2+1)
+
+        packed = self.pack(ws, mode='all')
+
+        # each WARC is larger than half of max_size. last two are packed
+        # together because of FINISH_DRAIN.
+        self.assertEqual(['WIDE-20101212000000-crawl',
+                          'WIDE-20101212000000-1-crawl',
+                          'WIDE-20101212000000-2-crawl'], packed)
+        itemdir = os.path.join(ws.xferdir, packed[1])
+        assert os.path.isfile(os.path.join(
+                itemdir, 'WIDE-20101212000000-00001.warc.gz'))
+        self.assertEqual(['FINISH_DRAIN'], os.listdir(ws.jobdir))
+
+    check_item_dir = PackWarcsTest.check_item_dir
+
+    def testNaming(self):
+        naming = packwarcs.WarcNaming(
+            '{prefix}-{timestamp}-{serial}-{pid}~{host}~{port}')
+        f = naming.parse(
+            'WIDE-20130130223836109-03048-3466~crawl450.us.archive.org~9443'
+            '.warc.gz')
+        self.assertEqual('20130130223836109', f['timestamp'])
+        self.assertEqual('crawl450', f['shost'])
+        self.assertEqual('.warc.gz', f['ext'])
+        assert naming.parse('WIDE-2013.txt') is None
+
+        self.assertEqual(r'\.w?arc(\.gz)?',
+            packwarcs.emacs_to_python_re(r'\.w?arc\(\.gz\)?'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import asyncio
+import threading
+from io import StringIO
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import config
+import dtmon
+import httppool
+import pipeline
+import retrysched
+import seriesindex
+
+class DrainPipelineTest(unittest.TestCase):
+    MAX_SIZE = 1.0/1024 # 1MB
+
+    def setUp(self):
+        self.ias3 = FakeIAS3()
+        self.ws = TestSpace(dict(TESTCONF, max_size=self.MAX_SIZE,
+                                 block_delay=0, pipeline_workers=dict(
+                    manifest=2, ingest=2)))
+        self.ws.write_s3cfg()
+        # three series of two WARCs
+        ITEM_SIZE = int(self.MAX_SIZE*(1024**3))
+        wnames = ['WIDE-2010121200%02d00-%05d-2145~localhost~9443' % (n, n)
+                  for n in range(6)]
+        self.ws.create_warcs(wnames, size=ITEM_SIZE//2 - 1000)
+        open(os.path.join(self.ws.jobdir, 'FINISH_DRAIN'), 'w').close()
+
+    def run_pipeline(self, run_hook=None, retries=None, retry=None,
+                     index=None):
+        async def run():
+            self.ias3.start()
+            try:
+                conf = config.DrainConfig(self.ws.configpath)
+                conf.cfg['s3_endpoint'] = self.ias3.endpoint
+                conf.validate()
+                out = StringIO()
+                p = pipeline.DrainPipeline(conf, out=out, run_hook=run_hook,
+                                           retries=retries, index=index)
+                try:
+                    errors = await p.run(retry=retry)
+                finally:
+                    sys.stderr.write(out.getvalue())
+                return p, errors
+            finally:
+                self.ias3.stop()
+                httppool.KeepAliveHTTPClient().close()
+        return asyncio.run(run())
+
+    def series(self):
+        return sorted(os.listdir(self.ws.xferdir))
+
+    def has(self, name, f):
+        return os.path.exists(os.path.join(self.ws.xferdir, name, f))
+
+    def testDrain(self):
+        p, errors = self.run_pipeline()
+        self.assertEqual(0, errors)
+        self.assertEqual(2, p.workers['manifest'])
+        series = self.series()
+        self.assertEqual(3, len(series))
+        self.assertEqual(dict(pack=3, manifest=3, ingest=3, clean=3), p.done)
+        self.assertEqual(['FINISH_DRAIN'], os.listdir(self.ws.jobdir))
+        for name in series:
+            for f in ('MANIFEST', 'SUCCESS', 'LAUNCH', 'CLEAN'):
+                assert self.has(name, f), '%s/%s does not exist' % (name, f)
+            # uploaded WARCs are cleaned
+            d = os.path.join(self.ws.xferdir, name)
+            self.assertEqual([], [fn for fn in os.listdir(d)
+                                  if fn.endswith('.warc.gz')])
+            self.assertEqual(3, len(self.ias3.items[name]))
+
+        # nothing to do for the second time
+        p, errors = self.run_pipeline()
+        self.assertEqual(dict(pack=0, manifest=0, ingest=0, clean=0), p.done)
+
+    def testHooks(self):
+        """failing before hook skips the stage, leaving series for the
+        next run"""
+        calls = []
+        def run_hook(step, hook, out):
+            calls.append(hook + step)
+            return 1 if hook + step == 'beforeingest' else 0
+        p, errors = self.run_pipeline(run_hook)
+        self.assertEqual(1, errors)
+        self.assertEqual(['beforepack', 'beforemanifest', 'beforeingest',
+                          'beforeclean', 'onpack', 'onmanifest', 'onclean'],
+                         calls)
+        self.assertEqual(dict(pack=3, manifest=3, ingest=0, clean=0), p.done)
+        self.assertEqual({}, self.ias3.items)
+
+        # series with MANIFEST are picked up for upload
+        p, errors = self.run_pipeline()
+        self.assertEqual(0, errors)
+        self.assertEqual(dict(pack=0, manifest=0, ingest=3, clean=3), p.done)
+
+    def testRetry(self):
+        """series scheduled for retry are skipped until due, then
+        uploaded alone"""
+        retries = retrysched.RetrySchedule(self.ws.xferdir)
+        self.ias3.fail = [500]
+        p, errors = self.run_pipeline(retries=retries)
+        self.assertEqual(3, p.done['pack'])
+        self.assertEqual(2, p.done['ingest'])
+        self.assertEqual(1, len(retries))
+        d = retries.due(now=float('inf'))[0]
+        assert self.has(os.path.basename(d), 'RETRY')
+        retries.schedule(d, retries.deadline(d) or 2**31)
+
+        # not looked into while waiting
+        p, errors = self.run_pipeline(retries=retries)
+        self.assertEqual(dict(pack=0, manifest=0, ingest=0, clean=0), p.done)
+
+        # new WARCs in job_dir are left for the next drain
+        self.ws.create_warcs(['WIDE-20101212010000-00010-2145~localhost~9443'],
+                             size=1000)
+        with open(os.path.join(d, 'RETRY'), 'w') as w:
+            w.write('0\n')
+        retries.schedule(d, 0)
+        calls = []
+        def run_hook(step, hook, out):
+            calls.append(hook + step)
+            return 0
+        p, errors = self.run_pipeline(run_hook, retries, retries.due())
+        self.assertEqual(0, errors)
+        self.assertEqual(dict(pack=0, manifest=0, ingest=1, clean=1), p.done)
+        self.assertEqual(['beforeingest', 'beforeclean', 'oningest',
+                          'onclean'], calls)
+        assert self.has(os.path.basename(d), 'SUCCESS')
+        self.assertEqual(0, len(retries))
+        self.assertEqual(2, len(os.listdir(self.ws.jobdir)))
+
+    def testExecutor(self):
+        """blocking steps run in executor of the pipeline"""
+        threads = set()
+        def run_hook(step, hook, out):
+            threads.add(threading.current_thread().name.split('_')[0])
+            return 0
+        p, errors = self.run_pipeline(run_hook)
+        self.assertEqual(0, errors)
+        self.assertEqual({'pipeline'}, threads)
+        self.assertEqual(sum(p.workers.values()) + 1, p.executor._max_workers)
+
+    def testRetryAsap(self):
+        """series put off by RETRY is uploaded on retryasap"""
+        self.ias3.fail = [500]
+        pj = dtmon.Project(0, self.ws.configpath, None)
+        pj.loadconfig()
+        pj.update_retries()
+        p, errors = self.run_pipeline(retries=pj.retries)
+        [d] = pj.retries.due(now=float('inf'))
+        name = os.path.basename(d)
+        pj.retries.schedule(d, 2**31)
+
+        r = pj.retryasap(dtmon.Series(self.ws.xferdir, name))
+        self.assertEqual(1, r['ok'])
+        assert pj.wakeup_event.is_set()
+        open(pj.DRAINME, 'w').close()
+        self.assertEqual((dtmon.MIN_RETRY_SLEEP, True), pj.sleep_timeout(300))
+        p, errors = self.run_pipeline(retries=pj.retries)
+        self.assertEqual(0, errors)
+        self.assertEqual(1, p.done['ingest'])
+        assert self.has(name, 'SUCCESS')
+
+    def testIndex(self):
+        """index is kept up to date as series go through stages"""
+        index = seriesindex.SeriesIndex(self.ws.xferdir)
+        p, errors = self.run_pipeline(index=index)
+        self.assertEqual(0, errors)
+        states = index.all()
+        self.assertEqual(3, len(states))
+        for st in states:
+            for f in ('PACKED', 'MANIFEST', 'LAUNCH', 'SUCCESS', 'CLEAN'):
+                assert st.has(f), '%s has no %s' % (st.name, f)
+            self.assertEqual((0, 2), (st.warcs, st.warcs_done))
+
+        p, errors = self.run_pipeline(index=index)
+        self.assertEqual(dict(pack=0, manifest=0, ingest=0, clean=0), p.done)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import retrysched
+
+class RetryScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.ws = TestSpace(TESTCONF)
+
+    def series(self, name, retry=None):
+        d = os.path.join(self.ws.xferdir, name)
+        os.mkdir(d)
+        if retry is not None:
+            with open(os.path.join(d, 'RETRY'), 'w') as w:
+                w.write(retry)
+        return d
+
+    def testLoad(self):
+        a = self.series('a', '2000\n')
+        b = self.series('b', '1000\n')
+        c = self.series('c', '?\n')
+        self.series('d')
+        sched = retrysched.RetrySchedule(self.ws.xferdir)
+        self.assertEqual(3, len(sched))
+        self.assertEqual(0, sched.next_deadline())
+        self.assertEqual(1000, sched.deadline(b))
+        self.assertEqual([c], sched.due(now=500))
+        self.assertEqual([b, a], sched.due(now=2000))
+        self.assertEqual(None, sched.next_deadline())
+        self.assertEqual([], sched.due(now=3000))
+
+    def testSchedule(self):
+        a = self.series('a')
+        b = self.series('b')
+        sched = retrysched.RetrySchedule(self.ws.xferdir)
+        self.assertEqual(0, len(sched))
+        sched.schedule(a, 1000)
+        sched.schedule(b, 2000)
+        # rescheduled - old deadline is ignored
+        sched.schedule(a, 3000)
+        self.assertEqual(2000, sched.next_deadline())
+        self.assertEqual([], sched.due(now=1500))
+        sched.cancel(b)
+        self.assertEqual(3000, sched.next_deadline())
+        self.assertEqual([a], sched.due(now=3000))
+        self.assertEqual(0, len(sched))
+
+if __name__ == '__main__':
+    unittest.main()
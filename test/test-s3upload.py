@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import asyncio
+from io import StringIO
+from hashlib import md5
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import config
+import httppool
+import s3upload
+import uploadstats
+import uploadwindow
+
+ITEMID = 'WIDE-20130209104118-00000-00002-localhost'
+WARCS = ['WIDE-20130209104118%03d-%05d-2145~localhost~9443' % (n, n)
+         for n in range(3)]
+
+class S3UploaderTest(unittest.TestCase):
+    def setUp(self):
+        self.ias3 = FakeIAS3()
+        self.upload_stats = uploadstats.UploadStats()
+        self.window = uploadwindow.AdaptiveWindow(2, 8)
+
+    def prepare(self, size=1024, **kw):
+        ws = TestSpace(dict(dict(TESTCONF, block_delay=0, max_block_count=2,
+                                 upload_concurrency=2), **kw))
+        ws.write_s3cfg()
+        warcs = ws.prepare_launch_transfers(ITEMID, WARCS, size)
+        self.itemdir = os.path.join(ws.xferdir, ITEMID)
+        return ws, warcs
+
+    def upload(self, ws, mode='all'):
+        """run uploader against FakeIAS3. returns number of series
+        launched."""
+        async def run():
+            self.ias3.start()
+            try:
+                conf = config.DrainConfig(ws.configpath)
+                conf.cfg['s3_endpoint'] = self.ias3.endpoint
+                conf.cfg['download_base'] = self.ias3.download_base
+                conf.validate()
+                out = StringIO()
+                uploader = s3upload.S3Uploader(conf, out=out,
+                                               stats=self.upload_stats,
+                                               window=self.window)
+                try:
+                    return await uploader.run(mode=mode)
+                finally:
+                    sys.stderr.write(out.getvalue())
+                    self.stats = uploader.client.pool.stats
+            finally:
+                self.ias3.stop()
+                httppool.KeepAliveHTTPClient().close()
+        return asyncio.run(run())
+
+    def exists(self, fn):
+        return os.path.exists(os.path.join(self.itemdir, fn))
+
+    def testUpload(self):
+        ws, warcs = self.prepare()
+        self.assertEqual(1, self.upload(ws))
+
+        for fn in ('LAUNCH', 'SUCCESS', 'TOMBSTONE', 'BUCKET_OK', 'TASK'):
+            assert self.exists(fn), '%s does not exist' % fn
+        assert not self.exists('LAUNCH.open')
+        assert not self.exists('ERROR')
+
+        item = self.ias3.items[ITEMID]
+        self.assertEqual(sorted(['MANIFEST.txt'] + [w[0] for w in warcs]),
+                         sorted(item))
+        for fn, digest in warcs:
+            self.assertEqual(digest, md5(item[fn]).hexdigest())
+            assert self.exists(fn + '.tombstone')
+
+        # item creation comes first, with metadata
+        method, path, headers = self.ias3.requests[0]
+        self.assertEqual('/%s/MANIFEST.txt' % ITEMID, path)
+        self.assertEqual('1', headers['x-archive-auto-make-bucket'])
+        self.assertEqual('0', headers['x-archive-queue-derive'])
+        self.assertEqual('test_collection',
+                         headers['x-archive-meta01-collection'])
+        self.assertEqual('crawl@archive.org',
+                         headers['x-archive-meta-operator'])
+        self.assertEqual('20130209104118',
+                         headers['x-archive-meta-scandate'])
+        self.assertEqual('00002', headers['x-archive-meta-lastfileserial'])
+        self.assertEqual('3', headers['x-archive.meta-numwarcs'])
+        self.assertEqual('LOW ACCESS:SECRET', headers['authorization'])
+
+        # derive is queued with the last file only, which is uploaded last
+        method, path, headers = self.ias3.requests[-1]
+        self.assertEqual('/%s/%s' % (ITEMID, warcs[-1][0]), path)
+        assert 'x-archive-queue-derive' not in headers
+        for method, path, headers in self.ias3.requests[1:-1]:
+            self.assertEqual('0', headers['x-archive-queue-derive'])
+            assert headers['Content-MD5']
+
+        # connections are reused
+        self.assertEqual(len(self.ias3.requests), self.stats['requests'])
+        self.assertLessEqual(self.stats['opened'], 2)
+
+        # every request is recorded with its timings
+        total = self.upload_stats.total
+        self.assertEqual(len(self.ias3.requests), total.requests)
+        self.assertEqual([self.ias3.endpoint],
+                         [s.endpoint for s in self.upload_stats.endpoints()])
+        self.assertEqual({200: total.requests}, total.codes)
+        self.assertEqual(total.requests, total.latency.count)
+        self.assertEqual(total.requests, total.ttfb.count)
+        tasks = list(uploadstats.read_task(os.path.join(self.itemdir,
+                                                        'TASK')))
+        self.assertEqual(total.requests, len(tasks))
+        for url, code, size, time_info in tasks:
+            self.assertEqual(200, code)
+            assert 'send' in time_info and 'response' in time_info, \
+                time_info
+
+        # nothing to do for the second time
+        self.assertEqual(0, self.upload(ws))
+
+    def testBlockingRetry(self):
+        """503 is retried after block_delay"""
+        ws, warcs = self.prepare()
+        self.ias3.fail = [503, 503]
+        self.assertEqual(1, self.upload(ws))
+        assert self.exists('SUCCESS')
+        assert not self.exists('RETRY')
+        self.assertEqual(2, self.upload_stats.total.codes[503])
+        self.assertEqual(2, self.upload_stats.total.errors)
+        # window was cut, and is not above upload_max_connections
+        self.assertGreater(self.window.decreases, 0)
+        self.assertEqual(0, self.window.in_flight)
+        self.assertLessEqual(self.window.limit, 8)
+
+    def testBlockedFileGivesWay(self):
+        """other files are uploaded while one waits for blocking retry,
+        and blocking retries are counted per file"""
+        ws, warcs = self.prepare(block_delay=1, upload_concurrency=1)
+        # first file is blocked once, second twice: more than
+        # max_block_count in total, but not for either file.
+        self.ias3.fail = [None, 503, 503, None, 503]
+        self.assertEqual(1, self.upload(ws))
+        assert self.exists('SUCCESS')
+        assert not self.exists('RETRY')
+        paths = [path for method, path, headers in self.ias3.requests]
+        w0, w1, w2 = ['/%s/%s' % (ITEMID, w[0]) for w in warcs]
+        self.assertEqual(['/%s/MANIFEST.txt' % ITEMID, w0, w1, w0, w1, w1,
+                          w2], paths)
+
+    def testNonBlockingRetry(self):
+        """500 schedules RETRY; LAUNCH.open is left for next attempt"""
+        ws, warcs = self.prepare()
+        self.ias3.fail = [500]
+        self.assertEqual(0, self.upload(ws))
+        assert self.exists('RETRY')
+        assert self.exists('LAUNCH.open')
+        assert not self.exists('SUCCESS')
+
+        # RETRY is not due yet
+        self.assertEqual(0, self.upload(ws))
+
+        # due - RETRY and blocking files are moved aside
+        with open(os.path.join(self.itemdir, 'RETRY'), 'w') as w:
+            w.write('0\n')
+        self.assertEqual(1, self.upload(ws))
+        assert self.exists('SUCCESS')
+        assert self.exists('RETRY.0')
+        assert self.exists('LAUNCH.open.0')
+        # log of the attempt is closed before it is moved aside
+        with open(os.path.join(self.itemdir, 'LAUNCH.open.0')) as f:
+            self.assertEqual('  moving aside RETRY file',
+                             f.read().splitlines()[-1])
+        with open(os.path.join(self.itemdir, 'LAUNCH')) as f:
+            self.assertEqual('==== %s ====' % ITEMID, f.readline().strip())
+
+    def testJournalResume(self):
+        """files recorded as uploaded in JOURNAL are not sent again"""
+        ws, warcs = self.prepare(upload_concurrency=1)
+        self.ias3.fail = [None, None, 500]
+        self.assertEqual(0, self.upload(ws))
+        assert self.exists('RETRY')
+        journal = s3upload.SeriesJournal(os.path.join(self.itemdir,
+                                                      'JOURNAL'))
+        self.assertEqual('verified', journal.state(warcs[0][0]))
+        self.assertEqual('sending', journal.state(warcs[1][0]))
+        self.assertEqual('pending', journal.state(warcs[2][0]))
+        self.assertEqual(warcs[0][1], journal.uploaded(warcs[0][0], 1024,
+                                                       warcs[0][1]))
+        self.assertEqual(None, journal.uploaded(warcs[0][0], 1025,
+                                                warcs[0][1]))
+
+        # crash after upload, before .tombstone was written
+        os.remove(os.path.join(self.itemdir, warcs[0][0] + '.tombstone'))
+        with open(os.path.join(self.itemdir, 'RETRY'), 'w') as w:
+            w.write('0\n')
+        del self.ias3.requests[:]
+        self.assertEqual(1, self.upload(ws))
+        assert self.exists('SUCCESS')
+        assert self.exists(warcs[0][0] + '.tombstone')
+        self.assertEqual(['/%s/%s' % (ITEMID, w[0]) for w in warcs[1:]],
+                         [path for method, path, headers in
+                          self.ias3.requests])
+        journal = s3upload.SeriesJournal(journal.path)
+        for fn, digest in warcs:
+            self.assertEqual('verified', journal.state(fn))
+
+    def testRemoteResume(self):
+        """files found in the item are not uploaded again"""
+        ws, warcs = self.prepare(upload_concurrency=1, remote_resume=1)
+        self.ias3.fail = [None, None, 500]
+        self.assertEqual(0, self.upload(ws))
+        # lost track of the upload of the first file
+        os.remove(os.path.join(self.itemdir, warcs[0][0] + '.tombstone'))
+        os.remove(os.path.join(self.itemdir, 'JOURNAL'))
+        # and the second file in the item is broken
+        self.ias3.items[ITEMID][warcs[1][0]] = b'x'
+        with open(os.path.join(self.itemdir, 'RETRY'), 'w') as w:
+            w.write('0\n')
+        del self.ias3.requests[:]
+        self.assertEqual(1, self.upload(ws))
+        assert self.exists('SUCCESS')
+        assert self.exists(warcs[0][0] + '.tombstone')
+        self.assertEqual(
+            [('GET', '/%s/%s_files.xml' % (ITEMID, ITEMID))] +
+            [('PUT', '/%s/%s' % (ITEMID, w[0])) for w in warcs[1:]],
+            [(method, path) for method, path, headers in
+             self.ias3.requests])
+        journal = s3upload.SeriesJournal(os.path.join(self.itemdir,
+                                                      'JOURNAL'))
+        self.assertEqual('verified', journal.state(warcs[0][0]))
+        # keys are sent to S3 endpoint only, not to download_base
+        self.assertEqual([('localhost', False), ('127.0.0.1', True),
+                          ('127.0.0.1', True)],
+                         [(headers['Host'].split(':')[0],
+                           'authorization' in headers)
+                          for method, path, headers in self.ias3.requests])
+
+    def testBadETag(self):
+        ws, warcs = self.prepare()
+        self.ias3.etag = '0' * 32
+        self.assertEqual(0, self.upload(ws))
+        assert self.exists('ERROR')
+        assert not self.exists('SUCCESS')
+
+    def testTestMode(self):
+        ws, warcs = self.prepare()
+        self.assertEqual(1, self.upload(ws, mode='test'))
+        self.assertEqual([], self.ias3.requests)
+
+    # 4 parts of 3000 bytes, the last being 1000 bytes
+    MULTIPART = dict(size=10000, multipart_threshold=5000/1024/1024,
+                     multipart_part_size=3000/1024/1024)
+
+    def testMultipart(self):
+        ws, warcs = self.prepare(**self.MULTIPART)
+        self.assertEqual(1, self.upload(ws))
+        assert self.exists('SUCCESS')
+        item = self.ias3.items[ITEMID]
+        for fn, digest in warcs:
+            self.assertEqual(digest, md5(item[fn]).hexdigest())
+            assert self.exists(fn + '.tombstone')
+            assert not self.exists(fn + '.multipart')
+        parts = [(m, p) for m, p, h in self.ias3.requests
+                 if m == 'PUT' and p != '/%s/MANIFEST.txt' % ITEMID]
+        self.assertEqual(4 * len(warcs), len(parts))
+        self.assertEqual({}, self.ias3.uploads)
+
+    def testMultipartResume(self):
+        """parts completed before RETRY are not uploaded again"""
+        ws, warcs = self.prepare(upload_series=1, **self.MULTIPART)
+        # files are uploaded 2 at a time, parts of each 2 at a time.
+        # MANIFEST.txt, 2 initiates, 4 parts, then failure.
+        self.ias3.fail = [None] * 7 + [500]
+        self.assertEqual(0, self.upload(ws))
+        assert self.exists('RETRY')
+        journals = [fn + '.multipart' for fn, d in warcs
+                    if self.exists(fn + '.multipart')]
+        assert journals
+        remaining = 4 * sum(1 for fn, d in warcs
+                            if not self.exists(fn + '.tombstone'))
+        done = 0
+        for j in journals:
+            with open(os.path.join(self.itemdir, j)) as f:
+                done += sum(1 for l in f if l.startswith('done '))
+        assert done > 0
+
+        with open(os.path.join(self.itemdir, 'RETRY'), 'w') as w:
+            w.write('0\n')
+        self.ias3.requests = []
+        self.assertEqual(1, self.upload(ws))
+        assert self.exists('SUCCESS')
+        item = self.ias3.items[ITEMID]
+        for fn, digest in warcs:
+            self.assertEqual(digest, md5(item[fn]).hexdigest())
+        parts = [p for m, p, h in self.ias3.requests if m == 'PUT']
+        self.assertEqual(remaining - done, len(parts))
+
+    def testMultipartBadFile(self):
+        """file not matching MANIFEST is not uploaded"""
+        ws, warcs = self.prepare(**self.MULTIPART)
+        with open(os.path.join(self.itemdir, warcs[0][0]), 'r+b') as f:
+            f.write(b'x')
+        self.assertEqual(0, self.upload(ws))
+        assert self.exists('ERROR')
+        assert warcs[0][0] not in self.ias3.items[ITEMID]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import time
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import seriesindex
+
+class SeriesIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.ws = TestSpace(TESTCONF)
+
+    def series(self, name, *files):
+        d = os.path.join(self.ws.xferdir, name)
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        for fn in files:
+            with open(os.path.join(d, fn), 'w') as w:
+                w.write('1234\n')
+        return d
+
+    def touch_later(self, d, fn):
+        """create fn in d, making sure mtime of d changes"""
+        mtime = os.stat(d).st_mtime
+        open(os.path.join(d, fn), 'w').close()
+        os.utime(d, (mtime + 1, mtime + 1))
+
+    def testState(self):
+        self.series('a', 'PACKED', 'MANIFEST', 'RETRY', 'LAUNCH.open',
+                    'x.warc.gz', 'y.warc.gz', 'x.warc.gz.tombstone')
+        index = seriesindex.SeriesIndex(self.ws.xferdir)
+        self.assertEqual(1, index.rebuild())
+        st = index.get('a')
+        self.assertEqual(frozenset(['PACKED', 'MANIFEST', 'RETRY',
+                                    'LAUNCH.open']), st.markers)
+        self.assertEqual('1234', st.retry)
+        self.assertEqual((2, 1), (st.warcs, st.warcs_done))
+        self.assertEqual(None, index.get('b'))
+        self.assertEqual(['a'], index.with_marker('RETRY'))
+        self.assertEqual([], index.with_marker('LAUNCH'))
+
+    def testPersistent(self):
+        self.series('a', 'PACKED')
+        index = seriesindex.SeriesIndex(self.ws.xferdir)
+        index.rebuild()
+        index.close()
+        index = seriesindex.SeriesIndex(self.ws.xferdir)
+        self.assertEqual(1, len(index))
+        assert index.get('a').has('PACKED')
+
+    def testOutOfDate(self):
+        """rows are refreshed when series directory has changed"""
+        d = self.series('a', 'PACKED')
+        index = seriesindex.SeriesIndex(self.ws.xferdir)
+        self.assertEqual(['a'], [st.name for st in index.all()])
+        self.touch_later(d, 'MANIFEST')
+        assert index.get('a').has('MANIFEST')
+        # new and removed series
+        self.series('b')
+        os.rename(d, os.path.join(self.ws.dir, 'a'))
+        mtime = os.stat(self.ws.xferdir).st_mtime
+        os.utime(self.ws.xferdir, (mtime + 1, mtime + 1))
+        self.assertEqual(['b'], [st.name for st in index.all()])
+
+    def testMostRecentFirst(self):
+        a = self.series('a')
+        b = self.series('b')
+        os.utime(a, (time.time() + 10, time.time() + 10))
+        index = seriesindex.SeriesIndex(self.ws.xferdir)
+        self.assertEqual(['a', 'b'], [st.name for st in index.all()])
+
+    def testIter(self):
+        """series are listed in pages, most recent first, across
+        batches"""
+        now = time.time()
+        names = ['s%02d' % i for i in range(10)]
+        for i, name in enumerate(names):
+            d = self.series(name, 'SUCCESS' if i % 2 else 'LAUNCH.open')
+            # s00 and s01 have the same mtime
+            t = now - max(i, 1)
+            os.utime(d, (t, t))
+        index = seriesindex.SeriesIndex(self.ws.xferdir)
+        order = ['s00', 's01'] + names[2:]
+        save = seriesindex.BATCH_SIZE
+        seriesindex.BATCH_SIZE = 3
+        try:
+            self.assertEqual(order, [st.name for st in index.iter()])
+            self.assertEqual(order[2:7], [st.name for st in
+                                          index.iter(limit=5, offset=2)])
+            self.assertEqual(order[1::2], [st.name for st in
+                                           index.iter('completed')])
+            self.assertEqual(['s04', 's06'], [st.name for st in index.iter(
+                        'running', limit=2, offset=2)])
+        finally:
+            seriesindex.BATCH_SIZE = save
+        self.assertEqual(10, index.count())
+        self.assertEqual(5, index.count('active'))
+        self.assertEqual(0, index.count('retry'))
+        self.assertRaises(ValueError, list, index.iter('bogus'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import sourcestats
+
+class SourceSamplerTest(unittest.TestCase):
+    def setUp(self):
+        self.ws = TestSpace(TESTCONF)
+
+    def write(self, name, size):
+        with open(os.path.join(self.ws.jobdir, name), 'wb') as f:
+            f.write(b'x' * size)
+
+    def testSample(self):
+        self.write('a.warc.gz', 100)
+        self.write('b.arc.gz', 200)
+        self.write('c.warc.gz.open', 400)
+        sampler = sourcestats.SourceSampler(self.ws.jobdir, 3600)
+        s = sampler.snapshot
+        assert s.exists
+        self.assertEqual((2, 300), (s.warcs, s.warcs_size))
+        assert 0 < s.free <= s.total
+        self.assertEqual(None, s.fill_rate)
+
+        self.write('d.warc', 1000)
+        s = sampler.sample()
+        self.assertEqual((3, 1300), (s.warcs, s.warcs_size))
+        assert s.fill_rate is not None
+
+    def testUnchanged(self):
+        """job_dir is not listed again while its mtime is the same"""
+        self.write('a.warc.gz', 100)
+        sampler = sourcestats.SourceSampler(self.ws.jobdir, 3600)
+        st = os.stat(self.ws.jobdir)
+        os.remove(os.path.join(self.ws.jobdir, 'a.warc.gz'))
+        os.utime(self.ws.jobdir, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(1, sampler.sample().warcs)
+        os.utime(self.ws.jobdir)
+        self.assertEqual(0, sampler.sample().warcs)
+
+    def testNoJobDir(self):
+        sampler = sourcestats.SourceSampler(
+            os.path.join(self.ws.dir, 'nonexistent'), 3600)
+        assert not sampler.snapshot.exists
+
+if __name__ == '__main__':
+    unittest.main()
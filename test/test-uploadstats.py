@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import json
+from tempfile import NamedTemporaryFile
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import uploadstats
+from uploadstats import Histogram, UploadStats
+
+class HistogramTest(unittest.TestCase):
+    def testPercentile(self):
+        h = Histogram((1, 2, 4, 8))
+        self.assertIsNone(h.percentile(50))
+        for v in (0.5, 1.5, 1.5, 3, 100):
+            h.add(v)
+        self.assertEqual([1, 2, 1, 0, 1], h.counts)
+        self.assertEqual(5, h.count)
+        self.assertEqual(2, h.percentile(50))
+        # above all bounds
+        self.assertEqual(100, h.percentile(99))
+        # upper bound of the bucket, but not below min nor above max
+        self.assertEqual(1, h.percentile(10))
+        h = Histogram((1, 2, 4, 8))
+        h.add(3)
+        self.assertEqual(3, h.percentile(50))
+        self.assertEqual(3, h.mean)
+
+class UploadStatsTest(unittest.TestCase):
+    def testRecord(self):
+        stats = UploadStats()
+        mb = 1024 * 1024
+        stats.record('http://a', 200, 10 * mb,
+                     dict(connect=0.1, send=2.0, response=0.5, total=2.6))
+        stats.record('http://a', 503, 10 * mb,
+                     dict(connect=0.0, send=0.0, response=0.2, total=0.2))
+        stats.record('http://b', 0, 0, {})
+        # small request is not counted in throughput
+        stats.record('http://b', 201, 100,
+                     dict(send=0.001, response=0.1, total=0.1))
+        a, b = stats.endpoints()
+        self.assertEqual(('http://a', 'http://b'), (a.endpoint, b.endpoint))
+        self.assertEqual(2, a.requests)
+        self.assertEqual(10 * mb, a.bytes)
+        self.assertEqual({200: 1, 503: 1}, a.codes)
+        self.assertEqual(1, a.errors)
+        self.assertEqual(2, a.latency.count)
+        # ttfb and throughput are of successful requests only
+        self.assertEqual(1, a.ttfb.count)
+        self.assertEqual(1, a.throughput.count)
+        self.assertAlmostEqual(5 * mb, a.throughput.sum)
+        self.assertAlmostEqual(0.05, a.phase_mean('connect'))
+        self.assertEqual(0, b.throughput.count)
+        self.assertEqual(1, b.errors)
+
+        total = stats.total
+        self.assertEqual(4, total.requests)
+        self.assertEqual(2, total.errors)
+        self.assertEqual(3, total.latency.count)
+        d = json.loads(json.dumps(stats.to_dict()))
+        self.assertEqual(4, d['total']['requests'])
+        self.assertEqual(['http://a', 'http://b'],
+                         [e['endpoint'] for e in d['endpoints']])
+        self.assertEqual(1, d['endpoints'][0]['codes']['503'])
+
+    def testReadTask(self):
+        with NamedTemporaryFile(mode='w') as f:
+            f.write('https://s3.us.archive.org/item/MANIFEST.txt\n'
+                    '  response_code 200\n'
+                    '  size_upload_bytes 1000\n'
+                    '  total_time_seconds 0.500\n'
+                    '  time_connect_seconds 0.100\n'
+                    '  time_response_seconds 0.300\n'
+                    'https://s3.us.archive.org/item/a.warc.gz\n'
+                    '  response_code 503\n'
+                    '  size_upload_bytes 0\n'
+                    '  total_time_seconds 1.5\n')
+            f.flush()
+            tasks = list(uploadstats.read_task(f.name))
+        self.assertEqual([
+                ('https://s3.us.archive.org/item/MANIFEST.txt', 200, 1000,
+                 dict(total=0.5, connect=0.1, response=0.3)),
+                ('https://s3.us.archive.org/item/a.warc.gz', 503, 0,
+                 dict(total=1.5))], tasks)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import asyncio
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../lib")))
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+from tornado import gen
+from uploadwindow import AdaptiveWindow
+
+class AdaptiveWindowTest(unittest.TestCase):
+    def testIncrease(self):
+        """window grows by 1 per window-full of successful requests,
+        while it is in use"""
+        async def test():
+            w = AdaptiveWindow(2, 4)
+            for i in range(4):
+                a, b = await w.acquire(), await w.acquire()
+                w.release(a, 200)
+                w.release(b, 200)
+            return w
+        w = asyncio.run(test())
+        self.assertEqual(3, w.limit)
+        self.assertEqual(0, w.in_flight)
+        self.assertEqual((3, 'raised'), w.recent()[0][1:])
+
+    def testNoIncreaseIdle(self):
+        """window does not grow if not all of it is used"""
+        async def test():
+            w = AdaptiveWindow(4, 8)
+            for i in range(20):
+                w.release(await w.acquire(), 200)
+            return w
+        w = asyncio.run(test())
+        self.assertEqual(4, w.limit)
+        self.assertEqual(0, w.increases)
+
+    def testMaximum(self):
+        async def test():
+            w = AdaptiveWindow(1, 2)
+            for i in range(10):
+                w.release(await w.acquire(), 200)
+            return w
+        w = asyncio.run(test())
+        self.assertEqual(2, w.limit)
+        w.set_maximum(1)
+        self.assertEqual(1, w.limit)
+
+    def testDecrease(self):
+        """window is cut in half on 503 and errors, once per round trip,
+        and not below 1. other errors leave it as is."""
+        async def test():
+            w = AdaptiveWindow(8, 8)
+            tokens = [await w.acquire() for i in range(4)]
+            w.release(tokens[0], 503)
+            self.assertEqual(4, w.limit)
+            # sent before the cut
+            w.release(tokens[1], 503)
+            self.assertEqual(4, w.limit)
+            w.release(tokens[2], 500)
+            w.release(tokens[3], 404)
+            self.assertEqual(4, w.limit)
+            for i in range(3):
+                await gen.sleep(0.001)
+                w.release(await w.acquire(), congested=True)
+            self.assertEqual(1, w.limit)
+            w.release(await w.acquire(), 429)
+            return w
+        w = asyncio.run(test())
+        self.assertEqual(1, w.limit)
+        self.assertEqual(5, w.decreases)
+        self.assertEqual([1, 2, 4], [h[1] for h in w.recent()])
+
+    def testWait(self):
+        """acquire waits for a free slot in window"""
+        async def test():
+            w = AdaptiveWindow(2, 2)
+            running = []
+            peak = []
+            async def request(n):
+                token = await w.acquire()
+                running.append(n)
+                peak.append(len(running))
+                await gen.sleep(0.01)
+                running.remove(n)
+                w.release(token, 200)
+            await asyncio.gather(*[request(n) for n in range(5)])
+            return max(peak), w
+        peak, w = asyncio.run(test())
+        self.assertEqual(2, peak)
+        self.assertEqual(0, w.in_flight)
+
+if __name__ == '__main__':
+    unittest.main()
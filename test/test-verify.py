@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+import asyncio
+from hashlib import md5
+from io import StringIO
+
+from testutils import *
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../")))
+
+import config
+import httppool
+import verify
+
+ITEMS = ['WIDE-20130209104118-00000-00002-localhost',
+         'WIDE-20130209114118-00003-00005-localhost']
+
+def warc_names(n):
+    return ['WIDE-20130209104118%03d-%05d-2145~localhost~9443' % (i, i)
+            for i in range(n * 3, n * 3 + 3)]
+
+def flip_last(content):
+    """content with its last byte changed"""
+    return content[:-1] + bytes([content[-1] ^ 1])
+
+class VerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.ias3 = FakeIAS3()
+        self.ws = TestSpace(dict(TESTCONF, verify_concurrency=2))
+        self.ws.write_s3cfg()
+        self.warcs = {}
+        for n, item in enumerate(ITEMS):
+            self.warcs[item] = self.ws.prepare_launch_transfers(
+                item, warc_names(n))
+            d = self.itemdir(item)
+            open(os.path.join(d, 'LAUNCH'), 'w').close()
+            # item as uploaded
+            self.ias3.items[item] = {}
+            for fn, digest in self.warcs[item]:
+                with open(os.path.join(d, fn), 'rb') as f:
+                    self.ias3.items[item][fn] = f.read()
+
+    def itemdir(self, item):
+        return os.path.join(self.ws.xferdir, item)
+
+    def exists(self, item, fn):
+        return os.path.exists(os.path.join(self.itemdir(item), fn))
+
+    def verify(self, names=None, method='size', **kw):
+        async def run():
+            self.ias3.start()
+            try:
+                conf = config.DrainConfig(self.ws.configpath)
+                conf.cfg['download_base'] = self.ias3.download_base
+                conf.cfg.update(kw)
+                conf.validate()
+                out = StringIO()
+                self.verifier = verify.Verifier(conf, out=out, method=method)
+                try:
+                    return await self.verifier.run(names)
+                finally:
+                    sys.stderr.write(out.getvalue())
+                    self.stats = self.verifier.client.pool.stats
+            finally:
+                self.ias3.stop()
+                httppool.KeepAliveHTTPClient().close()
+        return asyncio.run(run())
+
+    def testVerify(self):
+        self.assertEqual(2, self.verify())
+        for item in ITEMS:
+            assert self.exists(item, 'TOMBSTONE')
+            assert not self.exists(item, 'VERIFYING.open')
+            for fn, digest in self.warcs[item]:
+                assert self.exists(item, fn + '.tombstone')
+            with open(os.path.join(self.itemdir(item), 'TOMBSTONE')) as f:
+                self.assertEqual(['%s/%s/%s' % (self.ias3.download_base, item, fn)
+                                  for fn, digest in self.warcs[item]],
+                                 f.read().splitlines())
+        # one files.xml per item, and nothing else
+        self.assertEqual(sorted(('GET', '/%s/%s_files.xml' % (item, item))
+                                for item in ITEMS),
+                         sorted((method, path) for method, path, headers
+                                in self.ias3.requests))
+        # public downloads: keys are not sent
+        self.assertNotIn('authorization', self.ias3.requests[0][2])
+
+        # verified series are not verified again, unless named
+        del self.ias3.requests[:]
+        self.assertEqual(0, self.verify())
+        self.assertEqual([], self.ias3.requests)
+        self.assertEqual(1, self.verify([ITEMS[0]]))
+        self.assertEqual(1, len(self.ias3.requests))
+
+    def testMismatch(self):
+        fn0, fn1 = self.warcs[ITEMS[0]][0][0], self.warcs[ITEMS[0]][1][0]
+        self.ias3.items[ITEMS[0]][fn0] = b'x'
+        # cleaned after upload: size is not checked
+        path = os.path.join(self.itemdir(ITEMS[0]), fn1)
+        with open(path + '.tombstone', 'w') as w:
+            w.write('http://www.archive.org/download/%s/%s\n' % (
+                    ITEMS[0], fn1))
+        os.remove(path)
+        self.assertEqual(1, self.verify())
+        self.assertEqual(1, self.verifier.counts['error'])
+        assert self.exists(ITEMS[0], 'ERROR')
+        assert not self.exists(ITEMS[0], 'TOMBSTONE')
+        assert not self.exists(ITEMS[0], fn0 + '.tombstone')
+        with open(os.path.join(self.itemdir(ITEMS[0]), 'ERROR')) as f:
+            self.assertEqual(['ERROR: BAD_REMOTE_CHECKSUM (%s) %s' % (
+                        '9dd4e461268c8034f5c8564e155c67a6', fn0)],
+                             f.read().splitlines())
+        assert self.exists(ITEMS[1], 'TOMBSTONE')
+
+    def testPending(self):
+        """series whose files are not all in the item are left for the
+        next run"""
+        fn = self.warcs[ITEMS[0]][2][0]
+        del self.ias3.items[ITEMS[0]][fn]
+        del self.ias3.items[ITEMS[1]]
+        self.assertEqual(0, self.verify())
+        self.assertEqual(2, self.verifier.counts['pending'])
+        for item in ITEMS:
+            assert not self.exists(item, 'TOMBSTONE')
+            assert not self.exists(item, 'ERROR')
+            assert not self.exists(item, 'VERIFYING.open')
+        assert self.exists(ITEMS[0], self.warcs[ITEMS[0]][0][0] +
+                           '.tombstone')
+        assert not self.exists(ITEMS[0], fn + '.tombstone')
+
+        with open(os.path.join(self.itemdir(ITEMS[0]), fn), 'rb') as f:
+            self.ias3.items[ITEMS[0]][fn] = f.read()
+        self.assertEqual(1, self.verify())
+        assert self.exists(ITEMS[0], 'TOMBSTONE')
+
+    def testFailure(self):
+        """failure in one series leaves no VERIFYING.open, and does not
+        stop others"""
+        # unreadable MANIFEST
+        path = os.path.join(self.itemdir(ITEMS[0]), 'MANIFEST')
+        os.rename(path, path + '.x')
+        os.mkdir(path)
+        self.assertEqual(1, self.verify())
+        self.assertEqual(1, self.verifier.counts['error'])
+        assert self.exists(ITEMS[0], 'ERROR')
+        assert not self.exists(ITEMS[0], 'VERIFYING.open')
+        assert self.exists(ITEMS[1], 'TOMBSTONE')
+
+        # named series without MANIFEST
+        self.assertEqual(0, self.verify(['NOSUCHITEM']))
+        self.assertEqual(1, self.verifier.counts['error'])
+        assert not os.path.exists(os.path.join(self.ws.xferdir,
+                                               'NOSUCHITEM'))
+
+    def testNetworkError(self):
+        """series are left pending on network errors"""
+        from tornado.testing import bind_unused_port
+        sock, port = bind_unused_port()
+        sock.close()
+        for method in verify.METHODS:
+            self.assertEqual(0, self.verify(
+                    method=method, download_base='http://127.0.0.1:%d' % port))
+            self.assertEqual(2, self.verifier.counts['pending'])
+            for item in ITEMS:
+                assert not self.exists(item, 'ERROR')
+
+    def testDownload(self):
+        self.assertEqual(2, self.verify(method='download'))
+        for item in ITEMS:
+            assert self.exists(item, 'TOMBSTONE')
+            for fn, digest in self.warcs[item]:
+                assert self.exists(item, fn + '.tombstone')
+        # each file downloaded, and no files.xml
+        self.assertEqual(sorted(('GET', '/%s/%s' % (item, fn))
+                                for item in ITEMS
+                                for fn, digest in self.warcs[item]),
+                         sorted((method, path) for method, path, headers
+                                in self.ias3.requests))
+
+    def testDownloadMismatch(self):
+        fn0, fn1 = self.warcs[ITEMS[0]][0][0], self.warcs[ITEMS[0]][1][0]
+        content = self.ias3.items[ITEMS[0]][fn0]
+        self.ias3.items[ITEMS[0]][fn0] = flip_last(content)
+        # not in item yet
+        del self.ias3.items[ITEMS[1]][self.warcs[ITEMS[1]][0][0]]
+        self.assertEqual(0, self.verify(method='download'))
+        self.assertEqual(1, self.verifier.counts['error'])
+        self.assertEqual(1, self.verifier.counts['pending'])
+        with open(os.path.join(self.itemdir(ITEMS[0]), 'ERROR')) as f:
+            self.assertEqual(['ERROR: BAD_CHECKSUM %s %s' % (
+                        md5(flip_last(content)).hexdigest(), fn0)],
+                             f.read().splitlines())
+        assert self.exists(ITEMS[0], fn1 + '.tombstone')
+        assert not self.exists(ITEMS[1], 'TOMBSTONE')
+        assert not self.exists(ITEMS[1], 'ERROR')
+
+    def testSample(self):
+        self.assertEqual(2, self.verify(method='sample', verify_samples=3,
+                                        verify_sample_size=0.0001))
+        for item in ITEMS:
+            assert self.exists(item, 'TOMBSTONE')
+        # 3 ranges of 104 bytes per file, the last one at the end
+        ranges = {}
+        for method, path, headers in self.ias3.requests:
+            self.assertEqual('GET', method)
+            ranges.setdefault(path, []).append(headers['Range'])
+        self.assertEqual(6, len(ranges))
+        for path, r in ranges.items():
+            self.assertEqual(3, len(r))
+            self.assertEqual('bytes=920-1023', r[-1])
+
+    def testSampleMismatch(self):
+        fn0, fn1 = self.warcs[ITEMS[0]][0][0], self.warcs[ITEMS[0]][1][0]
+        # differs at the end, which is always sampled
+        content = self.ias3.items[ITEMS[0]][fn0]
+        self.ias3.items[ITEMS[0]][fn0] = flip_last(content)
+        # truncated
+        self.ias3.items[ITEMS[0]][fn1] = self.ias3.items[ITEMS[0]][fn1][:-1]
+        self.assertEqual(1, self.verify(method='sample',
+                                        verify_sample_size=0.0001))
+        with open(os.path.join(self.itemdir(ITEMS[0]), 'ERROR')) as f:
+            errors = sorted(f.read().splitlines())
+        self.assertEqual(2, len(errors))
+        assert errors[0].startswith('ERROR: BAD_CHECKSUM of bytes 920-1023 ')
+        self.assertEqual('ERROR: BAD_REMOTE_FILESIZE (1023) %s' % fn1,
+                         errors[1])
+
+    def testSampleRanges(self):
+        conf = config.DrainConfig(self.ws.configpath)
+        verifier = verify.Verifier(conf, method='sample')
+        verifier.sample_size = 1024
+        # smaller than a range
+        self.assertEqual([(0, 1000)], verifier.sample_ranges(1000))
+        self.assertEqual([(0, 1024)], verifier.sample_ranges(1024))
+        self.assertEqual([], verifier.sample_ranges(0))
+        # exact multiple: all ranges there are
+        self.assertEqual([(0, 1024), (1024, 1024), (2048, 1024),
+                          (3072, 1024)], verifier.sample_ranges(4096))
+        verifier.samples = 8
+        self.assertEqual([(0, 1024), (1024, 1024)],
+                         verifier.sample_ranges(2048))
+        ranges = verifier.sample_ranges(1024 * 100 + 1)
+        self.assertEqual(8, len(ranges))
+        self.assertEqual((1024 * 99 + 1, 1024), ranges[-1])
+
+    def testSampleSmallFiles(self):
+        """files smaller than verify_sample_size are checked whole"""
+        self.assertEqual(2, self.verify(method='sample'))
+        self.assertEqual(['bytes=0-1023'] * 6,
+                         [headers['Range'] for method, path, headers
+                          in self.ias3.requests])
+
+    def testSampleCleaned(self):
+        """files cleaned after upload are checked against files.xml"""
+        fn = self.warcs[ITEMS[0]][0][0]
+        path = os.path.join(self.itemdir(ITEMS[0]), fn)
+        with open(path + '.tombstone', 'w') as w:
+            w.write('http://www.archive.org/download/%s/%s\n' % (
+                    ITEMS[0], fn))
+        os.remove(path)
+        self.assertEqual(2, self.verify(method='sample'))
+        assert self.exists(ITEMS[0], 'TOMBSTONE')
+        self.assertEqual(
+            ['/%s/%s_files.xml' % (ITEMS[0], ITEMS[0])],
+            [path for method, path, headers in self.ias3.requests
+             if 'Range' not in headers])
+
+        # mismatch in files.xml is an error
+        self.ias3.items[ITEMS[0]][fn] = b'x'
+        os.remove(os.path.join(self.itemdir(ITEMS[0]), 'TOMBSTONE'))
+        self.assertEqual(0, self.verify([ITEMS[0]], method='sample'))
+        assert self.exists(ITEMS[0], 'ERROR')
+
+    def testFilesXmlParser(self):
+        import s3upload
+        parser = s3upload.FilesXmlParser()
+        doc = (b'<files><file name="a.warc.gz" source="original">'
+               b'<size>10</size><md5>abc</md5></file>'
+               b'<file name="a_meta.xml" source="metadata"><md5>def</md5>'
+               b'</file></files>')
+        for i in range(0, len(doc), 7):
+            parser.feed(doc[i:i + 7])
+        self.assertEqual({'a.warc.gz': (10, 'abc'),
+                          'a_meta.xml': (None, 'def')}, parser.close())
+
+if __name__ == '__main__':
+    unittest.main()
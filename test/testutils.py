@@ -4,6 +4,7 @@ import sys
 import os
 import shutil
 import random
+import re
 import gzip
 from tempfile import mkdtemp
 from io import StringIO
@@ -13,8 +14,11 @@ sys.path.append(os.path.abspath(
     os.path.join(os.path.dirname(__file__), "../lib")))
 
 import yaml
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
 
-__all__ = ['bin', 'TESTCONF', 'TestSpace']
+__all__ = ['bin', 'TESTCONF', 'TEST_WARCINFO', 'TestSpace', 'FakeIAS3']
 
 BINDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 def bin(f):
@@ -72,6 +76,12 @@ class TestSpace(object):
     def __del__(self):
         if os.path.isdir(self.dir):
             shutil.rmtree(self.dir)
+    def write_s3cfg(self):
+        """write .ias3cfg next to config file (first place config.py
+        looks for it)."""
+        with open(os.path.join(self.dir, '.ias3cfg'), 'w') as w:
+            w.write('[default]\naccess_key = ACCESS\nsecret_key = SECRET\n')
+
     @property
     def jobdir(self):
         return os.path.join(self.dir, 'warcs')
@@ -122,13 +132,12 @@ class TestSpace(object):
         assert isinstance(length, int)
         return bytearray(random.getrandbits(8) for i in range(length))
 
-    def prepare_launch_transfers(self, iid, names):
+    def prepare_launch_transfers(self, iid, names, SIZE=1024):
         """create new item directory, fake WARC files, PACKED, and MANIFEST,
         emulating pack-warcs and make-manifest processes, just true enough for
         testing s3-launch-transfers.
         """
         print("creating test data in %s" % self.jobdir, file=sys.stderr)
-        SIZE = 1024
 
         itemdir = os.path.join(self.xferdir, iid)
         os.makedirs(itemdir)
@@ -159,3 +168,143 @@ class TestSpace(object):
                 w.write('%s  %s\n' % (warc[1], warc[0]))
 
         return warcs
+
+class FakeIAS3(object):
+    """stand-in of IAS3 (and download server, with files.xml of items)
+    for testing uploads.
+    must be started on the IOLoop running the code under test.
+
+    items: {bucket: {filename: content}}
+    requests: list of (method, path, headers) received
+    fail: list of response codes to return (one each) before succeeding.
+      None lets request through.
+    uploads: {upload_id: {part_number: content}} of multipart uploads
+    """
+    def __init__(self):
+        self.items = {}
+        self.requests = []
+        self.fail = []
+        self.etag = None
+        self.uploads = {}
+
+    class Handler(web.RequestHandler):
+        def initialize(self, ias3):
+            self.ias3 = ias3
+
+        def record(self):
+            self.ias3.requests.append(
+                (self.request.method, self.request.path, self.request.headers))
+            code = self.ias3.fail.pop(0) if self.ias3.fail else None
+            if code:
+                self.set_status(code)
+                return False
+            return True
+
+        def head(self, bucket, filename):
+            if not self.record(): return
+            if bucket not in self.ias3.items:
+                self.set_status(404)
+
+        def get(self, bucket, filename):
+            """download of item file, or files.xml of the item"""
+            if not self.record(): return
+            item = self.ias3.items.get(bucket)
+            if item is None:
+                self.set_status(404)
+            elif filename == '%s_files.xml' % bucket:
+                self.set_header('Content-Type', 'text/xml')
+                self.write('<files>\n')
+                for fn in sorted(item):
+                    self.write('<file name="%s" source="original">'
+                               '<size>%d</size><md5>%s</md5></file>\n' % (
+                            fn, len(item[fn]), md5(item[fn]).hexdigest()))
+                self.write('</files>\n')
+            elif filename in item:
+                content = item[filename]
+                m = re.match(r'bytes=(\d+)-(\d+)$',
+                             self.request.headers.get('Range', ''))
+                if m:
+                    start = int(m.group(1))
+                    end = min(int(m.group(2)), len(content) - 1)
+                    self.set_status(206)
+                    self.set_header('Content-Range', 'bytes %d-%d/%d' % (
+                            start, end, len(content)))
+                    content = content[start:end + 1]
+                self.write(content)
+            else:
+                self.set_status(404)
+
+        def put(self, bucket, filename):
+            if not self.record(): return
+            body = self.request.body
+            upload_id = self.get_query_argument('uploadId', None)
+            if upload_id is not None:
+                if upload_id not in self.ias3.uploads:
+                    self.set_status(404, 'NoSuchUpload')
+                    return
+                if self.check_md5(body):
+                    n = int(self.get_query_argument('partNumber'))
+                    self.ias3.uploads[upload_id][n] = body
+                return
+            if bucket not in self.ias3.items:
+                if self.request.headers.get('x-archive-auto-make-bucket') \
+                        != '1':
+                    self.set_status(404)
+                    return
+                self.ias3.items[bucket] = {}
+            if self.check_md5(body):
+                self.ias3.items[bucket][filename] = body
+
+        def check_md5(self, body):
+            """check Content-MD5 and set ETag"""
+            digest = md5(body).hexdigest()
+            cmd5 = self.request.headers.get('Content-MD5')
+            if cmd5 and cmd5 != digest:
+                self.set_status(400, 'BadDigest')
+                return False
+            self.set_header('ETag', '"%s"' % (self.ias3.etag or digest))
+            return True
+
+        def post(self, bucket, filename):
+            """multipart upload: initiate and complete"""
+            if not self.record(): return
+            if self.get_query_argument('uploads', None) is not None:
+                if bucket not in self.ias3.items:
+                    self.ias3.items[bucket] = {}
+                upload_id = 'upload-%d' % len(self.ias3.requests)
+                self.ias3.uploads[upload_id] = {}
+                self.write('<InitiateMultipartUploadResult><UploadId>%s'
+                           '</UploadId></InitiateMultipartUploadResult>' %
+                           upload_id)
+                return
+            upload_id = self.get_query_argument('uploadId')
+            parts = self.ias3.uploads.pop(upload_id, None)
+            if parts is None:
+                self.set_status(404, 'NoSuchUpload')
+                return
+            content = b''.join(parts[n] for n in sorted(parts))
+            self.ias3.items[bucket][filename] = content
+            digests = b''.join(md5(parts[n]).digest() for n in sorted(parts))
+            etag = '%s-%d' % (md5(digests).hexdigest(), len(parts))
+            self.write('<CompleteMultipartUploadResult><ETag>"%s"</ETag>'
+                       '</CompleteMultipartUploadResult>' % etag)
+
+    def start(self):
+        app = web.Application([(r'/([^/]+)/(.*)', self.Handler,
+                                dict(ias3=self))])
+        sock, self.port = bind_unused_port()
+        self.server = HTTPServer(app)
+        self.server.add_sockets([sock])
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d' % self.port
+
+    @property
+    def download_base(self):
+        """same server as endpoint, by other host name"""
+        return 'http://localhost:%d' % self.port
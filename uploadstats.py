@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""timing statistics of upload requests
+Usage: uploadstats.py TASK ...
+    TASK  TASK or SUCCESS file of series uploaded by s3upload.py
+
+UploadStats aggregates timings of requests made by s3upload.py (see
+httppool.py for the phases of a request) into histograms, per endpoint
+and in total: latency (whole request), time to first byte of response
+after request body is sent (which is how long IAS3 takes to store the
+file), and throughput of request body. dtmon.py keeps one UploadStats
+per project, shown on admin page and at /uploadstats?pj=N as JSON.
+
+histograms have fixed, exponentially growing buckets, so that memory
+does not grow with the number of requests. percentiles are estimated
+from them, as upper bound of the bucket the percentile falls in.
+
+given TASK files, prints statistics of requests recorded in them.
+"""
+
+import sys, os, re
+import bisect
+import threading
+import time
+
+# timing fields of a request, as in httppool time_info
+PHASES = ('queue', 'connect', 'tls', 'continue', 'send', 'response',
+          'recv', 'total')
+
+# bucket upper bounds of latency (seconds), 1ms to ~35min, and of
+# throughput (bytes/s), 1KB/s to ~1GB/s
+LATENCY_BOUNDS = tuple(0.001 * 2**i for i in range(22))
+THROUGHPUT_BOUNDS = tuple(1024 * 2**i for i in range(21))
+
+# requests with smaller body are not counted in throughput, as their
+# time is mostly latency.
+MIN_THROUGHPUT_SIZE = 1024 * 1024
+
+class Histogram(object):
+    """counts of values in buckets. bucket i counts values no more than
+    bounds[i] (and greater than bounds[i-1]); the last bucket counts
+    values greater than all bounds."""
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.count += 1
+        self.sum += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, p):
+        """estimate of p-th percentile, or None if empty"""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                break
+        if i < len(self.bounds):
+            return max(min(self.bounds[i], self.max), self.min)
+        return self.max
+
+    def to_dict(self):
+        return dict(count=self.count, sum=self.sum, min=self.min,
+                    max=self.max,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99),
+                    buckets=[[b, n] for b, n in zip(
+                        list(self.bounds) + [None], self.counts) if n])
+
+class RequestStats(object):
+    """statistics of requests to one endpoint (or all of them)"""
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.requests = 0
+        # number of responses by status code. 0 for network errors.
+        self.codes = {}
+        # bytes of request body successfully sent
+        self.bytes = 0
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.ttfb = Histogram(LATENCY_BOUNDS)
+        self.throughput = Histogram(THROUGHPUT_BOUNDS)
+        # total seconds spent in each phase
+        self.phases = dict((p, 0.0) for p in PHASES)
+        self.last = None
+
+    def add(self, code, size, time_info):
+        self.requests += 1
+        self.codes[code] = self.codes.get(code, 0) + 1
+        self.last = time.time()
+        for p in PHASES:
+            self.phases[p] += time_info.get(p, 0.0)
+        if 'total' in time_info:
+            self.latency.add(time_info['total'])
+        if code == 0 or code >= 300:
+            return
+        self.bytes += size
+        if 'response' in time_info:
+            self.ttfb.add(time_info['response'])
+        send = time_info.get('send')
+        if size >= MIN_THROUGHPUT_SIZE and send:
+            self.throughput.add(size / send)
+
+    @property
+    def errors(self):
+        """requests failed, with network error or status >= 400"""
+        return sum(n for code, n in self.codes.items()
+                   if code == 0 or code >= 400)
+
+    def phase_mean(self, phase):
+        return self.phases[phase] / self.requests if self.requests else None
+
+    def to_dict(self):
+        return dict(endpoint=self.endpoint, requests=self.requests,
+                    codes=dict((str(k), v) for k, v in self.codes.items()),
+                    bytes=self.bytes, last=self.last,
+                    latency=self.latency.to_dict(),
+                    ttfb=self.ttfb.to_dict(),
+                    throughput=self.throughput.to_dict(),
+                    phases=dict((p, self.phase_mean(p)) for p in PHASES))
+
+class UploadStats(object):
+    """statistics of upload requests, per endpoint and total. record()
+    is called from the IOLoop uploading, and others from admin
+    server."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.total = RequestStats('all')
+        self.by_endpoint = {}
+
+    def record(self, endpoint, code, size, time_info):
+        """add a request to endpoint, with response status code (0 for
+        network error), size bytes of request body and time_info"""
+        with self.lock:
+            s = self.by_endpoint.get(endpoint)
+            if s is None:
+                s = self.by_endpoint[endpoint] = RequestStats(endpoint)
+            s.add(code, size, time_info)
+            self.total.add(code, size, time_info)
+
+    def endpoints(self):
+        """list of RequestStats of each endpoint"""
+        with self.lock:
+            return [self.by_endpoint[e] for e in sorted(self.by_endpoint)]
+
+    def to_dict(self):
+        with self.lock:
+            return dict(started=self.started, total=self.total.to_dict(),
+                        endpoints=[self.by_endpoint[e].to_dict()
+                                   for e in sorted(self.by_endpoint)])
+
+def format_seconds(v):
+    return '-' if v is None else '%.3fs' % v
+
+def format_rate(v):
+    return '-' if v is None else '%.2fMB/s' % (v / 1024.0**2)
+
+def summary(s):
+    """one line summary of RequestStats s"""
+    return ("%d requests, %d errors, %.2fMB;"
+            " latency p50 %s p90 %s p99 %s;"
+            " ttfb p50 %s p90 %s; throughput p50 %s p90 %s" % (
+            s.requests, s.errors, s.bytes / 1024.0**2,
+            format_seconds(s.latency.percentile(50)),
+            format_seconds(s.latency.percentile(90)),
+            format_seconds(s.latency.percentile(99)),
+            format_seconds(s.ttfb.percentile(50)),
+            format_seconds(s.ttfb.percentile(90)),
+            format_rate(s.throughput.percentile(50)),
+            format_rate(s.throughput.percentile(90))))
+
+def read_task(path):
+    """yields (url, code, size, time_info) of requests in TASK file"""
+    entry = None
+    with open(path) as f:
+        for l in f:
+            m = re.match(r'\s+(\w+) (\S+)$', l)
+            if m and entry:
+                k, v = m.groups()
+                if k == 'response_code':
+                    entry[1] = int(v)
+                elif k == 'size_upload_bytes':
+                    entry[2] = int(float(v))
+                elif k == 'total_time_seconds':
+                    entry[3]['total'] = float(v)
+                elif k.startswith('time_') and k.endswith('_seconds'):
+                    entry[3][k[5:-8]] = float(v)
+            elif l.strip():
+                if entry:
+                    yield tuple(entry)
+                entry = [l.strip(), 0, 0, {}]
+    if entry:
+        yield tuple(entry)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    stats = UploadStats()
+    for path in sys.argv[1:]:
+        for url, code, size, time_info in read_task(path):
+            m = re.match(r'(\w+://[^/]+)', url)
+            stats.record(m.group(1) if m else url, code, size, time_info)
+    for s in stats.endpoints() + [stats.total]:
+        print("%s: %s" % (s.endpoint, summary(s)))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""adaptive limit of concurrent upload requests (AIMD)
+
+AdaptiveWindow takes the place of a fixed semaphore of
+upload_max_connections in s3upload.py. the window of requests allowed
+in flight grows additively while responses are healthy (by 1 for each
+window-full of successful requests, as long as the window is in use),
+and is cut in half on 503, SlowDown, 429 and network errors or
+timeouts, down to 1. other errors leave it as it is. it is cut at most
+once per round trip: responses to requests sent before the last cut do
+not cut it again. the window never goes above upload_max_connections.
+
+dtmon.py keeps one window per project across runs, shown on admin page
+with its recent changes.
+"""
+
+import collections
+import threading
+import time
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+# window is multiplied by this on congestion
+DECREASE_FACTOR = 0.5
+# changes of window kept for admin page
+HISTORY_SIZE = 50
+
+# response status codes telling server is overloaded
+CONGESTION_CODES = (429, 503)
+
+class AdaptiveWindow(object):
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.window = float(min(max(initial, minimum), self.maximum))
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        # IOLoop time of the last decrease
+        self.cut_at = None
+        # futures of acquire() waiting for a slot. (not a
+        # tornado.locks.Condition, which is bound to the IOLoop it is
+        # made on: dtmon.py makes window outside of the uploading one.)
+        self.waiters = collections.deque()
+        self.lock = threading.Lock()
+        # (time, window, reason) of changes of limit
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+
+    @property
+    def limit(self):
+        """number of requests allowed in flight"""
+        return int(self.window)
+
+    def set_maximum(self, maximum):
+        """change upper limit of window (upload_max_connections)"""
+        self.maximum = max(maximum, self.minimum)
+        if self.window > self.maximum:
+            self.change(self.maximum, 'maximum %d' % self.maximum)
+
+    def change(self, window, reason):
+        old = self.limit
+        self.window = window
+        if self.limit != old:
+            with self.lock:
+                self.history.append((time.time(), self.limit, reason))
+            # more requests may be let in
+            self.notify()
+
+    def notify(self):
+        """wake up waiters for free slots"""
+        free = self.limit - self.in_flight
+        while free > 0 and self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+    async def acquire(self):
+        """wait for a slot in window. returns token to pass to
+        release()."""
+        while self.in_flight >= self.limit:
+            fut = Future()
+            self.waiters.append(fut)
+            await fut
+        self.in_flight += 1
+        return IOLoop.current().time()
+
+    def release(self, token, code=None, congested=None):
+        """release slot acquired at token, with response status code.
+        congested is True for network errors and timeouts."""
+        full = self.in_flight >= self.limit
+        self.in_flight -= 1
+        if congested is None:
+            congested = code in CONGESTION_CODES
+        if congested:
+            if self.cut_at is None or token >= self.cut_at:
+                self.cut_at = IOLoop.current().time()
+                self.decreases += 1
+                self.change(max(self.minimum, self.window * DECREASE_FACTOR),
+                            'cut on %s' % (code or 'error'))
+        elif code is not None and 200 <= code < 300 and full and \
+                self.window < self.maximum:
+            self.increases += 1
+            self.change(min(self.maximum, self.window + 1.0 / self.limit),
+                        'raised')
+        self.notify()
+
+    def recent(self, n=10):
+        """last n changes, most recent first"""
+        with self.lock:
+            return list(self.history)[-n:][::-1]
+
+    def summary(self):
+        return ("%d in flight of %d (max %d), %d raised, %d cut" % (
+                self.in_flight, self.limit, self.maximum, self.increases,
+                self.decreases))
+
+    def to_dict(self):
+        return dict(window=self.window, limit=self.limit,
+                    in_flight=self.in_flight, minimum=self.minimum,
+                    maximum=self.maximum, increases=self.increases,
+                    decreases=self.decreases,
+                    history=[list(h) for h in self.recent(HISTORY_SIZE)])
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+"""verify uploaded series against their items
+Usage: verify.py config [method] [series ...]
+    config  a YAML config file
+    method  size = check md5 and size in files.xml (default)
+            download = download files and check their md5
+            sample = check md5 of random byte ranges of files
+    series  names of series to verify, even if verified before.
+            all series waiting for verification if none given.
+
+in-process, concurrent equivalent of verify-transfers.sh
+(item-verify-size.sh, item-verify-download.sh,
+get-remote-warc-urls.sh). series waiting for verification are those
+uploaded (LAUNCH) without TOMBSTONE, and without VERIFYING.open or
+ERROR. requests go through httppool's KeepAliveHTTPClient, up to
+verify_concurrency (8 by default) at once: files.xml of as many items
+with size method, and downloads of as many files with the others.
+
+with size method, <item>_files.xml under download_base is fetched and
+parsed as it arrives (s3upload.FilesXmlParser). each file in MANIFEST
+is reconciled with files.xml in one pass: md5 must match MANIFEST, and
+size the local file (unless it has been cleaned already).
+
+with download method, MD5 of each file is computed on the response as
+it arrives, without writing the file anywhere, and checked against
+MANIFEST, along with size.
+
+sample method is for cheap spot checks of large items: for each file
+still in series directory, verify_samples (4 by default) ranges of
+verify_sample_size MB (1 by default) are requested with Range header,
+at random offsets and always including the end of the file. MD5 of
+each range must match the same range of the local file, and total size
+in Content-Range the size of the local file. files cleaned after
+upload are checked against files.xml, as with size method.
+
+verified files get .tombstone with their download URL. when all files
+in MANIFEST have .tombstone, TOMBSTONE is written with all of them. on
+mismatch, messages go to ERROR. series whose files are not all in the
+item yet (files.xml lags behind uploads) are left for the next run.
+
+progress of each series goes to VERIFYING.open, which is removed when
+done.
+"""
+
+import sys, os
+libdir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'lib'))
+if libdir not in sys.path:
+    sys.path.append(libdir)
+import asyncio
+import hashlib
+import random
+import re
+import time
+from xml.etree import ElementTree
+
+from tornado import locks
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.ioloop import IOLoop
+
+import config
+import httppool
+import s3upload
+
+METHODS = ('size', 'download', 'sample')
+
+# defaults for config parameters
+DEFAULT_CONCURRENCY = 8
+DEFAULT_SAMPLES = 4
+DEFAULT_SAMPLE_SIZE_MB = 1
+
+class VerifySeries(object):
+    """one series directory being verified"""
+    def __init__(self, d, out):
+        self.dir = d
+        self.name = os.path.basename(d)
+        self.bucket = self.name
+        self.out = out
+        for f in ('MANIFEST', 'LAUNCH', 'ERROR', 'TOMBSTONE'):
+            setattr(self, f, os.path.join(d, f))
+        self.OPEN = os.path.join(d, 'VERIFYING.open')
+        self.errors = []
+
+    def echo(self, msg):
+        print(msg, file=self.out)
+
+    def log(self, msg):
+        """echo msg and append it to VERIFYING.open"""
+        self.echo(msg)
+        with open(self.OPEN, 'a') as w:
+            w.write(msg + '\n')
+
+    def error(self, msg):
+        self.log(msg)
+        self.errors.append(msg)
+
+    def path(self, fn):
+        return os.path.join(self.dir, fn)
+
+    def tombstone(self, fn):
+        return os.path.join(self.dir, fn + '.tombstone')
+
+class Verifier(object):
+    def __init__(self, conf, out=None, method='size'):
+        if method not in METHODS:
+            raise ValueError('unknown method %r' % method)
+        self.method = method
+        self.config = conf
+        self.out = out or sys.stdout
+        self.xfer_dir = conf['xfer_dir']
+        self.download_base = (conf['download_base'] or
+                              s3upload.DOWNLOAD_BASE).rstrip('/')
+        self.concurrency = (conf['verify_concurrency'] or
+                            DEFAULT_CONCURRENCY)
+        self.samples = conf['verify_samples'] or DEFAULT_SAMPLES
+        self.sample_size = int((conf['verify_sample_size'] or
+                                DEFAULT_SAMPLE_SIZE_MB) * 1024 * 1024)
+        self.counts = dict(verified=0, pending=0, error=0)
+
+    def echo(self, msg):
+        print(msg, file=self.out)
+
+    def is_ready(self, s):
+        """True if series s is waiting for verification"""
+        if not os.path.exists(s.MANIFEST) or not os.path.exists(s.LAUNCH):
+            return False
+        for marker in (s.TOMBSTONE, s.OPEN, s.ERROR):
+            if os.path.exists(marker):
+                return False
+        return True
+
+    def ready_series(self):
+        for name in sorted(os.listdir(self.xfer_dir)):
+            s = VerifySeries(os.path.join(self.xfer_dir, name), self.out)
+            if os.path.isdir(s.dir) and self.is_ready(s):
+                yield s
+
+    async def stream(self, url, callback, headers=None):
+        """GET url, passing chunks of response body to callback as they
+        arrive. body of redirects and errors is not passed. returns
+        HTTPResponse (without body), with code 599 for network errors."""
+        # status of each response, redirects included
+        status = []
+        def header_callback(line):
+            if line.startswith('HTTP/'):
+                status.append(int(line.split()[1]))
+        def streaming_callback(chunk):
+            if status and 200 <= status[-1] < 300:
+                callback(chunk)
+        # downloads are public. S3 keys are not sent.
+        req = HTTPRequest(url, headers=headers or {}, connect_timeout=60,
+                          request_timeout=0, follow_redirects=True,
+                          header_callback=header_callback,
+                          streaming_callback=streaming_callback)
+        try:
+            return await self.client.fetch(req, raise_error=False)
+        except Exception as ex:
+            return HTTPResponse(req, 599, error=ex)
+
+    def download_url(self, s, fn):
+        return '%s/%s/%s' % (self.download_base, s.bucket, fn)
+
+    def failed(self, s, resp):
+        s.log("  failed with response_code: %d%s" % (
+                resp.code, ' (%s)' % resp.error if resp.code == 599
+                else ''))
+
+    async def fetch_files(self, s):
+        """{name: (size, md5)} of files in item of series s, or None if
+        files.xml could not be fetched"""
+        url = self.download_url(s, '%s_files.xml' % s.bucket)
+        s.log("fetching %s" % url)
+        parser = s3upload.FilesXmlParser()
+        resp = await self.stream(url, parser.feed)
+        if resp.code != 200:
+            self.failed(s, resp)
+            return None
+        try:
+            return parser.close()
+        except ElementTree.ParseError as ex:
+            s.log("  bad files.xml: %s" % ex)
+            return None
+
+    def verified(self, s, fn, msg):
+        """log msg and write .tombstone of fn"""
+        s.log(msg)
+        tombstone = s.tombstone(fn)
+        if not os.path.exists(tombstone):
+            with open(tombstone, 'w') as w:
+                w.write(self.download_url(s, fn) + '\n')
+
+    def reconcile(self, s, manifest, files):
+        """check files in manifest (list of (md5, filename)) against
+        files from files.xml, writing .tombstone for those verified.
+        returns list of filenames not in files.xml."""
+        missing = []
+        for checksum, fn in manifest:
+            remote = files.get(fn)
+            if remote is None:
+                missing.append(fn)
+                continue
+            remote_size, remote_md5 = remote
+            if checksum != '-' and remote_md5 != checksum:
+                s.error("ERROR: BAD_REMOTE_CHECKSUM (%s) %s" % (
+                        remote_md5, fn))
+                continue
+            try:
+                local_size = os.path.getsize(s.path(fn))
+            except OSError:
+                if not os.path.exists(s.tombstone(fn)):
+                    s.error("ERROR: file not found: %s" % s.path(fn))
+                    continue
+                # cleaned after upload. md5 is all there is to check.
+                local_size = remote_size
+            if remote_size != local_size:
+                s.error("ERROR: BAD_REMOTE_FILESIZE (%s) %s" % (
+                        remote_size, fn))
+                continue
+            self.verified(s, fn, "REMOTE_CHECKSUM_OK %s %s" % (
+                    fn, remote_md5))
+        return missing
+
+    async def download(self, s, checksum, fn):
+        """download file fn, checking its md5 against checksum and its
+        size against local file. returns False if fn is not in the
+        item, None if download failed."""
+        url = self.download_url(s, fn)
+        s.log("downloading %s" % url)
+        h = hashlib.md5()
+        received = [0]
+        def on_chunk(chunk):
+            h.update(chunk)
+            received[0] += len(chunk)
+        resp = await self.stream(url, on_chunk)
+        if resp.code == 404:
+            return False
+        if resp.code != 200:
+            self.failed(s, resp)
+            return None
+        digest = h.hexdigest()
+        if checksum != '-' and digest != checksum:
+            s.error("ERROR: BAD_CHECKSUM %s %s" % (digest, fn))
+        elif os.path.exists(s.path(fn)) and \
+                received[0] != os.path.getsize(s.path(fn)):
+            s.error("ERROR: BAD_REMOTE_FILESIZE (%d) %s" % (received[0], fn))
+        else:
+            self.verified(s, fn, "CHECKSUM_OK %s %s" % (fn, digest))
+        return True
+
+    def sample_ranges(self, size):
+        """(offset, length) of ranges to sample of a file of size bytes,
+        in order. the last one ends at the end of file."""
+        length = min(self.sample_size, size)
+        if length == 0:
+            return []
+        # ranges at multiples of length, other than the one at the end
+        slots = (size - 1) // length
+        picked = random.sample(range(slots), min(self.samples - 1, slots))
+        offsets = [i * length for i in picked] + [size - length]
+        return [(o, length) for o in sorted(offsets)]
+
+    async def sample(self, s, checksum, fn):
+        """check random ranges of file fn against the local file.
+        returns False if fn is not in the item, None if a request
+        failed."""
+        path = s.path(fn)
+        size = os.path.getsize(path)
+        url = self.download_url(s, fn)
+        loop = IOLoop.current()
+        ranges = self.sample_ranges(size)
+        for offset, length in ranges:
+            local = await loop.run_in_executor(None, range_md5, path,
+                                               offset, length)
+            h = hashlib.md5()
+            resp = await self.stream(url, h.update, {
+                    'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+            if resp.code == 404:
+                return False
+            if resp.code != 206:
+                self.failed(s, resp)
+                return None
+            m = re.match(r'bytes (\d+)-(\d+)/(\d+)',
+                         resp.headers.get('Content-Range', ''))
+            if not m or int(m.group(1)) != offset:
+                s.log("  bad Content-Range: %s" %
+                      resp.headers.get('Content-Range'))
+                return None
+            if int(m.group(3)) != size:
+                s.error("ERROR: BAD_REMOTE_FILESIZE (%s) %s" % (
+                        m.group(3), fn))
+                return True
+            if h.hexdigest() != local:
+                s.error("ERROR: BAD_CHECKSUM of bytes %d-%d %s %s" % (
+                        offset, offset + length - 1, h.hexdigest(), fn))
+                return True
+        self.verified(s, fn, "SAMPLE_OK %s %d ranges" % (fn, len(ranges)))
+        return True
+
+    async def check_files(self, s, manifest, slots):
+        """check each file in manifest by download or sample, each
+        holding one of slots. files cleaned from series directory cannot
+        be sampled, and are checked against files.xml instead. returns
+        list of filenames not in the item, or None if some could not be
+        checked."""
+        check = self.download
+        cleaned = []
+        if self.method == 'sample':
+            check = self.sample
+            cleaned = [(checksum, fn) for checksum, fn in manifest
+                       if not os.path.exists(s.path(fn))]
+            manifest = [m for m in manifest if m not in cleaned]
+        async def check_file(checksum, fn):
+            async with slots:
+                return await check(s, checksum, fn)
+        async def check_cleaned():
+            async with slots:
+                files = await self.fetch_files(s)
+            if files is None:
+                return None
+            return self.reconcile(s, cleaned, files)
+        results = await asyncio.gather(*[check_file(checksum, fn)
+                                         for checksum, fn in manifest])
+        missing = []
+        if cleaned:
+            missing = await check_cleaned()
+        if None in results or missing is None:
+            return None
+        return [fn for (checksum, fn), found in zip(manifest, results)
+                if not found] + missing
+
+    def write_tombstone(self, s, manifest):
+        """write TOMBSTONE listing .tombstone of all files in manifest"""
+        tmp = s.TOMBSTONE + '.open'
+        with open(tmp, 'w') as w:
+            for checksum, fn in manifest:
+                with open(s.tombstone(fn)) as f:
+                    w.write(f.read())
+        os.rename(tmp, s.TOMBSTONE)
+
+    async def verify_series(self, s, slots):
+        """verify series s, holding one of slots for each request.
+        returns 'verified', 'pending' or 'error'."""
+        if not os.path.exists(s.MANIFEST):
+            s.echo("MANIFEST not found: %s" % s.MANIFEST)
+            self.counts['error'] += 1
+            return 'error'
+        try:
+            try:
+                s.log("==== %s ====" % s.name)
+                status = await self.check_series(s, slots)
+            except Exception as ex:
+                # other series go on
+                s.error("ERROR: verification failed: %s" % ex)
+                status = 'error'
+            if s.errors:
+                with open(s.ERROR, 'a') as w:
+                    for msg in s.errors:
+                        w.write(msg + '\n')
+                s.echo("wrote file: %s" % s.ERROR)
+        except OSError as ex:
+            s.echo("ERROR: %s" % ex)
+            status = 'error'
+        finally:
+            if os.path.exists(s.OPEN):
+                os.remove(s.OPEN)
+        self.counts[status] += 1
+        return status
+
+    async def check_series(self, s, slots):
+        """verify files of series s, writing TOMBSTONE if all are
+        verified. returns 'verified', 'pending' or 'error' (errors are
+        in s.errors)."""
+        with open(s.MANIFEST) as f:
+            manifest = [(l.split()[0], l.split()[1]) for l in f
+                        if len(l.split()) >= 2]
+        if self.method == 'size':
+            async with slots:
+                files = await self.fetch_files(s)
+            missing = (None if files is None else
+                       self.reconcile(s, manifest, files))
+        else:
+            missing = await self.check_files(s, manifest, slots)
+        if s.errors:
+            return 'error'
+        if missing is None:
+            return 'pending'
+        if missing:
+            s.log("%d of %d files not in item yet: %s" % (
+                    len(missing), len(manifest), ' '.join(missing)))
+            return 'pending'
+        s.log("verified %d files" % len(manifest))
+        self.write_tombstone(s, manifest)
+        s.echo("wrote %s" % s.TOMBSTONE)
+        return 'verified'
+
+    async def run(self, names=None):
+        """verify series waiting for verification, or series names.
+        returns number of series verified."""
+        self.echo("%s %s" % (os.path.basename(__file__), time.strftime('%c')))
+        # shared by all users of KeepAliveHTTPClient on this IOLoop, with
+        # the largest max_clients asked for
+        self.client = httppool.KeepAliveHTTPClient(
+            max_clients=self.concurrency)
+        if names:
+            series = [VerifySeries(os.path.join(self.xfer_dir, name),
+                                   self.out) for name in names]
+        else:
+            series = list(self.ready_series())
+        slots = locks.Semaphore(self.concurrency)
+        await asyncio.gather(*[self.verify_series(s, slots)
+                               for s in series])
+        self.echo("%(verified)d verified, %(pending)d pending,"
+                  " %(error)d error" % self.counts)
+        self.echo("%s done. %s" % (os.path.basename(__file__),
+                                   time.strftime('%c')))
+        return self.counts['verified']
+
+def range_md5(path, offset, length):
+    """md5 of length bytes of path from offset"""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(s3upload.BUFSIZE, length))
+            if not data:
+                break
+            h.update(data)
+            length -= len(data)
+    return h.hexdigest()
+
+def main(conf, names=None, out=None, method='size'):
+    """verify series for DrainConfig conf with method. returns exit
+    status: 0 if no series failed verification."""
+    try:
+        verifier = Verifier(conf, out=out, method=method)
+        httppool.run_sync(verifier.run(names))
+    except OSError as ex:
+        print("ERROR: %s" % ex, file=out or sys.stdout)
+        return 1
+    return 1 if verifier.counts['error'] else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(os.path.basename(__file__), __doc__)
+        sys.exit(1)
+    conf = config.DrainConfig(sys.argv[1])
+    try:
+        conf.validate()
+    except ValueError as ex:
+        print("ERROR: invalid config: %s: %s" % (sys.argv[1], ex))
+        sys.exit(1)
+    args = sys.argv[2:]
+    method = 'size'
+    if args and args[0] in METHODS:
+        method = args.pop(0)
+    sys.exit(main(conf, args, method=method))